@@ -1,16 +1,37 @@
-import json
+import asyncio
+import orjson
 import config
 from openai import AsyncOpenAI
 import plant_utils
 import telegrambot
-from chat_context import ChatContext, DialogState, PERSONA_DESCRIPTION, ADDRESS_INFO, RESPONSE_FORMAT_INSTRUCTIONS
+from chat_context import ChatContext, DialogState, SYSTEM_PROMPT_BASE
 from agents import Agent, Runner, function_tool, ModelSettings, RunContextWrapper
 import logging
 import re
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+def _json_default(obj):
+    """Сериализует значения, которые orjson не знает (numpy-скаляры из pandas и т.п.)"""
+    if hasattr(obj, "item"):
+        return obj.item()
+    return str(obj)
+
+def _dumps(obj) -> str:
+    """Сериализует результат инструмента в JSON-строку (кириллица без экранирования)"""
+    return orjson.dumps(obj, default=_json_default).decode()
+
+@lru_cache(maxsize=1)
+def get_openai_client() -> AsyncOpenAI:
+    """
+    Общий асинхронный клиент OpenAI: один пул соединений на весь процесс.
+    Создаётся при первом обращении, чтобы импорт модуля не читал .env.
+    """
+    return AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+
 # Возможные категории запросов для менеджера
 CATEGORY_REPLIES = {
     "live_photo": "Сейчас я спрошу у коллеги, чтобы он сделал для вас свеженькое фото растения 📸 Немного подождите, хорошо?",
@@ -85,17 +106,26 @@ PLANT_POT_SIZE_MAPPING = {
     53: (60, 70)
 }
 
+# Паттерны диаметра горшка в названии растения: "12/45 см", "d17 см", "21/110 см"
+_DIAMETER_PATTERNS = (
+    re.compile(r'(\d+)/\d+\s*см'),  # "12/45 см" - берем первое число
+    re.compile(r'd(\d+)\s*см'),     # "d17 см" - берем число после d
+    re.compile(r'(\d+)\s*см'),      # "21 см" - просто число с см
+)
+
+# Паттерны размера кашпо в запросе пользователя
+_POT_SIZE_PATTERNS = (
+    re.compile(r'(\d+)\s*см'),      # "20 см", "15см"
+    re.compile(r'd(\d+)'),          # "d15", "d20"
+    re.compile(r'диаметр\s*(\d+)'), # "диаметр 20"
+    re.compile(r'размер\s*(\d+)'),  # "размер 15"
+)
+
+@lru_cache(maxsize=2048)
 def extract_plant_diameter(plant_name: str) -> int | None:
     """Извлекает диаметр горшка из названия растения"""
-    # Ищем паттерны типа "12/45 см", "d17 см", "21/110 см"
-    patterns = [
-        r'(\d+)/\d+\s*см',  # "12/45 см" - берем первое число
-        r'd(\d+)\s*см',     # "d17 см" - берем число после d
-        r'(\d+)\s*см',      # "21 см" - просто число с см
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, plant_name)
+    for pattern in _DIAMETER_PATTERNS:
+        match = pattern.search(plant_name)
         if match:
             diameter = int(match.group(1))
             # Проверяем, что диаметр в разумных пределах (5-60 см)
@@ -104,92 +134,160 @@ def extract_plant_diameter(plant_name: str) -> int | None:
     
     return None
 
+# Максимальный диаметр, для которого заранее готовим ссылку (кашпо ищем до 70 см)
+POT_LINK_MAX_DIAMETER = 70
+POT_CATALOG_FILTER_URL = "https://tropichouse.ru/catalog/gorshki_i_kashpo/filter"
+
+def _build_pot_link_table() -> tuple[str, ...]:
+    """Готовит ссылки на кашпо для каждого диаметра 0..POT_LINK_MAX_DIAMETER.
+
+    Для диаметров, которых нет в PLANT_POT_SIZE_MAPPING, берётся ближайший размер из таблицы.
+    """
+    links = []
+    for diameter in range(POT_LINK_MAX_DIAMETER + 1):
+        closest_diameter = min(PLANT_POT_SIZE_MAPPING, key=lambda x: abs(x - diameter))
+        min_diameter, max_diameter = PLANT_POT_SIZE_MAPPING[closest_diameter]
+        links.append(f"{POT_CATALOG_FILTER_URL}/diameter-from-{min_diameter}-to-{max_diameter}/apply/")
+    return tuple(links)
+
+_POT_LINKS = _build_pot_link_table()
+
 def generate_pot_link(plant_diameter: int) -> str:
     """Генерирует ссылку на подходящие горшки по размеру растения"""
-    if plant_diameter not in PLANT_POT_SIZE_MAPPING:
-        # Если точного соответствия нет, используем ближайший размер
-        closest_diameter = min(PLANT_POT_SIZE_MAPPING.keys(), 
-                             key=lambda x: abs(x - plant_diameter))
-        pot_range = PLANT_POT_SIZE_MAPPING[closest_diameter]
-    else:
-        pot_range = PLANT_POT_SIZE_MAPPING[plant_diameter]
-    
-    min_diameter, max_diameter = pot_range
+    # Ближайший размер для каждого диаметра посчитан заранее, здесь только индекс
+    index = min(max(plant_diameter, 0), POT_LINK_MAX_DIAMETER)
+    return _POT_LINKS[index]
+
+def _format_pot_suggestion(plant: dict) -> str:
+    """Формирует предложение купить кашпо для растения в техническом горшке"""
+    plant_name = plant.get("Название", "растение")
+    diameter = extract_plant_diameter(plant_name)
     
-    # Формируем ссылку с нужными параметрами
-    base_url = "https://tropichouse.ru/catalog/gorshki_i_kashpo/filter"
-    link = f"{base_url}/diameter-from-{min_diameter}-to-{max_diameter}/apply/"
+    if diameter:
+        pot_link = generate_pot_link(diameter)
+        return f"""🪴 Кстати! Ваше растение "{plant_name}" поставляется в техническом горшке. 
+
+Рекомендуем дополнить заказ красивым кашпо подходящего размера:
+{pot_link}
+
+Это не только украсит интерьер, но и обеспечит растению лучшие условия! 🌿✨"""
     
-    return link
+    # Если не удалось определить размер, отправляем общую ссылку
+    return f"""🪴 Кстати! Ваше растение "{plant_name}" поставляется в техническом горшке. 
+
+Рекомендуем дополнить заказ красивым кашпо:
+https://tropichouse.ru/catalog/gorshki_i_kashpo/
+
+Это не только украсит интерьер, но и обеспечит растению лучшие условия! 🌿✨"""
 
 async def check_and_send_pot_suggestion(chat_id: str, selected_plants: list):
     """Проверяет растения в техническом горшке и отправляет предложение купить кашпо"""
     from main import send_message
     
-    tech_pot_plants = []
-    
-    # Проверяем каждое выбранное растение
-    for plant in selected_plants:
-        pot_info = plant.get("Кашпо/Горшок", "")
-        if "в техническом горшке" in pot_info:
-            tech_pot_plants.append(plant)
+    # Формируем сообщение для каждого растения в техническом горшке
+    messages = [
+        _format_pot_suggestion(plant)
+        for plant in selected_plants
+        # Пустая ячейка "Кашпо/Горшок" приходит как None (или NaN в старых данных)
+        if isinstance(pot := plant.get("Кашпо/Горшок"), str) and "в техническом горшке" in pot
+    ]
     
-    if not tech_pot_plants:
+    if not messages:
         return  # Нет растений в технических горшках
     
-    # Формируем сообщение для каждого растения в техническом горшке
-    for plant in tech_pot_plants:
-        plant_name = plant.get("Название", "растение")
-        diameter = extract_plant_diameter(plant_name)
-        
-        if diameter:
-            pot_link = generate_pot_link(diameter)
-            message = f"""🪴 Кстати! Ваше растение "{plant_name}" поставляется в техническом горшке. 
+    # Отправляем все предложения параллельно, а не по одному
+    await asyncio.gather(*(send_message(chat_id, message) for message in messages))
+
+# Запрос на отзыв, который после доставки отправляет другой бот
+REVIEW_REQUEST_TEXT = (
+    "Ваш заказ доставлен 🏡\n"
+    "Благодарим за покупку в TropicHouse! 🌿\n\n"
+    "Ваш выбор — лучшая награда для нашей команды. Мы постоянно совершенствуем сервис и хотим, чтобы вам было приятно возвращаться🌴\n\n"
+    "Пожалуйста, оцените наш сервис по 5-балльной шкале:\n"
+    "5 — 😍 всё отлично\n"
+    "3 — 😐 есть, что улучшить\n"
+    "1 — 😞 остались недовольны"
+)
 
-Рекомендуем дополнить заказ красивым кашпо подходящего размера:
-{pot_link}
+# Ответы клиента на запрос отзыва, на которые бот не реагирует
+_REVIEW_REPLIES = frozenset({
+    '1', '3', '5', '1 - 3', '5 - отлично', '5 — всё отлично', '3 — есть, что улучшить',
+    '1 — остались недовольны',
+})
+
+# Очевидные запросы классифицируем без обращения к модели
+_TRIVIAL_MESSAGES = frozenset({
+    "да", "нет", "ага", "ок", "окей", "хорошо", "понятно", "ясно", "спасибо", "спс",
+    "благодарю", "привет", "здравствуйте", "добрый день", "добрый вечер", "доброе утро",
+    "/start",
+})
+
+# Только правила, которые нельзя перевернуть отрицанием. call_request и ask_human
+# переводят чат к менеджеру, а "не звоните"/"без перезвона" правилом не отличить -
+# их решают модель и кэш классификатора
+_FAST_INTENT_RULES = (
+    (re.compile(r'\d{1,2}'), "none"),  # выбор пункта из списка: "1", "2"
+)
 
-Это не только украсит интерьер, но и обеспечит растению лучшие условия! 🌿✨"""
-        else:
-            # Если не удалось определить размер, отправляем общую ссылку
-            message = f"""🪴 Кстати! Ваше растение "{plant_name}" поставляется в техническом горшке. 
+# Кэш ответов классификатора: нормализованный текст -> категория
+INTENT_CACHE_SIZE = 1024
+_intent_cache: OrderedDict[str, str] = OrderedDict()
 
-Рекомендуем дополнить заказ красивым кашпо:
-https://tropichouse.ru/catalog/gorshki_i_kashpo/
+def _normalize_intent_text(text: str) -> str:
+    """Приводит текст к виду, по которому ищем в правилах и кэше классификатора"""
+    return " ".join(text.lower().split()).strip(" .,!?)")
 
-Это не только украсит интерьер, но и обеспечит растению лучшие условия! 🌿✨"""
-        
-        await send_message(chat_id, message)
+def _match_fast_intent(normalized: str) -> str | None:
+    """Возвращает категорию, если запрос однозначно решается правилами"""
+    if normalized in _TRIVIAL_MESSAGES:
+        return "none"
+    for pattern, category in _FAST_INTENT_RULES:
+        if pattern.fullmatch(normalized):
+            return category
+    return None
 
-async def classify_intent(ctx: RunContextWrapper[ChatContext] | ChatContext, text: str) -> str:
+def _classify_intent_without_model(context: ChatContext, text: str) -> tuple[str | None, str]:
     """
-        Classifies a client message into a predefined intent.
-        """
-    review_request_text = (
-        "Ваш заказ доставлен 🏡\n"
-        "Благодарим за покупку в TropicHouse! 🌿\n\n"
-        "Ваш выбор — лучшая награда для нашей команды. Мы постоянно совершенствуем сервис и хотим, чтобы вам было приятно возвращаться🌴\n\n"
-        "Пожалуйста, оцените наш сервис по 5-балльной шкале:\n"
-        "5 — 😍 всё отлично\n"
-        "3 — 😐 есть, что улучшить\n"
-        "1 — 😞 остались недовольны"
-    )
+    Классифицирует запрос без модели: отзывы, очевидные правила и кэш классификатора.
+    Возвращает (категория или None, если нужна модель; нормализованный текст).
+    """
+    stripped_text = text.strip()
 
     # Проверка на прямое совпадение с текстом запроса на отзыв
-    if text.strip() == review_request_text.strip():
+    if stripped_text == REVIEW_REQUEST_TEXT:
         logger.info("Ignoring fixed review request message from another bot.")
-        return "review_ignore"
+        return "review_ignore", ""
 
     # Проверка на ответ клиента на запрос отзыва (число от 1 до 5)
-    last_message = context.get_last_message()
-    if last_message and last_message.get('text', '').strip() == review_request_text.strip():
-        if text.strip() in ['1', '3', '5', '1 - 3', '5 - отлично', '5 — всё отлично', '3 — есть, что улучшить',
-                            '1 — остались недовольны']:
+    history = context.get_last_n_messages(1)
+    last_message = history[-1] if history else None
+    if last_message and (last_message.get('content') or '').strip() == REVIEW_REQUEST_TEXT:
+        if stripped_text in _REVIEW_REPLIES:
             logger.info("Ignoring client's response to a review request.")
-            return "review_ignore"
+            return "review_ignore", ""
+
+    normalized = _normalize_intent_text(text)
+    category = _match_fast_intent(normalized)
+    if category is not None:
+        logger.debug("[classify_intent] Категория '%s' определена без модели", category)
+        return category, normalized
 
-    """Классифицирует запрос пользователя для выделения случаев, требующих уведомления менеджера."""
-    client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+    category = _intent_cache.get(normalized)
+    if category is not None:
+        _intent_cache.move_to_end(normalized)
+    return category, normalized
+
+async def classify_intent(context: ChatContext, text: str) -> str:
+    """
+        Classifies a client message into a predefined intent.
+        """
+    category, normalized = _classify_intent_without_model(context, text)
+    if category is not None:
+        return category
+    return await _classify_intent_with_model(text, normalized)
+
+async def _classify_intent_with_model(text: str, normalized: str) -> str:
+    """Классифицирует запрос пользователя моделью для выделения случаев, требующих уведомления менеджера."""
     system_prompt = """
 # Инструкция по классификации запросов клиентов
 Ты анализируешь запросы клиентов магазина растений и классифицируешь их по следующим категориям:
@@ -223,34 +321,22 @@ async def classify_intent(ctx: RunContextWrapper[ChatContext] | ChatContext, tex
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": text},
     ]
-    response = await client.chat.completions.create(model="gpt-4.1-mini", messages=messages)
+    response = await get_openai_client().chat.completions.create(model="gpt-4.1-mini", messages=messages)
     category = response.choices[0].message.content.strip().lower()
     if category not in CATEGORY_REPLIES:
-        return "none"
+        category = "none"
+
+    _intent_cache[normalized] = category
+    if len(_intent_cache) > INTENT_CACHE_SIZE:
+        _intent_cache.popitem(last=False)
     return category
 
 # Динамические инструкции с учётом состояния диалога
 
-def _make_instructions(ctx: RunContextWrapper[ChatContext] | ChatContext, agent: Agent[ChatContext]) -> str:
-    # Получаем базовые инструкции
-    instructions = f"{PERSONA_DESCRIPTION}\n{ADDRESS_INFO}\n{RESPONSE_FORMAT_INSTRUCTIONS}"
-    
-    # Проверяем тип объекта и получаем state
-    if isinstance(ctx, RunContextWrapper):
-        state = ctx.context.state
-        cart = ctx.context.cart
-    else:
-        state = ctx.state
-        cart = ctx.cart
-    
-    # Добавляем информацию о корзине, если в ней есть товары
-    if cart:
-        cart_info = f"\n## Текущая корзина:\n{ctx.context.get_cart_summary() if isinstance(ctx, RunContextWrapper) else ctx.get_cart_summary()}"
-        instructions += cart_info
-    
-    # Добавляем контекстно-зависимые инструкции
-    if state == DialogState.START:
-        instructions += """
+# Базовые инструкции не меняются, собираем их один раз
+# Контекстно-зависимые инструкции для каждого состояния
+_STATE_INSTRUCTIONS = {
+    DialogState.START: """
 ## Текущее состояние: Начало диалога
 Используй ТОЧНО ЭТОТ шаблон для первого сообщения:
 
@@ -260,24 +346,18 @@ def _make_instructions(ctx: RunContextWrapper[ChatContext] | ChatContext, agent:
 Если мне не хватит компетентности, сразу переведу наш диалог на специалиста🌷
 
 НЕ ИЗМЕНЯЙ ЭТОТ ТЕКСТ. Используй его как есть.
-"""
-    elif state == DialogState.ASK_SIZE:
-        instructions += "\n## Текущее состояние: Уточнение размера\nСфокусируйся на выяснении предпочтительного размера растения (напольное >90см или настольное <90см)."
-    elif state == DialogState.ASK_LOCATION:
-        instructions += "\n## Текущее состояние: Уточнение места размещения\nУточни, куда планируется поставить растение (дом, офис, подарок)."
-    elif state == DialogState.PLANT_SEARCH:
-        instructions += """
+""",
+    DialogState.ASK_SIZE: "\n## Текущее состояние: Уточнение размера\nСфокусируйся на выяснении предпочтительного размера растения (напольное >90см или настольное <90см).",
+    DialogState.ASK_LOCATION: "\n## Текущее состояние: Уточнение места размещения\nУточни, куда планируется поставить растение (дом, офис, подарок).",
+    DialogState.PLANT_SEARCH: """
 ## Текущее состояние: Подбор растений
 Ищи растения, максимально соответствующие критериям пользователя.
 ВАЖНО: После показа растений ВСЕГДА предлагай добавить растение в корзину с помощью функции add_to_cart.
 Спрашивай: "Хотите добавить это растение в корзину?" или "Добавить в корзину?"
-"""
-    elif state == DialogState.OUT_OF_STOCK:
-        instructions += "\n## Текущее состояние: Растение не в наличии\nМягко предложи оформить предзаказ с доставкой через 3-10 дней или рассмотреть альтернативы. Можно добавить в корзину как предзаказ."
-    elif state == DialogState.ORDERING:
-        instructions += "\n## Текущее состояние: Оформление заказа\nПозови менеджера и подготовь всю информацию для оформления заказа."
-    elif state == DialogState.CART_MANAGEMENT:
-        instructions += """
+""",
+    DialogState.OUT_OF_STOCK: "\n## Текущее состояние: Растение не в наличии\nМягко предложи оформить предзаказ с доставкой через 3-10 дней или рассмотреть альтернативы. Можно добавить в корзину как предзаказ.",
+    DialogState.ORDERING: "\n## Текущее состояние: Оформление заказа\nПозови менеджера и подготовь всю информацию для оформления заказа.",
+    DialogState.CART_MANAGEMENT: """
 ## Текущее состояние: Управление корзиной
 Пользователь управляет содержимым корзины. Доступны функции:
 - add_to_cart: добавить еще растения
@@ -286,43 +366,45 @@ def _make_instructions(ctx: RunContextWrapper[ChatContext] | ChatContext, agent:
 - checkout_cart: оформить заказ всех растений
 
 После добавления растения в корзину ВСЕГДА спрашивай: "Хотите добавить еще растения или оформим заказ?"
-"""
-    elif state == DialogState.UPSELL:
-        instructions += "\n## Текущее состояние: Предложение дополнительных товаров\nПредложи полезные аксессуары для ухода за растением. Используй функцию suggest_accessories."
+""",
+    DialogState.UPSELL: "\n## Текущее состояние: Предложение дополнительных товаров\nПредложи полезные аксессуары для ухода за растением. Используй функцию suggest_accessories.",
+}
+
+def _make_instructions(ctx: RunContextWrapper[ChatContext] | ChatContext, agent: Agent[ChatContext]) -> str:
+    # Проверяем тип объекта и получаем контекст чата
+    context = ctx.context if isinstance(ctx, RunContextWrapper) else ctx
     
-    return instructions
+    # Добавляем информацию о корзине, если в ней есть товары
+    cart_info = f"\n## Текущая корзина:\n{context.get_cart_summary()}" if context.cart else ""
+    
+    # Добавляем контекстно-зависимые инструкции
+    return SYSTEM_PROMPT_BASE + cart_info + _STATE_INSTRUCTIONS.get(context.state, "")
 
 @function_tool
 async def search(ctx: RunContextWrapper[ChatContext], query: str) -> str:
     """Ищет растения в базе данных по запросу пользователя."""
-    client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
-    
     # Результаты векторного поиска
-    results_with_score = await plant_utils.vector_search_with_score(query, top_k=50, openai_client=client)
+    results_with_score = await plant_utils.vector_search_with_score(query, top_k=50, openai_client=get_openai_client())
     
-    processed_results = []
-    for plant_data, score in results_with_score:
-        item = plant_data.copy()  # Копируем все поля
-        item["relevance_score"] = score
-        processed_results.append(item)
+    # Копируем все поля растения и добавляем оценку релевантности
+    processed_results = [
+        {**plant_data, "relevance_score": score}
+        for plant_data, score in results_with_score
+    ]
+    seen_names = {item.get("Название") for item in processed_results}  # Названия, уже попавшие в результаты
         
     # Результаты поиска по имени
     name_search_results = plant_utils.search_plants_by_name(query)
     for plant_data_from_name_search in name_search_results:
         name = plant_data_from_name_search.get("Название")
         
-        # Проверяем, есть ли растение с таким же "Название" уже в результатах
-        is_duplicate = any(
-            existing_item.get("Название") == name 
-            for existing_item in processed_results
-        )
-        
-        if not is_duplicate:
-            item = plant_data_from_name_search.copy()  # Копируем все поля
-            item["relevance_score"] = 1.0  # Прямые совпадения по имени получают высокий балл
-            processed_results.append(item)
+        # Пропускаем растения с таким же "Название", которые уже есть в результатах
+        if name not in seen_names:
+            # Прямые совпадения по имени получают высокий балл
+            processed_results.append({**plant_data_from_name_search, "relevance_score": 1.0})
+            seen_names.add(name)
             
-    return json.dumps({"results": processed_results, "total_count": len(processed_results), "query": query}, ensure_ascii=False)
+    return _dumps({"results": processed_results, "total_count": len(processed_results), "query": query})
 
 @function_tool
 async def order(ctx: RunContextWrapper[ChatContext], plant: str, quantity: int, customer_info: str | None = None) -> str:
@@ -340,7 +422,7 @@ async def order(ctx: RunContextWrapper[ChatContext], plant: str, quantity: int,
     # После успешного заказа переходим к предложению аксессуаров
     ctx.context.change_state(DialogState.UPSELL)
     
-    return json.dumps(result, ensure_ascii=False)
+    return _dumps(result)
 
 @function_tool
 async def preorder(ctx: RunContextWrapper[ChatContext], plant: str, quantity: int, customer_info: str | None = None) -> str:
@@ -358,7 +440,7 @@ async def preorder(ctx: RunContextWrapper[ChatContext], plant: str, quantity: in
     # После успешного предзаказа переходим к предложению аксессуаров
     ctx.context.change_state(DialogState.UPSELL)
     
-    return json.dumps(result, ensure_ascii=False)
+    return _dumps(result)
 
 @function_tool
 async def suggest_accessories(ctx: RunContextWrapper[ChatContext]) -> str:
@@ -373,13 +455,14 @@ async def suggest_accessories(ctx: RunContextWrapper[ChatContext]) -> str:
     # Переводим в состояние UPSELL
     ctx.context.change_state(DialogState.UPSELL)
     
-    return json.dumps({"accessories": accessories}, ensure_ascii=False)
+    return _dumps({"accessories": accessories})
 
 @function_tool
 async def add_to_cart(ctx: RunContextWrapper[ChatContext], plant: str, quantity: int, order_type: str = "order") -> str:
     """Добавляет растение в корзину для последующего оформления заказа."""
     # Ищем растение в базе данных по названию
-    plant_data = plant_utils.search_plants_by_name(plant)
+    # В корзину идёт первое совпадение - остальные не собираем
+    plant_data = plant_utils.search_plants_by_name(plant, limit=1)
     
     if not plant_data:
         return "Растение не найдено в каталоге"
@@ -460,23 +543,20 @@ async def checkout_cart(ctx: RunContextWrapper[ChatContext], customer_info: str
     ctx.context.clear_cart()
     ctx.context.change_state(DialogState.UPSELL)
     
-    return json.dumps({"success": True, "message": "Заказ оформлен"}, ensure_ascii=False)
+    return _dumps({"success": True, "message": "Заказ оформлен"})
 
 @function_tool
 async def remove_from_cart(ctx: RunContextWrapper[ChatContext], plant_name: str) -> str:
     """Удаляет растение из корзины по названию."""
-    # Проверяем, есть ли растение в корзине
-    plant_found = False
-    for item in ctx.context.cart:
-        if plant_name.lower() in item["plant"].get("Название", "").lower():
-            plant_found = True
-            break
+    # Проверяем, есть ли растение в корзине (по вхождению названия без учёта регистра)
+    needle = plant_name.lower()
+    cart_item = next((item for item in ctx.context.cart or () if needle in item["_name_lower"]), None)
     
-    if not plant_found:
+    if cart_item is None:
         return f"Растение '{plant_name}' не найдено в корзине"
     
-    # Удаляем растение
-    ctx.context.remove_from_cart(plant_name)
+    # Удаляем найденное растение по его полному названию
+    ctx.context.remove_from_cart(cart_item["plant"].get("Название"))
     
     # Остаемся в состоянии управления корзиной
     ctx.context.change_state(DialogState.CART_MANAGEMENT)
@@ -494,15 +574,9 @@ agent = Agent[ChatContext](
 async def extract_pot_size(text: str) -> int | None:
     """Извлекает размер кашпо из запроса пользователя."""
     # Сначала пытаемся найти размер прямо в тексте
-    patterns = [
-        r'(\d+)\s*см',      # "20 см", "15см"
-        r'd(\d+)',          # "d15", "d20"
-        r'диаметр\s*(\d+)', # "диаметр 20"
-        r'размер\s*(\d+)',  # "размер 15"
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text.lower())
+    text_lower = text.lower()
+    for pattern in _POT_SIZE_PATTERNS:
+        match = pattern.search(text_lower)
         if match:
             size = int(match.group(1))
             # Проверяем, что размер в разумных пределах для кашпо (10-70 см)
@@ -513,7 +587,6 @@ async def extract_pot_size(text: str) -> int | None:
 
 async def extract_plant_quantity(text: str) -> int:
     """Определяет количество растений в запросе пользователя."""
-    client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
     system_prompt = """
 Определи количество растений, которое хочет заказать пользователь в офис.
 
@@ -529,33 +602,36 @@ async def extract_plant_quantity(text: str) -> int:
         {"role": "user", "content": text},
     ]
     try:
-        response = await client.chat.completions.create(model="gpt-4.1-mini", messages=messages)
+        response = await get_openai_client().chat.completions.create(model="gpt-4.1-mini", messages=messages)
         quantity_str = response.choices[0].message.content.strip()
         return int(quantity_str)
-    except:
+    except Exception:
         return 1  # По умолчанию возвращаем 1
 
+# Категории, при которых нужно проверять доступность менеджеров
+MANAGER_CATEGORIES = frozenset({
+    "office_plant", "multiple_plants", "live_photo", "ask_human", "reclamation", "order_question", "call_request",
+})
+
 async def is_working_hours_and_managers_available(category: str) -> tuple[bool, bool]:
     """Проверяет рабочее время и доступность менеджеров
     
     Returns:
         tuple: (is_working_hours, has_online_managers)
     """
-    now = datetime.now()
-    current_hour = now.hour
-    
     # Рабочие часы: до 19:00
-    is_working_hours = current_hour < 19
+    is_working_hours = datetime.now().hour < 19
     
     # Проверяем доступность менеджеров только если требуется их вызов
     has_online_managers = False
-    if category in ["office_plant", "multiple_plants", "live_photo", "ask_human", "reclamation", "order_question", "call_request"]:
+    if category in MANAGER_CATEGORIES:
         # Определяем тип заказа для выбора группы менеджеров
         is_b2b = category == "office_plant"
         manager_group = config.MANAGER_B2B if is_b2b else config.MANAGER_B2C
         
         try:
-            online_managers = telegrambot.get_online_managers(manager_group["id"])
+            # Список кэшируется в telegrambot на ONLINE_MANAGERS_TTL секунд
+            online_managers = await telegrambot.get_online_managers(manager_group.id)
             has_online_managers = len(online_managers) > 0
         except Exception as e:
             logger.error(f"[is_working_hours_and_managers_available] Ошибка проверки менеджеров: {e}")
@@ -567,11 +643,31 @@ async def run_unified_agent(context: ChatContext, user_message: str, openai_clie
     """
         Main function to run the bot agent.
         """
-    # ... (код получения intent) ...
-    intent = await classify_intent(text=text, context=context)
+    # Если менеджер уже вызван, бот не отвечает (кроме /start) - количество растений не понадобится
+    manager_called = context.state == DialogState.MANAGER_CALLED and user_message.strip().lower() != "/start"
+
+    # Классифицируем запрос один раз и переиспользуем результат ниже.
+    # Отзывы, очевидные правила и кэш решаются без модели
+    category, normalized = _classify_intent_without_model(context, user_message)
+    quantity_task = None
+    if category is None:
+        # Классификатору нужна модель. Количество растений нужно только для office_plant,
+        # но запрашиваем его параллельно, чтобы не ждать два ответа модели подряд
+        if not manager_called:
+            quantity_task = asyncio.create_task(extract_plant_quantity(user_message))
+        try:
+            category = await _classify_intent_with_model(user_message, normalized)
+        except BaseException:
+            if quantity_task is not None:
+                quantity_task.cancel()
+            raise
+
+        if category != "office_plant" and quantity_task is not None:
+            quantity_task.cancel()
+            quantity_task = None
 
     # Если интент "review_ignore", не отвечаем
-    if intent == "review_ignore":
+    if category == "review_ignore":
         return ""
 
     """Обёртка над Agents SDK Runner с сохранением истории сообщений."""
@@ -580,17 +676,15 @@ async def run_unified_agent(context: ChatContext, user_message: str, openai_clie
     
     # Проверяем, не был ли уже вызван менеджер ранее
     # Пропускаем проверку для команды /start
-    if context.state == DialogState.MANAGER_CALLED and not user_message.strip().lower() in ["/start"]:
+    if manager_called:
         # Если менеджер уже был вызван, не отвечаем на сообщения клиента
         logger.info(f"[run_unified_agent] Менеджер уже вызван для chat {context.chat_id}, бот не отвечает на сообщения")
         return ""
     
-    # Проверяем категории, требующие уведомления менеджера
-    category = await classify_intent(context, user_message)
-    
     # Специальная логика для office_plant: вызываем менеджера только при количестве > 1
     if category == "office_plant":
-        quantity = await extract_plant_quantity(user_message)
+        # Категория из правил или кэша: модель количества ещё не запрашивали
+        quantity = await (quantity_task if quantity_task is not None else extract_plant_quantity(user_message))
         if quantity <= 1:
             # Для одного растения не вызываем менеджера, обрабатываем обычным агентом
             category = "none"
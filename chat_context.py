@@ -1,8 +1,10 @@
 import logging
-import json
+from collections import deque
 from enum import Enum
-from typing import Optional, Dict, List, Any, Tuple
-from datetime import datetime, timedelta
+from itertools import islice
+from typing import Optional, Dict, List, Any, Tuple, Iterator, Callable
+import sys
+import time
 
 # Константы для промптов LLM
 PERSONA_DESCRIPTION = """
@@ -73,6 +75,10 @@ N. {название растения}
 5. После списка добавь 1-2 предложения с предложением помощи в выборе
 """
 
+# Статическая часть системного промпта: собирается один раз при импорте,
+# чтобы не склеивать большие строки на каждый запрос к LLM
+SYSTEM_PROMPT_BASE = sys.intern(f"{PERSONA_DESCRIPTION}\n{ADDRESS_INFO}\n{RESPONSE_FORMAT_INSTRUCTIONS}")
+
 logger = logging.getLogger(__name__)
 
 # --------------------------- #
@@ -92,26 +98,63 @@ class DialogState(Enum):
     COMPLETED = "completed"   # Диалог завершён
     MANAGER_CALLED = "manager_called"  # Менеджер был вызван, бот не отвечает на сообщения
 
+def _intern_name(name: Any) -> Any:
+    """Интернирует название растения, чтобы ключи индекса корзины сравнивались по ссылке."""
+    return sys.intern(name) if type(name) is str else name
+
+
+# Состояния, из которых переход к поиску не сбрасывает предпочтения
+_KEEP_PREF_STATES = frozenset({DialogState.START, DialogState.PLANT_SEARCH, DialogState.CART_MANAGEMENT})
+
 
 # --------------------------- #
 #    Класс для контекста     #
 # --------------------------- #
 
+# Сколько последних сообщений хранится в истории диалога (в промпт уходит не больше 20)
+MAX_HISTORY = 64
+
+# Пул освобождённых контекстов для повторного использования
+CONTEXT_POOL_SIZE = 1024
+_context_pool: "deque[ChatContext]" = deque(maxlen=CONTEXT_POOL_SIZE)
+
 class ChatContext:
     """
     Хранит всю необходимую информацию о ходе диалога: последние сообщения,
     текущее состояние, данные выбранных растений, детали заказа и т.д.
+
+    Новые контексты лучше получать через ChatContext.acquire(), а ненужные
+    возвращать через release(): так объекты и их списки переиспользуются.
     """
+    __slots__ = (
+        "chat_id", "dialog_id", "_created_epoch", "messages", "state", "subject",
+        "desired_size", "desired_location", "selected_plants",
+        "cart", "_cart_index", "_cart_version", "_cart_summary_cache",
+        "order_details", "potential_groups", "channel_info", "user_info",
+        "out_of_stock_plant", "out_of_stock_plants", "preorder_info", "last_search_query",
+    )
+
     def __init__(self, chat_id: str):
+        self.messages: "deque[Tuple]" = deque(maxlen=MAX_HISTORY)  # история: последние MAX_HISTORY сообщений (role, content, tool_calls, tool_call_id, name)
+        # Корзина создаётся лениво при первом добавлении: большинство диалогов её не трогает
+        self.cart: Optional[List[Dict[str, Any]]] = None  # [{"plant": plant_data, "quantity": int, "type": "order"/"preorder"}, ...]
+        self._cart_index: Optional[Dict[Optional[str], Dict[str, Any]]] = None  # Название растения -> элемент корзины
+        self._reset_fields(chat_id)
+
+    def _reset_fields(self, chat_id: Optional[str]):
+        """Приводит все поля к начальному состоянию, переиспользуя существующие списки."""
         self.chat_id = chat_id
         self.dialog_id: Optional[str] = None
-        self.created_at = datetime.now()  # Время создания контекста
-        self.messages = []                # история (список словарей {"role": ..., "content": ...})
+        self._created_epoch = time.time()  # Время создания контекста (секунды epoch)
+        self.messages.clear()
         self.state = DialogState.START
+        self.subject = ""                 # Тема обращения для уведомления менеджера
         self.desired_size: Optional[str] = None      # 'floor', 'tabletop', 'any'
         self.desired_location: Optional[str] = None  # 'home', 'office', 'gift', 'any'
         self.selected_plants = None       # Сюда можно складывать выбранные позиции (при необходимости)
-        self.cart = []                    # Корзина: [{"plant": plant_data, "quantity": int, "type": "order"/"preorder"}, ...]
+        self._clear_cart_storage()
+        self._cart_version = 0            # Увеличивается при каждом изменении корзины
+        self._cart_summary_cache: Optional[Tuple[int, str]] = None  # (версия корзины, текст сводки)
         self.order_details = None         # Сюда можно складывать детали заказа
         self.potential_groups = None      # Сюда можно складывать сгруппированные результаты (если их >5 и т.п.)
         self.channel_info = None          # Информация о канале (name, id)
@@ -121,11 +164,29 @@ class ChatContext:
         self.preorder_info = None         # Информация о предзаказе (сроки доставки, комментарии и т.д.)
         self.last_search_query = None     # Последний поисковый запрос для сохранения контекста
 
-
-    def is_expired(self, days: int = 7) -> bool:
-        """Проверяет, истек ли срок действия контекста (по умолчанию 7 дней)."""
-        expiry_date = self.created_at + timedelta(days=days)
-        return datetime.now() > expiry_date
+    @classmethod
+    def acquire(cls, chat_id: str) -> "ChatContext":
+        """Возвращает чистый контекст для чата, по возможности из пула освобождённых."""
+        try:
+            context = _context_pool.pop()
+        except IndexError:
+            return cls(chat_id)
+        context._reset_fields(chat_id)
+        return context
+
+    def release(self):
+        """Очищает контекст и возвращает его в пул. После вызова объект использовать нельзя."""
+        self._reset_fields(None)
+        _context_pool.append(self)
+
+    def is_expired(self, days: int = 7, now: Optional[float] = None) -> bool:
+        """Проверяет, истек ли срок действия контекста (по умолчанию 7 дней).
+
+        now — текущее время (time.time()); при массовой проверке его удобно посчитать один раз.
+        """
+        if now is None:
+            now = time.time()
+        return now > self._created_epoch + days * 86400.0
 
     def add_message(self, role: str, text: Optional[str], tool_calls: Optional[List[Dict]] = None, tool_call_id: Optional[str] = None, name: Optional[str] = None):
         """Добавляет сообщение в историю диалога, поддерживая формат OpenAI.
@@ -137,33 +198,47 @@ class ChatContext:
             tool_call_id: ID вызова инструмента (для сообщений tool).
             name: Имя инструмента (для сообщений tool).
         """
-        message = {"role": role, "content": text}
+        # У OpenAI content должен быть null, если есть tool_calls;
+        # у tool-сообщений без текста content — пустая строка
+        if role == "tool" and text is None:
+            content = ""
+        elif tool_calls:
+            content = None
+        else:
+            content = text
+        # Храним компактный кортеж, словарь в формате OpenAI собирается только при отправке.
+        # Роль интернируем: их всего несколько, а строки могут приходить извне
+        self.messages.append((sys.intern(role), content, tool_calls or None, tool_call_id or None, name or None))
+
+    @staticmethod
+    def _to_openai_message(entry: Tuple) -> Dict[str, Any]:
+        """Собирает словарь в формате OpenAI из сохранённого кортежа сообщения."""
+        role, content, tool_calls, tool_call_id, name = entry
+        # Обычные текстовые сообщения user/assistant собираем одним литералом
+        if tool_calls is None and tool_call_id is None and name is None and content is not None:
+            return {"role": role, "content": content}
+        message = {"role": role}
+        # content опускаем, если он None, кроме сообщений assistant (там null допустим)
+        if content is not None or role == "assistant":
+            message["content"] = content
         if tool_calls:
-            # OpenAI ожидает tool_calls как список объектов, а не JSON-строку
             message["tool_calls"] = tool_calls
-            # У OpenAI content должен быть null, если есть tool_calls
-            message["content"] = None
         if tool_call_id:
             message["tool_call_id"] = tool_call_id
-            # У tool-сообщений в content обычно результат вызова (уже должен быть в text)
         if name:
-            message["name"] = name # Для tool-сообщений
+            message["name"] = name
+        return message
 
-        # Проверка для role="tool": если text=None, ставим content=""
-        if role == "tool" and text is None:
-            message["content"] = ""
-        # Удаляем ключи с None значениями, кроме content у assistant при tool_calls
-        # и content у tool (если мы его только что установили в "")
-        elif message["content"] is None and role != "assistant":
-             del message["content"]
-
-        self.messages.append(message)
+    def iter_openai_messages(self, start: int = 0) -> Iterator[Dict[str, Any]]:
+        """Отдаёт сообщения истории в формате OpenAI, начиная с позиции start."""
+        for entry in islice(self.messages, start, None):
+            yield self._to_openai_message(entry)
 
     def get_last_n_messages(self, n: int = 5) -> List[Dict[str, Any]]: # Возвращаемый тип Any из-за tool_calls
         """
         Возвращает последние n сообщений в истории.
         """
-        return self.messages[-n:] if len(self.messages) >= n else self.messages
+        return list(self.iter_openai_messages(max(0, len(self.messages) - n)))
 
     def reset_out_of_stock_state(self):
         """
@@ -183,22 +258,15 @@ class ChatContext:
         """
         Изменяет состояние диалога с соответствующими сбросами данных.
         """
-        logger.info(f"Chat {self.chat_id}: State change {self.state} -> {new_state}")
-
-        # Если переходим из OUT_OF_STOCK в другое состояние, сбрасываем связанные данные
-        if self.state == DialogState.OUT_OF_STOCK and new_state != DialogState.OUT_OF_STOCK:
-            self.reset_out_of_stock_state()
+        # Переход состояния — самый частый лог; аргументы форматируются, только если INFO включён
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Chat %s: State change %s -> %s", self.chat_id, self.state.value, new_state.value)
 
-        # Если переходим в COMPLETED, можно выполнить дополнительные действия при завершении
-        if new_state == DialogState.COMPLETED:
-            logger.info(f"Диалог в чате {self.chat_id} завершён")
-            # При завершении диалога очищаем корзину
-            self.clear_cart()
-
-        # Если переходим к новому поиску или начинаем сначала, сбрасываем предпочтения
-        if new_state in [DialogState.START, DialogState.PLANT_SEARCH] and self.state not in [DialogState.START, DialogState.PLANT_SEARCH, DialogState.CART_MANAGEMENT]:
-            self.reset_preferences()
-            # НЕ очищаем корзину при переходе к поиску, позволяем накапливать растения
+        # Побочные эффекты перехода берутся из таблиц: при выходе из текущего состояния и при входе в новое
+        for action in _EXIT_ACTIONS.get(self.state, ()):
+            action(self, new_state)
+        for action in _ENTRY_ACTIONS.get(new_state, ()):
+            action(self, new_state)
 
         # Устанавливаем новое состояние
         self.state = new_state
@@ -207,14 +275,14 @@ class ChatContext:
         """Полностью сбрасывает состояние диалога."""
         self.state = DialogState.START
         self.dialog_id = None
-        self.messages = []
+        self.messages.clear()
         self.selected_plants = None
         self.order_details = None
         self.potential_groups = None
         self.reset_out_of_stock_state()
         self.reset_preferences() # Сбрасываем предпочтения
         self.last_search_query = None     # Сбрасываем последний поисковый запрос
-        logger.info(f"Chat {self.chat_id}: Dialog reset")
+        logger.info("Chat %s: Dialog reset", self.chat_id)
 
     def set_out_of_stock_info(self, plant_data: Dict[str, Any], plants_list: Optional[List[Dict[str, Any]]] = None):
         """Устанавливает информацию о растении(ях) отсутствующих в наличии."""
@@ -224,39 +292,107 @@ class ChatContext:
     # Методы для работы с корзиной
     def add_to_cart(self, plant_data: Dict[str, Any], quantity: int = 1, order_type: str = "order"):
         """Добавляет растение в корзину."""
+        plant_name = _intern_name(plant_data.get("Название"))
+        if self.cart is None:
+            self.cart = []
+            self._cart_index = {}
+        
         # Проверяем, есть ли уже такое растение в корзине
-        for item in self.cart:
-            if item["plant"].get("Название") == plant_data.get("Название"):
-                item["quantity"] += quantity
-                return
+        item = self._cart_index.get(plant_name)
+        if item is not None:
+            item["quantity"] += quantity
+            self._cart_version += 1
+            return
         
         # Если растения нет в корзине, добавляем новый элемент
-        self.cart.append({
+        item = {
             "plant": plant_data,
             "quantity": quantity,
-            "type": order_type  # "order" или "preorder"
-        })
+            "type": order_type,  # "order" или "preorder"
+            "_name_lower": (plant_name or "").lower()  # для поиска по подстроке
+        }
+        self.cart.append(item)
+        self._cart_index[plant_name] = item
+        self._cart_version += 1
 
     def remove_from_cart(self, plant_name: str):
         """Удаляет растение из корзины по названию."""
-        self.cart = [item for item in self.cart if item["plant"].get("Название") != plant_name]
+        if not self.cart:
+            return
+        item = self._cart_index.pop(_intern_name(plant_name), None)
+        if item is not None:
+            self.cart.remove(item)
+            self._cart_version += 1
 
     def get_cart_summary(self) -> str:
-        """Возвращает краткое описание содержимого корзины."""
+        """Возвращает краткое описание содержимого корзины.
+
+        Сводка кэшируется до следующего изменения корзины.
+        """
         if not self.cart:
             return "Корзина пуста"
         
-        total_items = sum(item["quantity"] for item in self.cart)
+        if self._cart_summary_cache and self._cart_summary_cache[0] == self._cart_version:
+            return self._cart_summary_cache[1]
+        
+        # Один проход по корзине: и строки, и общее количество
+        total_items = 0
         items_text = []
         
         for item in self.cart:
-            plant_name = item["plant"].get("Название", "Неизвестное растение")
             quantity = item["quantity"]
+            total_items += quantity
+            plant_name = item["plant"].get("Название", "Неизвестное растение")
             order_type = " (предзаказ)" if item["type"] == "preorder" else ""
             items_text.append(f"• {plant_name} - {quantity} шт.{order_type}")
         
-        return f"🛒 В корзине ({total_items} растений):\n" + "\n".join(items_text)
+        summary = f"🛒 В корзине ({total_items} растений):\n" + "\n".join(items_text)
+        self._cart_summary_cache = (self._cart_version, summary)
+        return summary
 
     def clear_cart(self):
         """Очищает корзину."""
-        self.cart = [] 
\ No newline at end of file
+        self._clear_cart_storage()
+        self._cart_version += 1
+
+    def _clear_cart_storage(self):
+        """Опустошает уже созданные список и индекс корзины на месте, не выделяя новые."""
+        if self.cart is not None:
+            self.cart.clear()
+            self._cart_index.clear()
+
+
+# --------------------------- #
+#  Действия при смене состояния
+# --------------------------- #
+
+def _leave_out_of_stock(context: ChatContext, new_state: DialogState):
+    # Если уходим из OUT_OF_STOCK в другое состояние, сбрасываем связанные данные
+    if new_state is not DialogState.OUT_OF_STOCK:
+        context.reset_out_of_stock_state()
+
+
+def _enter_completed(context: ChatContext, new_state: DialogState):
+    logger.info("Диалог в чате %s завершён", context.chat_id)
+    # При завершении диалога очищаем корзину
+    context.clear_cart()
+
+
+def _enter_search(context: ChatContext, new_state: DialogState):
+    # При новом поиске или начале сначала сбрасываем предпочтения.
+    # Корзину НЕ очищаем, позволяем накапливать растения
+    if context.state not in _KEEP_PREF_STATES:
+        context.reset_preferences()
+
+
+# Действия при выходе из состояния (ключ — текущее состояние)
+_EXIT_ACTIONS: Dict[DialogState, Tuple[Callable[[ChatContext, DialogState], None], ...]] = {
+    DialogState.OUT_OF_STOCK: (_leave_out_of_stock,),
+}
+
+# Действия при входе в состояние (ключ — новое состояние; context.state ещё старое)
+_ENTRY_ACTIONS: Dict[DialogState, Tuple[Callable[[ChatContext, DialogState], None], ...]] = {
+    DialogState.COMPLETED: (_enter_completed,),
+    DialogState.START: (_enter_search,),
+    DialogState.PLANT_SEARCH: (_enter_search,),
+}
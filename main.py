@@ -1,19 +1,25 @@
 import asyncio
-import json
 import logging
-import pickle
+import orjson
 import re
 import os
+import random
 import time
-import base64
+try:
+    import pybase64 as base64  # SIMD-реализация с тем же API
+except ImportError:
+    import base64
+import hashlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime
-from threading import Thread, Lock
-from typing import Dict, List, Any, Optional, Tuple
-from PIL import Image
-from io import BytesIO
-import pandas as pd
-import requests
-import websocket
+from functools import lru_cache
+from typing import Dict, List, Any, Iterable, Optional, Tuple, NamedTuple
+import aiohttp
+try:
+    import uvloop  # быстрый event-loop; под Windows недоступен
+except ImportError:
+    uvloop = None
 # Предполагается, что все ключи и настройки хранятся в config.py
 import config
 
@@ -23,6 +29,8 @@ from bot_agent import run_unified_agent # Импортируем новую фу
 
 # Функции для работы с растениями (RAG, векторный поиск и т.п.)
 import plant_utils
+# Уведомления продавцам и назначение менеджеров (закрываем его HTTP-клиент при остановке)
+import telegrambot
 
 # Настройка логирования в файл и консоль
 log_dir = 'logs'
@@ -46,12 +54,6 @@ logger.info(f"Запуск приложения. Логи записываютс
 # --------------------------------------- #
 
 API_URL = config.API_URL
-TOKEN = config.RETAIL_CRM_BOT_TOKEN
-HEADERS = {"X-Bot-Token": TOKEN, "Content-Type": "application/json"}
-
-OPENAI_API_KEY = config.OPENAI_API_KEY
-MOY_SKLAD_TOKEN = config.MOY_SKLAD
-RETAILCRM_API_KEY = config.RETAIL_CRM
 RETAILCRM_BASE_URL = config.RETAILCRM_BASE_URL
 RETAILCRM_STORE_CODE = "tropichouse"
 
@@ -62,57 +64,113 @@ EMBEDDING_MODEL = "text-embedding-3-small"
 MAX_RECONNECT_ATTEMPTS = 10
 RECONNECT_DELAY = 5
 MAX_RECONNECT_DELAY = 60
+INIT_RETRY_MAX_DELAY = 60
 
-# Очередь входящих сообщений и главный event-loop
-message_queue = asyncio.Queue()
+# Главный event-loop
 main_event_loop = None
 
-# Инициализируем OpenAI-клиент (асинхронный)
-from openai import AsyncOpenAI
-openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+# Асинхронный OpenAI-клиент общий с bot_agent, чтобы не держать второй пул соединений
+from bot_agent import get_openai_client
 
-# Храним ChatContext для каждого chat_id
-chat_contexts: Dict[str, ChatContext] = {}
 
-# Для безопасной работы с веб-сокетом в многопоточном окружении
-ws_lock = Lock()
-contexts_lock = Lock()
+@lru_cache(maxsize=1)
+def _api_headers() -> Dict[str, str]:
+    """Заголовки запросов к API бота; токен читается из окружения при первом запросе, а не при импорте."""
+    return {"X-Bot-Token": config.RETAIL_CRM_BOT_TOKEN, "Content-Type": "application/json"}
+
+# Общая HTTP-сессия для RetailCRM и загрузки картинок (создаётся в main(), внутри event-loop)
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
+http_session: Optional[aiohttp.ClientSession] = None
+
+# Храним ChatContext для каждого chat_id.
+# Словарь читается и меняется только в event-loop, поэтому блокировка не нужна
+chat_contexts: Dict[str, ChatContext] = {}
 
 # Для объединения сообщений от пользователей
-user_messages: Dict[str, List[Tuple[str, Optional[str]]]] = {}  # chat_id -> [(text, image_url), ...]
-user_timers: Dict[str, asyncio.Task] = {}  # chat_id -> task
+@dataclass(slots=True)
+class PendingMessages:
+    """
+    Всё, что относится к ещё не обработанным сообщениям одного чата.
+    Тексты и фото копятся раздельно, чтобы при обработке не разбирать каждое сообщение по типу.
+    """
+    # Тексты держим в list: str.join берёт его как есть, а deque сначала копирует в список
+    texts: List[str] = field(default_factory=list)
+    images: "deque[str]" = field(default_factory=deque)
+    timer: Optional[asyncio.TimerHandle] = None  # отложенный запуск обработки (loop.call_later)
+    task: Optional[asyncio.Task] = None  # задача, которая сейчас обрабатывает пачку
+    first_at: float = 0.0  # loop.time() первого сообщения текущей пачки
+
+
+# chat_id -> PendingMessages; запись живёт, пока у чата есть сообщения или идёт обработка
+pending_chats: Dict[str, PendingMessages] = {}
 MESSAGE_DELAY = 1  # задержка в секундах
+MAX_MESSAGE_DELAY = 5 * MESSAGE_DELAY  # дольше пачку не копим, даже если клиент продолжает писать
+
+CONTEXT_CLEANUP_INTERVAL = 21600  # очистка устаревших контекстов, раз в 6 часов
+PLANT_DATA_REFRESH_INTERVAL = 3600  # обновление данных о растениях, раз в час
 
 
 # --------------------------------------- #
 #      Функции управления контекстами    #
 # --------------------------------------- #
 
+def get_context(chat_id: str, check_expiry: bool = False) -> ChatContext:
+    """
+    Возвращает контекст чата, создавая новый, если его нет.
+    С check_expiry=True устаревший (старше 7 дней) контекст заменяется новым.
+    Вызывается только из event-loop.
+    """
+    context = chat_contexts.get(chat_id)
+    if context is not None and check_expiry and context.is_expired():
+        logger.info(f"[get_context] Контекст для chat {chat_id} истек, создаем новый")
+        chat_contexts.pop(chat_id).release()
+        context = None
+    if context is None:
+        context = chat_contexts[chat_id] = ChatContext.acquire(chat_id)
+        logger.info(f"[get_context] Создан новый контекст для chat {chat_id}")
+    return context
+
+
 def cleanup_expired_contexts():
     """Удаляет устаревшие контексты диалогов для экономии памяти."""
-    with contexts_lock:
-        expired_chats = []
-        for chat_id, context in chat_contexts.items():
-            if context.is_expired():
-                expired_chats.append(chat_id)
-        
-        for chat_id in expired_chats:
-            del chat_contexts[chat_id]
-            logger.info(f"[cleanup_expired_contexts] Удален устаревший контекст для chat {chat_id}")
-        
-        if expired_chats:
-            logger.info(f"[cleanup_expired_contexts] Очищено {len(expired_chats)} устаревших контекстов")
+    # Время берём один раз на весь проход, а не для каждого контекста.
+    # Контексты чатов, сообщения которых сейчас обрабатываются, не трогаем:
+    # освобождённый контекст уходит в пул и может достаться другому чату
+    now = time.time()
+    expired_chats = [
+        chat_id for chat_id, context in chat_contexts.items()
+        if context.is_expired(now=now) and chat_id not in pending_chats
+    ]
+    
+    for chat_id in expired_chats:
+        chat_contexts.pop(chat_id).release()
+        logger.info(f"[cleanup_expired_contexts] Удален устаревший контекст для chat {chat_id}")
+    
+    if expired_chats:
+        logger.info(f"[cleanup_expired_contexts] Очищено {len(expired_chats)} устаревших контекстов")
 
 
 # --------------------------------------- #
 #      Асинхронные обёртки для HTTP
 # --------------------------------------- #
 
+def create_http_session() -> aiohttp.ClientSession:
+    """Создаёт сессию с пулом keep-alive соединений, общим для всех запросов бота."""
+    # DNS кэшируем на 5 минут (по умолчанию 10 с): хостов всего несколько и они не меняются
+    connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=60, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+
+async def _request(method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+    # Тело читаем сразу: соединение возвращается в пул, а resp.read() дальше отдаёт сохранённые байты
+    async with http_session.request(method, url, **kwargs) as resp:
+        await resp.read()
+    return resp
+
 async def async_get(url, **kwargs):
-    return await asyncio.to_thread(requests.get, url, **kwargs)
+    return await _request("GET", url, **kwargs)
 
 async def async_post(url, **kwargs):
-    return await asyncio.to_thread(requests.post, url, **kwargs)
+    return await _request("POST", url, **kwargs)
 
 
 # --------------------------------------- #
@@ -130,20 +188,14 @@ async def handle_client_message(chat_id: str, message_text: str):
     if message_text and message_text.strip().lower() in ["/start"]:
         logger.info(f"[handle_client_message] Получена команда сброса для chat {chat_id}")
         # Создаем новый контекст, полностью сбрасывая старый
-        chat_contexts[chat_id] = ChatContext(chat_id)
+        old_context = chat_contexts.get(chat_id)
+        chat_contexts[chat_id] = ChatContext.acquire(chat_id)
+        if old_context is not None:
+            old_context.release()
         # Продолжаем обработку, чтобы агент мог сгенерировать приветствие после сброса
 
-    # Получаем или создаем контекст для чата
-    if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = ChatContext(chat_id)
-        logger.info(f"[handle_client_message] Создан новый контекст для chat {chat_id}")
-    else:
-        # Проверяем, не истек ли срок действия контекста (7 дней)
-        if chat_contexts[chat_id].is_expired():
-            logger.info(f"[handle_client_message] Контекст для chat {chat_id} истек, создаем новый")
-            chat_contexts[chat_id] = ChatContext(chat_id)
-
-    context = chat_contexts[chat_id]
+    # Получаем или создаем контекст для чата (с проверкой срока действия)
+    context = get_context(chat_id, check_expiry=True)
 
     # Проверяем, что сообщение не пустое
     if not message_text:
@@ -154,7 +206,7 @@ async def handle_client_message(chat_id: str, message_text: str):
     # Передаём сообщение в наш новый единый агент
     try:
         # run_unified_agent теперь сам обрабатывает диалог и возвращает готовый текст ответа
-        bot_reply = await run_unified_agent(context, message_text, openai_client)
+        bot_reply = await run_unified_agent(context, message_text, get_openai_client())
 
         # Мы отправляем сообщение только если bot_reply не пустой (т.е. '')
         # Это позволяет игнорировать сообщения, которые должен обрабатывать другой бот
@@ -166,57 +218,46 @@ async def handle_client_message(chat_id: str, message_text: str):
         await send_message(chat_id, "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, повторите или введите /start для перезапуска диалога.")
 
 
-async def handle_client_image(chat_id: str, image_url: str):
+async def describe_client_image(chat_id: str, image_url: str) -> Optional[str]:
     """
-    Обрабатывает фотографию от клиента.
-    Анализирует изображение и передает результат агенту.
+    Загружает и анализирует одну фотографию клиента.
+    Возвращает "внутреннее" сообщение для агента или None, если фото обработать не удалось
+    (в этом случае клиенту уже отправлено сообщение об ошибке).
     """
-    # Получаем или создаем контекст для чата
-    if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = ChatContext(chat_id)
-        logger.info(f"[handle_client_image] Создан новый контекст для chat {chat_id}")
-    else:
-        # Проверяем, не истек ли срок действия контекста (7 дней)
-        if chat_contexts[chat_id].is_expired():
-            logger.info(f"[handle_client_image] Контекст для chat {chat_id} истек, создаем новый")
-            chat_contexts[chat_id] = ChatContext(chat_id)
-    
-    context = chat_contexts[chat_id]
-
     try:
         # Проверка, что image_url не None или пустая строка
         if not image_url:
-            logger.error(f"[handle_client_image] Получен пустой image_url для chat {chat_id}")
+            logger.error(f"[describe_client_image] Получен пустой image_url для chat {chat_id}")
             await send_message(chat_id, "Извините, не удалось получить изображение. Попробуйте отправить его снова.")
-            return
+            return None
             
-        logger.info(f"[handle_client_image] Получено изображение для chat {chat_id}: {image_url}")
+        logger.info(f"[describe_client_image] Получено изображение для chat {chat_id}: {image_url}")
         resp = await async_get(image_url)
         if resp is None:
-            logger.error(f"[handle_client_image] async_get вернул None для {image_url}")
+            logger.error(f"[describe_client_image] async_get вернул None для {image_url}")
             await send_message(chat_id, "Извините, не удалось загрузить фотографию. Попробуйте отправить её снова.")
-            return
+            return None
             
-        if resp.status_code != 200:
-            logger.error(f"[handle_client_image] Не удалось получить картинку: {resp.status_code}")
+        if resp.status != 200:
+            logger.error(f"[describe_client_image] Не удалось получить картинку: {resp.status}")
             await send_message(chat_id, "Извините, что-то пошло не так при загрузке фотографии. Не могли бы вы отправить её ещё раз? Если проблема повторится, попробуйте сделать новое фото.")
-            return
+            return None
 
-        # Проверка, что resp.content не None
-        if not resp.content:
-            logger.error(f"[handle_client_image] Пустой resp.content для {image_url}")
+        # Проверка, что тело ответа не пустое
+        image_bytes = await resp.read()
+        if not image_bytes:
+            logger.error(f"[describe_client_image] Пустое тело ответа для {image_url}")
             await send_message(chat_id, "Извините, полученное изображение оказалось пустым. Не могли бы вы отправить его ещё раз?")
-            return
-            
-        image_bytes = resp.content
+            return None
+
         # Анализируем фото
         result = await analyze_image(image_bytes)
         
         # Проверка, что result не None
         if result is None:
-            logger.error(f"[handle_client_image] analyze_image вернул None для chat {chat_id}")
+            logger.error(f"[describe_client_image] analyze_image вернул None для chat {chat_id}")
             await send_message(chat_id, "Извините, не удалось проанализировать изображение. Попробуйте отправить другое фото.")
-            return
+            return None
         
         # Формируем сообщение для агента на основе анализа
         if result.get("is_plant"):
@@ -224,58 +265,104 @@ async def handle_client_image(chat_id: str, image_url: str):
             description = result.get("description", "")
             # Формируем "внутреннее" сообщение для агента о том, что пришло фото
             internal_message = f"Пользователь прислал фото растения: {plant_name}. {description}"
-            logger.info(f"[handle_client_image] Растение опознано: {plant_name}. Передаем агенту: '{internal_message}'")
+            logger.info(f"[describe_client_image] Растение опознано: {plant_name}. Передаем агенту: '{internal_message}'")
         else:
             description = result.get("description", "").strip()
             if description:
                 internal_message = f"Пользователь прислал фото, но это похоже не растение. Описание: {description}"
             else:
                 internal_message = "Пользователь прислал фото, но распознать его не удалось."
-            logger.info(f"[handle_client_image] Растение не опознано. Передаем агенту: '{internal_message}'")
+            logger.info(f"[describe_client_image] Растение не опознано. Передаем агенту: '{internal_message}'")
+        return internal_message
+
+    except Exception as e:
+        logger.error(f"[describe_client_image] Ошибка для chat {chat_id}: {e}", exc_info=True)
+        await send_message(chat_id, "Прошу прощения, возникли технические сложности при обработке фото. Попробуйте отправить его ещё раз.")
+        return None
+
+
+async def handle_client_images(chat_id: str, image_urls: Iterable[str]):
+    """
+    Обрабатывает фотографии от клиента, пришедшие одной пачкой.
+    Фото загружаются и анализируются параллельно, а агент вызывается один раз на все описания.
+    """
+    # Получаем или создаем контекст для чата (с проверкой срока действия)
+    context = get_context(chat_id, check_expiry=True)
+
+    try:
+        descriptions = await asyncio.gather(*(describe_client_image(chat_id, url) for url in image_urls))
+        internal_message = "\n".join(d for d in descriptions if d)
+        if not internal_message:
+            return
 
         # Передаём внутреннее сообщение в единый агент
         try:
-            bot_reply = await run_unified_agent(context, internal_message, openai_client)
+            bot_reply = await run_unified_agent(context, internal_message, get_openai_client())
             
             if bot_reply is None:
-                logger.error(f"[handle_client_image] bot_reply=None после обработки фото для chat {chat_id}")
+                logger.error(f"[handle_client_images] bot_reply=None после обработки фото для chat {chat_id}")
                 bot_reply = "Извините, произошла техническая ошибка после анализа фото. Пожалуйста, повторите запрос."
                 
             await send_message(chat_id, bot_reply)
         except Exception as agent_e:
-            logger.error(f"[handle_client_image] Ошибка при вызове run_unified_agent для chat {chat_id} после фото: {agent_e}", exc_info=True)
+            logger.error(f"[handle_client_images] Ошибка при вызове run_unified_agent для chat {chat_id} после фото: {agent_e}", exc_info=True)
             await send_message(chat_id, "Извините, произошла ошибка при обработке вашего фото. Пожалуйста, попробуйте еще раз.")
 
     except Exception as e:
-        # Логируем основную ошибку handle_client_image
-        logger.error(f"[handle_client_image] Глобальная ошибка для chat {chat_id}: {e}", exc_info=True)
+        # Логируем основную ошибку handle_client_images
+        logger.error(f"[handle_client_images] Глобальная ошибка для chat {chat_id}: {e}", exc_info=True)
         await send_message(chat_id, "Прошу прощения, возникли технические сложности при обработке фото. Попробуйте отправить его ещё раз.")
 
 
+def _prepare_image(image_content: bytes) -> str:
+    """
+    Уменьшает фото и перекодирует его в JPEG, возвращает base64-строку.
+    Работа чисто вычислительная, поэтому вызывается в отдельном потоке.
+    """
+    # Pillow нужен только для фото, поэтому импортируем его здесь, а не при старте
+    from PIL import Image
+    from io import BytesIO
+
+    # Открываем изображение
+    img = Image.open(BytesIO(image_content))
+
+    # При необходимости уменьшаем размер (thumbnail сам сохраняет пропорции)
+    max_side = 1024
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+        logger.info(f"[analyze_image] Изображение уменьшено до: {img.width}x{img.height}")
+
+    # JPEG не поддерживает прозрачность и палитры
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    # Сохраняем в буфер как JPEG; для распознавания хватает качества 85 без доп. оптимизации
+    buf = BytesIO()
+    img.save(buf, format='JPEG', quality=85)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+# Результаты анализа фото по SHA-256 содержимого: повторно присланное фото не анализируем заново
+IMAGE_ANALYSIS_CACHE_SIZE = 256
+_image_analysis_cache: OrderedDict[bytes, dict] = OrderedDict()
+
+
 async def analyze_image(image_content: bytes) -> dict:
     """
     Анализирует изображение для определения растения.
     Использует Vision модель для распознавания и описания в естественном стиле.
     """
+    image_hash = hashlib.sha256(image_content).digest()
+    cached = _image_analysis_cache.get(image_hash)
+    if cached is not None:
+        _image_analysis_cache.move_to_end(image_hash)
+        logger.info("[analyze_image] Фото уже анализировалось, берём результат из кэша")
+        return cached
+
     try:
-        # Открываем изображение
-        img = Image.open(BytesIO(image_content))
-
-        # При необходимости уменьшаем размер
-        width, height = img.size
-        max_side = 1024
-        if max(width, height) > max_side:
-            scale = max_side / float(max(width, height))
-            new_w = int(width * scale)
-            new_h = int(height * scale)
-            img = img.resize((new_w, new_h))
-            logger.info(f"[analyze_image] Изображение уменьшено до: {new_w}x{new_h}")
-
-        # Сохраняем в буфер как JPEG
-        buf = BytesIO()
-        img.save(buf, format='JPEG')
-        buf.seek(0)
-        encoded_image = base64.b64encode(buf.read()).decode("utf-8")
+        # Декодирование и сжатие фото не должны блокировать event-loop
+        # run_in_executor вместо to_thread: копировать contextvars для чистой функции незачем
+        encoded_image = await main_event_loop.run_in_executor(None, _prepare_image, image_content)
 
         # Улучшенный промпт для более естественного описания
         prompt_content = [
@@ -301,7 +388,7 @@ async def analyze_image(image_content: bytes) -> dict:
         ]
 
         # Вызываем Vision-модель
-        response = await openai_client.chat.completions.create(
+        response = await get_openai_client().chat.completions.create(
             model=VISION_MODEL,
             messages=[
                 {
@@ -310,7 +397,7 @@ async def analyze_image(image_content: bytes) -> dict:
                         "Ты - опытный флорист-консультант магазина TropicHouse. "
                         "Твоя задача - помочь определить растение на фото и дать полезные рекомендации. "
                         "Используй дружелюбный, профессиональный тон. Отвечай как живой консультант, "
-                        "но строго в формате JSON."
+                        "но строго в формате JSON: верни один JSON-объект."
                     )
                 },
                 {
@@ -318,54 +405,38 @@ async def analyze_image(image_content: bytes) -> dict:
                     "content": prompt_content
                 }
             ],
-            temperature=0.3
+            temperature=0.3,
+            # JSON-режим: модель гарантированно возвращает разбираемый объект без markdown-обёрток
+            response_format={"type": "json_object"}
         )
 
         raw_answer = response.choices[0].message.content.strip()
         logger.info(f"[analyze_image] Модель вернула:\n{raw_answer}")
 
-        try:
-            # Удаляем маркеры кода, если они присутствуют
-            cleaned_answer = raw_answer
-            if cleaned_answer.startswith("```json"):
-                cleaned_answer = cleaned_answer[7:]
-            if cleaned_answer.startswith("```"):
-                cleaned_answer = cleaned_answer[3:]
-            if cleaned_answer.endswith("```"):
-                cleaned_answer = cleaned_answer[:-3]
+        result = orjson.loads(raw_answer)
+
+        # Проверяем и дополняем обязательные поля
+        if not isinstance(result.get("is_plant"), bool):
+            logger.warning("[analyze_image] Некорректный формат is_plant в ответе модели")
+            result["is_plant"] = False
             
-            cleaned_answer = cleaned_answer.strip()
-            result = json.loads(cleaned_answer)
+        if not result.get("plant_name"):
+            result["plant_name"] = "Неизвестное растение"
             
-            # Проверяем и дополняем обязательные поля
-            if not isinstance(result.get("is_plant"), bool):
-                logger.warning("[analyze_image] Некорректный формат is_plant в ответе модели")
-                result["is_plant"] = False
-                
-            if not result.get("plant_name"):
-                result["plant_name"] = "Неизвестное растение"
-                
-            if not result.get("description"):
-                result["description"] = "Нет описания"
-                
-            if not isinstance(result.get("confidence"), (int, float)):
-                result["confidence"] = 0.0
-                
-            if result.get("is_plant") and not result.get("care_tips"):
-                result["care_tips"] = "Общие рекомендации: умеренный полив, хорошее освещение без прямых солнечных лучей"
-                
-            return result
+        if not result.get("description"):
+            result["description"] = "Нет описания"
             
-        except json.JSONDecodeError as e:
-            logger.error(f"[analyze_image] Ошибка парсинга JSON: {e}\nОтвет модели:\n{raw_answer}")
-            # Пытаемся извлечь информацию из текстового ответа
-            is_plant = "растение" in raw_answer.lower()
-            return {
-                "is_plant": is_plant,
-                "plant_name": "Неизвестное растение" if is_plant else None,
-                "description": raw_answer[:200],
-                "confidence": 0.3 if is_plant else 0.0,
-            }
+        if not isinstance(result.get("confidence"), (int, float)):
+            result["confidence"] = 0.0
+            
+        if result.get("is_plant") and not result.get("care_tips"):
+            result["care_tips"] = "Общие рекомендации: умеренный полив, хорошее освещение без прямых солнечных лучей"
+
+        # Кэшируем только успешный анализ, ошибки пусть повторяются
+        _image_analysis_cache[image_hash] = result
+        if len(_image_analysis_cache) > IMAGE_ANALYSIS_CACHE_SIZE:
+            _image_analysis_cache.popitem(last=False)
+        return result
 
     except Exception as e:
         logger.error(f"[analyze_image] Ошибка при анализе изображения: {e}")
@@ -381,6 +452,10 @@ async def analyze_image(image_content: bytes) -> dict:
 #   Функции отправки сообщений клиенту
 # --------------------------------------- #
 
+SEND_MESSAGE_URL = f"{API_URL}/messages"
+_SEND_MESSAGE_TEMPLATE = b'{"chat_id":%d,"type":"text","content":%s,"scope":"public"}'
+
+
 async def send_message(chat_id: str, message: str):
     """
     Отправка текстового сообщения пользователю через RetailCRM Bot API.
@@ -395,31 +470,26 @@ async def send_message(chat_id: str, message: str):
         logger.info(f"[send_message] Пустое сообщение для chat_id={chat_id}, пропускаем отправку")
         return
     
-    url = f"{API_URL}/messages"
-    data = {
-        "chat_id": int(chat_id),
-        "type": "text",
-        "content": message,
-        "scope": "public"
-    }
+    # Форма тела постоянная: подставляем chat_id и экранированный orjson текст в готовый шаблон
+    body = _SEND_MESSAGE_TEMPLATE % (int(chat_id), orjson.dumps(message))
     try:
         # Используем безопасное логирование
         log_msg = message[:50] if message else "None"
         logger.info(f"[send_message] -> chat {chat_id}: {log_msg}")
         
-        # Отправляем JSON без экранирования кириллицы
-        resp = await async_post(url, headers=HEADERS, data=json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        resp = await async_post(SEND_MESSAGE_URL, headers=_api_headers(), data=body)
         if resp is None:
             logger.error("[send_message] Ошибка: async_post вернул None")
             return
             
-        if resp.status_code not in (200, 201):
-            logger.error(f"[send_message] Ошибка: {resp.status_code}, {resp.text}")
+        if resp.status not in (200, 201):
+            logger.error(f"[send_message] Ошибка: {resp.status}, {await resp.text()}")
         else:
-            # Добавляем проверку, что resp.content не None перед вызовом json()
+            # Добавляем проверку, что тело ответа не пустое перед разбором JSON
             try:
-                if resp.content:
-                    json_response = resp.json()
+                body = await resp.read()
+                if body:
+                    json_response = orjson.loads(body)
                     if json_response:
                         logger.info(f"[send_message] Отправлено, message_id={json_response.get('message_id')}")
                     else:
@@ -436,50 +506,96 @@ async def send_message(chat_id: str, message: str):
 #   Callbacks WebSocket для RetailCRM
 # --------------------------------------- #
 
-def dialog_assigned(dialog_id: int) -> bool:
-    """Проверяет, назначен ли диалог менеджеру"""
-    try:
-        # Пробуем получить информацию о чате
-        url = f"{API_URL}/dialogs"
-        params = {"id": dialog_id}
-        resp = requests.get(url, headers=HEADERS, params=params, timeout=10)
-        
-        if resp.status_code == 404:
-            logger.info(f"[dialog_assigned] Чат {dialog_id} не найден, считаем неназначенным")
-            return False
-            
-        resp.raise_for_status()
-        data = resp.json()
-        
-        # API может возвращать список или словарь
-        if isinstance(data, list):
-            # Если список, ищем диалог с нужным ID
-            for dialog in data:
-                if isinstance(dialog, dict) and dialog.get('id') == dialog_id:
-                    assigned = dialog.get('is_assigned')
-                    if assigned:
-                        logger.info(f"Диалог {dialog_id} уже назначен менеджеру")
-                        return True
-            logger.info(f"Диалог {dialog_id} не найден в списке или не назначен")
-            return False
-        else:
-            logger.warning(f"[dialog_assigned] Неожиданный тип данных от API: {type(data)}")
-            return False
+DIALOG_ASSIGNED_TTL = 30.0        # секунд
+DIALOG_ASSIGNED_CACHE_MAX = 1024  # при превышении выбрасываем устаревшие записи
+_dialog_assigned_cache: Dict[Any, Tuple[float, bool]] = {}
+
+
+async def _fetch_dialog_assigned(dialog_id: int) -> bool:
+    """Запрашивает у Bot API, назначен ли диалог менеджеру. Ошибки пробрасывает."""
+    # Пробуем получить информацию о чате
+    url = f"{API_URL}/dialogs"
+    params = {"id": dialog_id}
+    resp = await async_get(url, headers=_api_headers(), params=params, timeout=aiohttp.ClientTimeout(total=10))
+    
+    if resp.status == 404:
+        logger.info(f"[dialog_assigned] Чат {dialog_id} не найден, считаем неназначенным")
+        return False
         
+    resp.raise_for_status()
+    data = orjson.loads(await resp.read())
+    
+    # API может возвращать список или словарь
+    if isinstance(data, list):
+        # Если список, ищем диалог с нужным ID
+        for dialog in data:
+            if isinstance(dialog, dict) and dialog.get('id') == dialog_id:
+                assigned = dialog.get('is_assigned')
+                if assigned:
+                    logger.info(f"Диалог {dialog_id} уже назначен менеджеру")
+                    return True
+        logger.info(f"Диалог {dialog_id} не найден в списке или не назначен")
+        return False
+    else:
+        logger.warning(f"[dialog_assigned] Неожиданный тип данных от API: {type(data)}")
+        return False
+
+
+async def dialog_assigned(dialog_id: Optional[int]) -> bool:
+    """Проверяет, назначен ли диалог менеджеру (ответ API кэшируется на DIALOG_ASSIGNED_TTL)"""
+    # Кадр без dialog.id: проверять нечего (aiohttp не принимает None в параметрах запроса),
+    # считаем неназначенным, как и раньше, без запроса и ошибки в логе
+    if dialog_id is None:
+        return False
+
+    now_ts = time.monotonic()
+    cached = _dialog_assigned_cache.get(dialog_id)
+    if cached and now_ts - cached[0] < DIALOG_ASSIGNED_TTL:
+        return cached[1]
+
+    try:
+        assigned = await _fetch_dialog_assigned(dialog_id)
     except Exception as e:
         logger.error(f"[dialog_assigned] Ошибка при проверке диалога {dialog_id}: {e}")
-        # В случае ошибки считаем диалог неназначенным, чтобы бот мог отвечать
+        # В случае ошибки считаем диалог неназначенным, чтобы бот мог отвечать (и не кэшируем)
         return False
 
+    if len(_dialog_assigned_cache) >= DIALOG_ASSIGNED_CACHE_MAX:
+        for stale_id in [d for d, (ts, _) in _dialog_assigned_cache.items() if now_ts - ts >= DIALOG_ASSIGNED_TTL]:
+            del _dialog_assigned_cache[stale_id]
+    _dialog_assigned_cache[dialog_id] = (now_ts, assigned)
+    return assigned
+
+
+# Подстрока, без которой кадр точно не является событием message_new
+_MESSAGE_NEW_MARKER = '"message_new"'
+_MESSAGE_NEW_MARKER_BYTES = _MESSAGE_NEW_MARKER.encode()
+
 
-def on_message(ws, message):
+class IncomingMessage(NamedTuple):
+    """Разобранное входящее сообщение из WebSocket, которое передаётся в handle_incoming."""
+    chat_id: Any
+    dialog_id: Any
+    sender_type: str
+    channel_id: Any = None
+    channel_name: str = ""
+    user_id: Any = None
+    user_name: str = "Неизвестный пользователь"
+    text: Optional[str] = None
+    image_url: Optional[str] = None
+
+
+def on_message(message):
     """
-    Вызывается при входящем сообщении по WebSocket.
-    Парсим JSON, ищем текст/фото от клиента и кладём в очередь message_queue.
+    Вызывается при входящем сообщении по WebSocket прямо в event-loop.
+    Парсим JSON, ищем текст/фото и сразу передаём сообщение в handle_incoming:
+    промежуточной очереди нет, сообщение попадает прямо в буфер своего чата.
     """
-    global main_event_loop
+    # Кадры других событий (пинги, обновления и т.п.) отбрасываем до разбора JSON
+    if (_MESSAGE_NEW_MARKER_BYTES if isinstance(message, bytes) else _MESSAGE_NEW_MARKER) not in message:
+        return
     try:
-        data = json.loads(message)
+        data = orjson.loads(message)
         if data.get("type") == "message_new":
             message_data = data.get("data", {}).get("message", {})
             chat_id = message_data.get("chat_id")
@@ -500,7 +616,7 @@ def on_message(ws, message):
                 is_target_channel = False
                 
             if not is_target_channel:
-                logger.info(f"[on_message] Сообщение из другого канала ({channel_name}), игнорируем")
+                logger.info("[on_message] Сообщение из другого канала (%s), игнорируем", channel_name)
                 return
 
             from_data = message_data.get("from", {})
@@ -510,322 +626,326 @@ def on_message(ws, message):
 
             # Обрабатываем только сообщения от клиента
             if sender_type == "customer":
-                # Проверяем, не назначен ли диалог уже менеджеру
-                if dialog_assigned(dialog_id):
-                    logger.info(f"[on_message] Диалог {chat_id} уже назначен менеджеру, переводим в MANAGER_CALLED")
-                    # Создаем или обновляем контекст чата
-                    if chat_id not in chat_contexts:
-                        chat_contexts[chat_id] = ChatContext(chat_id)
-                    
-                    context = chat_contexts[chat_id]
-                    context.dialog_id = dialog_id
-                    context.change_state(DialogState.MANAGER_CALLED)
-                    return
-                
-                # Создаем или обновляем контекст чата
-                if chat_id not in chat_contexts:
-                    chat_contexts[chat_id] = ChatContext(chat_id)
-                
-                context = chat_contexts[chat_id]
-                context.dialog_id = dialog_id # Устанавливаем dialog_id в контексте
-                
-                # Сохраняем информацию о канале
-                context.channel_info = {
-                    "id": channel_id,
-                    "name": channel_name
-                }
-                
-                # Сохраняем информацию о пользователе
-                context.user_info = {
-                    "id": from_data.get("id"),
-                    "name": from_data.get("name", "Неизвестный пользователь")
-                }
-                
+                message_text = None
+                img_url = None
                 if incoming_type == "text":
                     message_text = content.get("text") if isinstance(content, dict) else str(content) if content else None
                     if message_text and message_text.strip():
-                        logger.info(f"[on_message] Текст от клиента: {message_text}")
-                        if main_event_loop:
-                            asyncio.run_coroutine_threadsafe(message_queue.put((chat_id, message_text)), main_event_loop)
+                        logger.info("[on_message] Текст от клиента: %s", message_text)
                     else:
-                        logger.warning(f"[on_message] Получено пустое текстовое сообщение для chat {chat_id}")
+                        logger.warning("[on_message] Получено пустое текстовое сообщение для chat %s", chat_id)
+                        message_text = None
                 elif incoming_type == "image":
                     items = message_data.get("items", [])
                     if items and isinstance(items, list):
                         first_item = items[0]
                         if isinstance(first_item, dict) and first_item.get("kind") == "image":
                             img_url = first_item.get("preview_url")
-                            if img_url and main_event_loop:
-                                logger.info(f"[on_message] Изображение от клиента: {img_url}")
-                                asyncio.run_coroutine_threadsafe(message_queue.put((chat_id, None, img_url)), main_event_loop)
+                            if img_url:
+                                logger.info("[on_message] Изображение от клиента: %s", img_url)
+
+                incoming = IncomingMessage(
+                    chat_id, dialog_id, sender_type,
+                    channel_id=channel_id,
+                    channel_name=channel_name,
+                    user_id=from_data.get("id"),
+                    user_name=from_data.get("name", "Неизвестный пользователь"),
+                    text=message_text,
+                    image_url=img_url or None,
+                )
             elif sender_type in ["manager", "user"]:
-                # Сообщения от менеджеров - переводим диалог в режим MANAGER_CALLED
-                logger.info(f"[on_message] Сообщение от менеджера ({sender_type}), переводим в режим MANAGER_CALLED")
-                
-                # Создаем или обновляем контекст чата
-                if chat_id not in chat_contexts:
-                    chat_contexts[chat_id] = ChatContext(chat_id)
-                
-                context = chat_contexts[chat_id]
-                context.dialog_id = dialog_id
-                
-                # Переводим в состояние MANAGER_CALLED
-                context.change_state(DialogState.MANAGER_CALLED)
+                incoming = IncomingMessage(chat_id, dialog_id, sender_type)
             else:
                 # Неизвестный тип отправителя - логируем и игнорируем
-                logger.warning(f"[on_message] Неизвестный тип отправителя: {sender_type}, игнорируем сообщение для chat {chat_id}")
+                logger.warning("[on_message] Неизвестный тип отправителя: %s, игнорируем сообщение для chat %s", sender_type, chat_id)
+                return
 
-    except json.JSONDecodeError:
-        logger.error(f"[on_message] JSONDecodeError: {message}")
+            handle_incoming(incoming)
+
+    except orjson.JSONDecodeError:
+        logger.error("[on_message] JSONDecodeError: %s", message)
     except Exception as e:
-        logger.error(f"[on_message] Ошибка: {e}")
+        logger.error("[on_message] Ошибка: %s", e)
 
 
-def on_error(ws, error):
-    logger.error(f"WebSocket ошибка: {error}")
-    if "403 Forbidden" in str(error):
-        logger.error("Ошибка авторизации токена бота (403).")
+def handle_incoming(incoming: IncomingMessage):
+    """
+    Обновляет контекст чата по входящему сообщению и складывает сообщения клиента
+    в PendingMessages чата, (пере)запуская таймер обработки. Выполняется в event-loop.
+    Назначен ли диалог менеджеру, проверяется один раз на пачку в process_user_messages.
+    """
+    chat_id = incoming.chat_id
+    context = get_context(chat_id)
+    context.dialog_id = incoming.dialog_id # Устанавливаем dialog_id в контексте
+
+    if incoming.sender_type != "customer":
+        # Сообщения от менеджеров - переводим диалог в режим MANAGER_CALLED
+        logger.info("[handle_incoming] Сообщение от менеджера (%s), переводим в режим MANAGER_CALLED", incoming.sender_type)
+        context.change_state(DialogState.MANAGER_CALLED)
+        return
+
+    # Сохраняем информацию о канале
+    context.channel_info = {
+        "id": incoming.channel_id,
+        "name": incoming.channel_name
+    }
+
+    # Сохраняем информацию о пользователе
+    context.user_info = {
+        "id": incoming.user_id,
+        "name": incoming.user_name
+    }
 
+    text, image_url = incoming.text, incoming.image_url
+    if not (text or image_url):
+        return
+
+    pending = pending_chats.get(chat_id)
+    if pending is None:
+        pending = pending_chats[chat_id] = PendingMessages()
 
-def on_close(ws, close_status_code, close_msg):
-    logger.warning(f"WebSocket закрыт: {close_status_code} - {close_msg}")
+    # Добавляем сообщение в буфер своего типа
+    if image_url:
+        pending.images.append(image_url)
+        logger.info("[handle_incoming] Добавлено изображение для chat_id %s: %s", chat_id, image_url)
+    else:
+        pending.texts.append(text)
+        logger.info("[handle_incoming] Добавлено текстовое сообщение для chat_id %s: %.50s", chat_id, text)
+
+    # Пока предыдущая пачка обрабатывается, новые сообщения ждут: их запланирует process_user_messages
+    if pending.task is None:
+        schedule_user_messages(chat_id, pending)
+        logger.info("[handle_incoming] Запущен таймер для chat_id %s", chat_id)
+    else:
+        logger.info("[handle_incoming] Сообщение ждёт окончания обработки для chat_id %s", chat_id)
 
 
-def on_open(ws):
-    logger.info("[on_open] WebSocket соединение установлено")
-    ws.reconnect_attempts = 0
-    ws.reconnect_delay = RECONNECT_DELAY
+def on_error(error):
+    logger.error(f"WebSocket ошибка: {error}")
+    if "403" in str(error):
+        logger.error("Ошибка авторизации токена бота (403).")
 
 
 # --------------------------------------- #
 #   Функции для запуска и переподключения
 # --------------------------------------- #
 
-def create_websocket():
-    """
-    Создаёт WebSocketApp для RetailCRM и возвращает его. 
-    """
-    ws_url = f"{API_URL.replace('https://', 'wss://')}/ws?events=message_new"
-    ws = websocket.WebSocketApp(
-        ws_url,
-        header=["X-Bot-Token: " + TOKEN],
-        on_message=on_message,
-        on_error=on_error,
-        on_close=on_close,
-        on_open=on_open
-    )
-    ws.reconnect_attempts = 0
-    ws.reconnect_delay = RECONNECT_DELAY
-    return ws
+WS_URL = f"{API_URL.replace('https://', 'wss://')}/ws?events=message_new"
 
 
-def run_with_reconnect(ws):
+async def run_with_reconnect():
     """
-    Запускает ws.run_forever в цикле, чтобы при обрыве связи
-    повторно подключаться (до MAX_RECONNECT_ATTEMPTS).
+    Держит WebSocket-соединение с RetailCRM в event-loop и при обрыве связи
+    повторно подключается (до MAX_RECONNECT_ATTEMPTS) с растущей задержкой.
+    Счётчик попыток сбрасывается после каждого успешного подключения.
     """
-    while True:
-        if ws.reconnect_attempts >= MAX_RECONNECT_ATTEMPTS:
-            logger.error(f"Достигнуто макс. число попыток переподключения: {MAX_RECONNECT_ATTEMPTS}")
-            break
-
-        if ws.reconnect_attempts > 0:
-            logger.info(f"Переподключение {ws.reconnect_attempts}/{MAX_RECONNECT_ATTEMPTS}...")
+    reconnect_attempts = 0
+    reconnect_delay = RECONNECT_DELAY
+    while reconnect_attempts < MAX_RECONNECT_ATTEMPTS:
+        if reconnect_attempts > 0:
+            logger.info(f"Переподключение {reconnect_attempts}/{MAX_RECONNECT_ATTEMPTS}...")
         else:
             logger.info("Старт WebSocket...")
 
         try:
-            ws.run_forever(ping_interval=30, ping_timeout=10)
-        except Exception as e:
-            logger.error(f"Ошибка в ws.run_forever: {e}")
-
-        current_attempts = ws.reconnect_attempts + 1
-        current_delay = min(ws.reconnect_delay * 2, MAX_RECONNECT_DELAY)
-        logger.info(f"Следующая попытка переподключения через {current_delay} с...")
-
-        time.sleep(current_delay)
-
-        ws_new = create_websocket()
-        ws_new.reconnect_attempts = current_attempts
-        ws_new.reconnect_delay = current_delay
-        ws = ws_new
-
-
-def check_connection_status(ws):
+            # heartbeat: ping каждые 30 с, без pong соединение считается разорванным
+            async with http_session.ws_connect(WS_URL, headers={"X-Bot-Token": config.RETAIL_CRM_BOT_TOKEN}, heartbeat=30) as ws:
+                logger.info("[on_open] WebSocket соединение установлено")
+                reconnect_attempts = 0
+                reconnect_delay = RECONNECT_DELAY
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        on_message(msg.data)
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        on_error(ws.exception())
+                        break
+            logger.warning(f"WebSocket закрыт: {ws.close_code}")
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            # Переподключаемся только при сетевых ошибках; прочие исключения - баг, пусть всплывают
+            on_error(e)
+
+        reconnect_attempts += 1
+        reconnect_delay = min(reconnect_delay * 2, MAX_RECONNECT_DELAY)
+        logger.info(f"Следующая попытка переподключения через {reconnect_delay} с...")
+        await asyncio.sleep(reconnect_delay)
+
+    logger.error(f"Достигнуто макс. число попыток переподключения: {MAX_RECONNECT_ATTEMPTS}")
+    # Без WebSocket бот глухой: завершаем процесс, чтобы его перезапустили
+    raise ConnectionError("WebSocket RetailCRM недоступен")
+
+
+async def check_connection_status():
     """
     Периодически проверяет, работает ли Bot API (GET /bots).
     """
     while True:
         try:
-            test_req = requests.get(f"{API_URL}/bots", headers=HEADERS)
-            if test_req.status_code == 200:
+            test_req = await async_get(f"{API_URL}/bots", headers=_api_headers(), timeout=aiohttp.ClientTimeout(total=10))
+            if test_req.status == 200:
                 logger.debug("[check_connection_status] API доступен.")
             else:
-                logger.warning(f"[check_connection_status] API вернул {test_req.status_code}")
+                logger.warning(f"[check_connection_status] API вернул {test_req.status}")
         except Exception as e:
             logger.warning(f"Ошибка check_connection_status: {e}")
-        time.sleep(300)  # раз в 5 минут
+        await asyncio.sleep(300)  # раз в 5 минут
 
 
 # --------------------------------------- #
 #    Фоновая корутина обработки очереди
 # --------------------------------------- #
 
-async def process_user_messages(chat_id: str):
+async def process_user_messages(chat_id: str, pending: PendingMessages):
     """
-    Обрабатывает сообщения пользователя после задержки.
+    Обрабатывает сообщения пользователя после задержки (запускается по таймеру из schedule_user_messages).
     Объединяет все сообщения, полученные в течение MESSAGE_DELAY секунд.
     """
     try:
-        # Ждем указанное время
-        logger.info(f"[process_user_messages] Ожидание {MESSAGE_DELAY} секунд для chat_id {chat_id}")
-        await asyncio.sleep(MESSAGE_DELAY)
-        
-        # Получаем все сообщения пользователя
-        messages = user_messages.get(chat_id, [])
-        if not messages:
-            logger.info(f"[process_user_messages] Нет сообщений для chat_id {chat_id}")
+        # Забираем накопленные сообщения; пришедшие во время обработки попадут в новые буферы
+        text_messages, image_messages = pending.texts, pending.images
+        pending.texts, pending.images = [], deque()
+        if not text_messages and not image_messages:
+            logger.info("[process_user_messages] Нет сообщений для chat_id %s", chat_id)
+            return
+
+        # Проверяем, не назначен ли диалог уже менеджеру (один запрос на всю пачку)
+        context = get_context(chat_id)
+        if await dialog_assigned(context.dialog_id):
+            logger.info("[process_user_messages] Диалог %s уже назначен менеджеру, переводим в MANAGER_CALLED", chat_id)
+            context.change_state(DialogState.MANAGER_CALLED)
             return
-            
-        logger.info(f"[process_user_messages] Обработка {len(messages)} сообщений для chat_id {chat_id}")
-        
-        # Очищаем сообщения пользователя
-        user_messages[chat_id] = []
-        
-        # Разделяем сообщения на текстовые и изображения
-        text_messages = []
-        image_messages = []
-        
-        for text, image_url in messages:
-            if image_url:
-                image_messages.append(image_url)
-            elif text:
-                text_messages.append(text)
         
-        # Обрабатываем изображения
-        for image_url in image_messages:
-            logger.info(f"[process_user_messages] Обработка изображения для chat_id {chat_id}: {image_url}")
-            await handle_client_image(chat_id, image_url)
+        # Обрабатываем изображения: все фото пачки анализируются параллельно, агент вызывается один раз
+        if image_messages:
+            logger.info("[process_user_messages] Обработка %s изображений для chat_id %s", len(image_messages), chat_id)
+            await handle_client_images(chat_id, image_messages)
         
         # Объединяем текстовые сообщения и обрабатываем их
         if text_messages:
             combined_text = "\n".join(text_messages)
-            logger.info(f"[process_user_messages] Обработка {len(text_messages)} текстовых сообщений для chat_id {chat_id}")
+            logger.info("[process_user_messages] Обработка %s текстовых сообщений для chat_id %s", len(text_messages), chat_id)
             await handle_client_message(chat_id, combined_text)
                 
     except Exception as e:
-        logger.error(f"[process_user_messages] Ошибка: {e}")
+        logger.error("[process_user_messages] Ошибка: %s", e)
     finally:
-        # Удаляем таймер пользователя
-        if chat_id in user_timers:
-            del user_timers[chat_id]
-            logger.info(f"[process_user_messages] Таймер удален для chat_id {chat_id}")
+        pending.task = None
+        # Сообщения, пришедшие во время обработки, ждут следующего срока
+        if pending.texts or pending.images:
+            schedule_user_messages(chat_id, pending)
+        else:
+            del pending_chats[chat_id]
+            logger.info("[process_user_messages] Обработка завершена для chat_id %s", chat_id)
 
 
-async def process_messages():
+def schedule_user_messages(chat_id: str, pending: PendingMessages):
     """
-    Берём задания из очереди message_queue и добавляем их в список сообщений пользователя.
-    Запускает таймер для обработки сообщений через MESSAGE_DELAY секунд.
+    (Пере)назначает обработку накопленных сообщений чата через MESSAGE_DELAY секунд.
+    Каждое новое сообщение сдвигает срок: на пачку сообщений - один таймер и одна задача.
+    Срок не уходит дальше MAX_MESSAGE_DELAY от первого сообщения пачки.
     """
-    while True:
-        item = await message_queue.get()
-        try:
-            chat_id = item[0]
-            
-            # Инициализируем список сообщений для пользователя, если его нет
-            if chat_id not in user_messages:
-                user_messages[chat_id] = []
-            
-            # Добавляем сообщение в список
-            if len(item) == 2:
-                text = item[1]
-                user_messages[chat_id].append((text, None))
-                logger.info(f"[process_messages] Добавлено текстовое сообщение для chat_id {chat_id}: {text[:50]}")
-            elif len(item) == 3:
-                image_url = item[2]
-                user_messages[chat_id].append((None, image_url))
-                logger.info(f"[process_messages] Добавлено изображение для chat_id {chat_id}: {image_url}")
-            
-            # Если у пользователя уже есть активный таймер, не создаем новый
-            if chat_id not in user_timers:
-                # Создаем новую задачу для обработки сообщений
-                user_timers[chat_id] = asyncio.create_task(process_user_messages(chat_id))
-                logger.info(f"[process_messages] Запущен таймер для chat_id {chat_id}, сообщений: {len(user_messages[chat_id])}")
-            else:
-                logger.info(f"[process_messages] Обновлен таймер для chat_id {chat_id}, сообщений: {len(user_messages[chat_id])}")
-            
-            message_queue.task_done()
-        except Exception as e:
-            logger.error(f"[process_messages] Ошибка: {e}")
-            await asyncio.sleep(1)
+    now = main_event_loop.time()
+    if pending.timer is None:
+        pending.first_at = now
+    else:
+        pending.timer.cancel()
+    deadline = min(now + MESSAGE_DELAY, pending.first_at + MAX_MESSAGE_DELAY)
+    pending.timer = main_event_loop.call_at(deadline, _flush_user_messages, chat_id, pending)
 
 
-# --------------------------------------- #
-#         Инициализация и запуск
-# --------------------------------------- #
+def _flush_user_messages(chat_id: str, pending: PendingMessages):
+    """Колбэк таймера: задача создаётся только сейчас, когда пачка сообщений собрана."""
+    pending.timer = None
+    pending.task = main_event_loop.create_task(process_user_messages(chat_id, pending))
+
+
+async def _sleep_until(deadline: float, interval: float) -> float:
+    """
+    Спит до срока deadline (по монотонным часам loop.time()) и возвращает следующий срок.
+    Период отсчитывается от сроков, а не от конца работы, поэтому время обновления
+    не накапливается; пропущенные из-за долгой работы сроки не догоняются.
+    """
+    await asyncio.sleep(max(0.0, deadline - main_event_loop.time()))
+    next_deadline = deadline + interval
+    now = main_event_loop.time()
+    if next_deadline <= now:
+        next_deadline += ((now - next_deadline) // interval + 1) * interval
+    return next_deadline
+
 
 async def start_bot():
     """
     Запускает всё окружение: инициализацию данных, подключение к WebSocket, фоновые задачи.
     """
     # Проверяем доступность бота
-    test_request = await async_get(f"{API_URL}/bots", headers=HEADERS)
-    if test_request.status_code == 403:
+    test_request = await async_get(f"{API_URL}/bots", headers=_api_headers())
+    if test_request.status == 403:
         logger.error("[start_bot] Ошибка авторизации: неверный токен бота.")
         return
 
-    # Пробуем инициализировать данные (загрузить эмбеддинги из pickle, либо обновить их)
+    # Пробуем инициализировать данные (загрузить сохранённые растения и эмбеддинги, либо обновить их)
     retry_attempts = 3
     for attempt in range(retry_attempts):
         try:
             logger.info(f"[start_bot] Инициализация данных #{attempt+1}...")
-            ok = await plant_utils.initialize_data(openai_client)
+            ok = await plant_utils.initialize_data(get_openai_client())
             if not ok:
                 logger.warning("Данные не проинициализировались, пробуем update_plant_data...")
-                await plant_utils.update_plant_data(openai_client)
+                await plant_utils.update_plant_data(get_openai_client())
             break
         except Exception as e:
             logger.error(f"[start_bot] Ошибка init данных: {e}")
             if attempt < (retry_attempts - 1):
-                logger.info("Повторим через 5 секунд...")
-                await asyncio.sleep(5)
+                # Экспоненциальная пауза со случайной добавкой: 1-2 с, 2-3 с, ... но не больше минуты
+                delay = min(INIT_RETRY_MAX_DELAY, 2 ** attempt + random.random())
+                logger.info(f"Повторим через {delay:.1f} с...")
+                await asyncio.sleep(delay)
             else:
                 logger.critical("Не удалось инициализировать данные после всех попыток.")
                 return
 
-    # Запускаем поток веб-сокета
-    ws = create_websocket()
-    thr_checker = Thread(target=check_connection_status, args=(ws,), daemon=True)
-    thr_checker.start()
-
-    ws_thread = Thread(target=run_with_reconnect, args=(ws,), daemon=True)
-    ws_thread.start()
-
-    # Запускаем корутину обработки очереди
-    asyncio.create_task(process_messages())
+    # Входящие сообщения разбирает on_message, обработку чатов планируют таймеры loop.call_later
 
     # Запускаем периодическую очистку устаревших контекстов (каждые 6 часов)
     async def periodic_cleanup():
+        next_fire = main_event_loop.time() + CONTEXT_CLEANUP_INTERVAL
         while True:
-            await asyncio.sleep(21600)  # 6 часов
+            next_fire = await _sleep_until(next_fire, CONTEXT_CLEANUP_INTERVAL)
             cleanup_expired_contexts()
-    
-    asyncio.create_task(periodic_cleanup())
 
-    # Периодически обновляем данные о растениях (например, раз в час)
-    while True:
-        await asyncio.sleep(3600)
-        await plant_utils.update_plant_data(openai_client)
+    # Периодически обновляем данные о растениях (раз в час)
+    async def periodic_plant_refresh():
+        next_fire = main_event_loop.time() + PLANT_DATA_REFRESH_INTERVAL
+        while True:
+            next_fire = await _sleep_until(next_fire, PLANT_DATA_REFRESH_INTERVAL)
+            await plant_utils.update_plant_data(get_openai_client())
+
+    # Фоновые задачи живут в одной группе: если одна падает, остальные отменяются
+    # и исключение выходит из start_bot, а не теряется в брошенной задаче
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(check_connection_status())
+        tg.create_task(run_with_reconnect())
+        tg.create_task(periodic_cleanup())
+        tg.create_task(periodic_plant_refresh())
 
 
 async def main():
     """
     Точка входа при запуске файла main.py напрямую.
     """
-    global main_event_loop
-    main_event_loop = asyncio.get_event_loop()
-    await start_bot()
+    global main_event_loop, http_session
+    main_event_loop = asyncio.get_running_loop()
+    http_session = create_http_session()
+    try:
+        await start_bot()
+    finally:
+        await http_session.close()
+        await plant_utils.close_http_client()
+        await telegrambot.close_http_client()
+        plant_utils.save_query_embedding_cache()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -1,18 +1,36 @@
 import asyncio
-import json
+import hashlib
 import logging
 import os
-import pickle
 import time
-import requests
 import re
+from collections import OrderedDict
 from datetime import datetime
 from typing import List, Dict, Any, Optional, Tuple, Union, NamedTuple
 import pandas as pd
 from io import BytesIO
 import numpy as np
+import orjson
+import httpx
 import string
 from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+
+try:
+    import python_calamine  # noqa: F401
+    # calamine (Rust) читает xlsx в разы быстрее openpyxl; пишем по-прежнему через openpyxl
+    EXCEL_READ_ENGINE: Optional[str] = "calamine"
+except ImportError:
+    EXCEL_READ_ENGINE = None  # движок по умолчанию (openpyxl)
+
+try:
+    # Левенштейн на C++ (bit-parallel); без него - чистый Python ниже
+    from rapidfuzz import process as fuzz_process
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    fuzz_process = None
+    Levenshtein = None
 
 import config
 
@@ -29,7 +47,9 @@ class Plant(NamedTuple):
     plant_type: Optional[str] = None
 
 # Константы
-EMBEDDINGS_FILE = "plants_embeddings.pkl"
+PLANTS_DATA_FILE = "plants_data.json"  # растения и метаданные обновления; эмбеддинги - в EMBEDDINGS_MATRIX_FILE
+EMBEDDINGS_MATRIX_FILE = "plants_embeddings.npy"  # матрица эмбеддингов, читается через mmap
+QUERY_EMBEDDINGS_FILE = "query_embeddings.npz"  # кэш эмбеддингов запросов между перезапусками
 PROCESSED_SHEET_FILE = "processed_sheet.xlsx"
 SHEET_ID = "1iaBpr26eWvLGjWftdHk2eCIPdezooENr"
 OUTPUT_FILE = "downloaded_spreadsheet.xlsx"
@@ -47,12 +67,77 @@ EMBEDDING_BATCH_PAUSE = 0.5
 EMBEDDING_DIM_DEFAULT = 1536
 VECTOR_SEARCH_SCORE_THRESHOLD = 0.5
 EMBEDDINGS_FILE_MAX_AGE = 3600  # 1 час в секундах
+QUERY_EMBEDDING_CACHE_SIZE = 4096  # Максимум эмбеддингов запросов в памяти
+# Поля, которые не входят в текст эмбеддинга растения: остаток меняется почти при каждом
+# обновлении, и из-за него пришлось бы заново эмбеддить весь каталог
+EMBEDDING_EXCLUDED_FIELDS = frozenset({"остаток (мойсклад)"})
 
 # Глобальные переменные для хранения данных о растениях
 plants_data: List[Dict[str, Any]] = []
-plants_embeddings: List[List[float]] = []
+# Эмбеддинги растений - непрерывная float32-матрица (строка на растение) с нормированными строками
+plants_embeddings: np.ndarray = np.zeros((0, EMBEDDING_DIM_DEFAULT), dtype=np.float32)
+# LRU-кэш эмбеддингов запросов: sha256 нормализованного текста -> вектор
+_query_embedding_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+# Запросы, эмбеддинг которых уже запрошен у OpenAI: одинаковые параллельные запросы ждут один ответ
+_query_embedding_inflight: Dict[bytes, "asyncio.Future[np.ndarray]"] = {}
+# Запросы, ждущие отправки одним батчем: (текст, ключ, future); отправляются на следующей итерации цикла
+_query_embedding_batch: List[Tuple[str, bytes, "asyncio.Future[np.ndarray]"]] = []
+_query_embedding_tasks: set = set()  # ссылки на задачи батчей, чтобы их не собрал GC
 latest_stock_file: Optional[str] = None
 
+class _PlantSearchEntry(NamedTuple):
+    """Текстовые поля растения, нормализованные один раз для search_plants_by_name."""
+    cleaned_name: str  # название без лишних символов (для точного совпадения)
+    search_text: str  # все текстовые поля в нижнем регистре через пробел
+    search_words: Tuple[str, ...]  # search_text, разбитый на слова (для нечеткого сопоставления)
+    base_name: str  # базовое имя без размера
+    base_words: Tuple[str, ...]
+
+# Поля растения, по которым идёт текстовый поиск, в порядке склейки search_text
+_SEARCH_TEXT_FIELDS = (
+    "name", "Растение", "Название", "Уход (список)", "article", "folder", "group",
+    "Кашпо/Горшок", "Освещение", "Полив", "Тег (Народное название)",
+)
+# Индекс для текстового поиска: строка на растение, параллельно plants_data.
+# Перестраивается при первом поиске после замены plants_data
+_search_index: List[_PlantSearchEntry] = []
+_search_index_source: Optional[List[Dict[str, Any]]] = None
+# Словарь уникальных слов всех растений и для каждого слова - номера растений, где оно встречается.
+# Нечеткое сопоставление считается один раз по словарю, а не по словам каждого растения
+_search_vocab: List[str] = []
+_search_postings: List[List[int]] = []
+# Очищенное название -> номера растений с таким названием (точное совпадение одним поиском в словаре)
+_search_exact_names: Dict[str, List[int]] = {}
+
+# Общий HTTP-клиент для МойСклад и Google Sheets: keep-alive пул и HTTP/2, создаётся при первом запросе
+HTTP_TIMEOUT = 30.0
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Отчёт об остатках МойСклад: размер страницы и число одновременных запросов страниц
+MOYSKLAD_STOCK_URL = 'https://api.moysklad.ru/api/remap/1.2/report/stock/all'
+MOYSKLAD_PAGE_SIZE = 1000
+MOYSKLAD_MAX_CONCURRENT_REQUESTS = 5  # МойСклад ограничивает число параллельных запросов с одного токена
+
+# Фрагменты вида [11111] (коды из МойСклад) в названиях и текстах таблицы
+_BRACKET_NUM_RE = re.compile(r'\[\d+\]')
+# Размер растения вида "12/40"
+_PLANT_SIZE_RE = re.compile(r'(\d+/\d+)')
+# Всё, кроме букв, цифр, пробелов, "-" и "/" (сравнение названий в search_plants_by_name)
+_NAME_JUNK_RE = re.compile(r'[^\w\s\-/]+')
+# Знаки препинания и пробельные последовательности для generate_symbolic_code
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
+# Таблица для удаления знаков препинания через str.translate
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+# Транслитерация кириллицы в латиницу для символьных кодов
+_TRANSLIT_TABLE = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+
 # Папки, содержащие растения в МойСклад
 PLANT_FOLDER_KEYWORDS = [
     "КОМНАТНЫЕ РАСТЕНИЯ",
@@ -60,7 +145,10 @@ PLANT_FOLDER_KEYWORDS = [
     "Для флорариума",
 
 ]
+# Все ключевые слова папок одним шаблоном: один проход по строке вместо any() по списку
+_PLANT_FOLDER_RE = re.compile("|".join(map(re.escape, PLANT_FOLDER_KEYWORDS)))
 
+@lru_cache(maxsize=4096)  # вызывается для каждого растения при каждом нечётком поиске
 def extract_plant_base_name(plant_name: str) -> Tuple[str, str, str]:
     """
     Приводит название растения к нижнему регистру и разбивает его на:
@@ -73,7 +161,7 @@ def extract_plant_base_name(plant_name: str) -> Tuple[str, str, str]:
     Если размер не найден, возвращает plant_name как есть.
     """
     plant_name = plant_name.lower().strip()
-    match = re.search(r'(\d+/\d+)', plant_name)
+    match = _PLANT_SIZE_RE.search(plant_name)
     if match:
         size = match.group(1)
         base_name = plant_name[:match.start()].strip()
@@ -82,6 +170,18 @@ def extract_plant_base_name(plant_name: str) -> Tuple[str, str, str]:
     else:
         return plant_name, "", plant_name
 
+# Первый размер вида "число/число" и всё, что перед ним (как _PLANT_SIZE_RE.search в extract_plant_base_name)
+_PLANT_SIZE_PREFIX_RE = re.compile(r'(?s)^(.*?)(\d+/\d+)')
+
+def _full_plant_names(names: pd.Series) -> pd.Series:
+    """
+    Векторная версия extract_plant_base_name(...)[2] для колонки уже очищенных названий
+    (нижний регистр, без крайних пробелов): "аглаонема 12/40 см" -> "аглаонема 12/40".
+    """
+    parts = names.str.extract(_PLANT_SIZE_PREFIX_RE.pattern)
+    with_size = (parts[0].str.strip() + " " + parts[1]).str.strip()
+    return with_size.where(parts[1].notna(), names)
+
 @contextmanager
 def safe_file_operation(file_path: str, mode: str = 'r', encoding: Optional[str] = None):
     """
@@ -99,6 +199,23 @@ def safe_file_operation(file_path: str, mode: str = 'r', encoding: Optional[str]
         if file:
             file.close()
 
+def _write_bytes_file(file_path: str, content: bytes) -> None:
+    """Записывает байты в файл (вызывается в пуле потоков)."""
+    with safe_file_operation(file_path, 'wb') as f:
+        f.write(content)
+
+def _write_json_file(file_path: str, data: Any) -> None:
+    """
+    Сериализует data через orjson в компактный UTF-8 JSON и записывает в файл
+    (вызывается в пуле потоков). Скаляры numpy из строк pandas сериализуются как числа.
+    """
+    _write_bytes_file(file_path, orjson.dumps(data, default=str, option=orjson.OPT_SERIALIZE_NUMPY))
+
+def _read_json_file(file_path: str) -> Any:
+    """Читает JSON-файл через orjson (вызывается в пуле потоков)."""
+    with safe_file_operation(file_path, 'rb') as f:
+        return orjson.loads(f.read())
+
 def get_plant_name(plant: Dict[str, Any]) -> str:
     """
     Извлекает название растения из различных полей в порядке приоритета.
@@ -257,49 +374,77 @@ async def cleanup_old_json_files(max_files_to_keep: int = MAX_OLD_JSON_FILES):
 async def cleanup_old_plants_files(max_files_to_keep: int = MAX_OLD_PLANTS_FILES):
     await cleanup_old_files(PLANTS_FILTERED_PREFIX, JSON_FILE_SUFFIX, max_files_to_keep)
 
+def _get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx.AsyncClient, создавая его при первом обращении."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            http2=True,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,  # экспорт Google Sheets отвечает редиректом
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    """Закрывает общий HTTP-клиент (при остановке бота)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def _fetch_stock_page(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, offset: int) -> Optional[Dict[str, Any]]:
+    """Запрашивает одну страницу отчёта об остатках; при ошибке пишет в лог и возвращает None."""
+    params = {"limit": MOYSKLAD_PAGE_SIZE, "offset": offset}
+    headers = {
+        "Authorization": f"Bearer {config.MOY_SKLAD}",
+        "Accept": "application/json;charset=utf-8"
+    }
+    
+    try:
+        async with semaphore:
+            response = await client.get(MOYSKLAD_STOCK_URL, headers=headers, params=params)
+        
+        if response.status_code != 200:
+            logger.error(f"Ошибка при получении остатков (offset={offset}): {response.status_code}, {response.text}")
+            return None
+        
+        return response.json()
+    
+    except Exception as e:
+        logger.error(f"Ошибка при запросе к API МойСклад (offset={offset}): {e}")
+        return None
+
 async def get_stock() -> list:
     """
     Получает данные об остатках из МойСклад API.
     
+    Первая страница сообщает общее число строк (meta.size), остальные
+    страницы запрашиваются параллельно.
+    
     Returns:
         list: Список с данными об остатках товаров
     """
-    url = 'https://api.moysklad.ru/api/remap/1.2/report/stock/all'
-    headers = {
-        "Authorization": f"Bearer {config.MOY_SKLAD}",
-        "Accept": "application/json;charset=utf-8"
-    }
-    params = {"limit": 1000}
-    all_stocks = []
-    offset = 0
+    client = _get_http_client()
+    semaphore = asyncio.Semaphore(MOYSKLAD_MAX_CONCURRENT_REQUESTS)
     
-    while True:
-        params["offset"] = offset
-        
-        try:
-            response = await asyncio.to_thread(requests.get, url, headers=headers, params=params)
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка при получении остатков: {response.status_code}, {response.text}")
-                break
-            
-            data = response.json()
-            rows = data.get("rows", [])
-            
-            if not rows:
-                break
-                
-            all_stocks.extend(rows)
-            offset += len(rows)
-            
-            if len(rows) < params["limit"]:
-                break
-                
-        except Exception as e:
-            logger.error(f"Ошибка при запросе к API МойСклад: {e}")
-            break
+    data = await _fetch_stock_page(client, semaphore, 0)
+    if data is None:
+        return []
+    
+    all_stocks = data.get("rows", [])
+    total = data.get("meta", {}).get("size", len(all_stocks))
     
-    logger.info(f"Получено {len(all_stocks)} записей об остатках из МойСклад")
+    # Страницы приходят в порядке offset - gather сохраняет порядок аргументов
+    pages = await asyncio.gather(*(
+        _fetch_stock_page(client, semaphore, offset)
+        for offset in range(MOYSKLAD_PAGE_SIZE, total, MOYSKLAD_PAGE_SIZE)
+    ))
+    for page in pages:
+        if page is not None:
+            all_stocks.extend(page.get("rows", []))
+    
+    logger.info(f"Получено {len(all_stocks)} записей об остатках из МойСклад (всего {total})")
     return all_stocks
 
 def filter_plants(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -313,6 +458,7 @@ def filter_plants(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         List[Dict[str, Any]]: Отфильтрованный список растений
     """
     filtered = []
+    is_plant_folder = _PLANT_FOLDER_RE.search
     
     for item in items:
         folder = item.get("folder", {})
@@ -322,7 +468,7 @@ def filter_plants(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         else:
             folder_name = str(folder)
             
-        if any(keyword in folder_name for keyword in PLANT_FOLDER_KEYWORDS):
+        if is_plant_folder(folder_name):
             filtered.append(item)
     
     logger.info(f"Отфильтровано {len(filtered)} растений из {len(items)} позиций")
@@ -331,6 +477,7 @@ def filter_plants(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 async def parse_json_to_plants(filename: str) -> List[Dict[str, Any]]:
     """
     Преобразует JSON с данными из МойСклад в список растений.
+    Файл пишет export_to_json, и в нём уже только растения - повторно не фильтруем.
     
     Args:
         filename: Путь к JSON файлу
@@ -340,16 +487,13 @@ async def parse_json_to_plants(filename: str) -> List[Dict[str, Any]]:
     """
     try:
         # Загружаем данные из файла
-        json_data = None
-        with safe_file_operation(filename, 'r', encoding='utf-8') as f:
-            json_data = json.load(f)
+        json_data = await asyncio.get_running_loop().run_in_executor(None, _read_json_file, filename)
         
         if not json_data:
             logger.error(f"Файл {filename} пуст или не содержит данных JSON")
             return []
             
-        # Фильтруем только растения
-        plants = filter_plants(json_data)
+        plants = json_data
         
         # Конвертируем числовые значения
         for plant in plants:
@@ -363,18 +507,17 @@ async def parse_json_to_plants(filename: str) -> List[Dict[str, Any]]:
         logger.error(f"Ошибка при обработке JSON файла {filename}: {e}")
         return []
 
-async def export_to_json(stocks: List[Dict[str, Any]]) -> str:
+def stocks_to_plants(stocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
-    Экспортирует данные об остатках в JSON файл.
+    Преобразует строки отчёта об остатках МойСклад в список растений
+    с положительным остатком (stock и price - float).
     
     Args:
         stocks: Список данных об остатках
         
     Returns:
-        str: Имя созданного файла
+        List[Dict[str, Any]]: Список растений
     """
-    now = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{MOYSKLAD_FILE_PREFIX}{now}{JSON_FILE_SUFFIX}"
     output_data = []
     
     for item in stocks:
@@ -386,7 +529,7 @@ async def export_to_json(stocks: List[Dict[str, Any]]) -> str:
             product_folder = folder.get("pathName", "")
             group_name = folder.get("name", "")
             sale_price = item.get("salePrice", 0)
-            price = sale_price / 100 if sale_price else 0
+            price = sale_price / 100 if sale_price else 0.0
             
             output_data.append({
                 "folder": product_folder,
@@ -394,98 +537,264 @@ async def export_to_json(stocks: List[Dict[str, Any]]) -> str:
                 "name": item.get("name", ""),
                 "article": item.get("article", ""),
                 "stock": stock,
-                "price": price
+                "price": float(price)
             })
     
     # Фильтруем только растения
-    filtered_data = filter_plants(output_data)
+    return filter_plants(output_data)
+
+async def export_plants_to_json(plants: List[Dict[str, Any]]) -> str:
+    """
+    Сохраняет растения из МойСклад в JSON файл (архивная копия выгрузки).
+    
+    Args:
+        plants: Список растений (результат stocks_to_plants)
+        
+    Returns:
+        str: Имя созданного файла или пустая строка при ошибке
+    """
+    now = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{MOYSKLAD_FILE_PREFIX}{now}{JSON_FILE_SUFFIX}"
     
     # Сохраняем в файл
     try:
-        with safe_file_operation(filename, 'w', encoding='utf-8') as f:
-            json.dump(filtered_data, f, ensure_ascii=False, indent=4)
+        await asyncio.get_running_loop().run_in_executor(None, _write_json_file, filename, plants)
         
-        logger.info(f"Экспортировано {len(filtered_data)} растений в {filename}")
+        logger.info(f"Экспортировано {len(plants)} растений в {filename}")
         return filename
     except Exception as e:
         logger.error(f"Ошибка при сохранении данных в JSON: {e}")
         return ""
 
-async def create_embeddings(plants: List[Dict[str, Any]], openai_client) -> List[List[float]]:
+async def export_to_json(stocks: List[Dict[str, Any]]) -> str:
+    """
+    Экспортирует данные об остатках в JSON файл.
+    
+    Args:
+        stocks: Список данных об остатках
+        
+    Returns:
+        str: Имя созданного файла
+    """
+    return await export_plants_to_json(stocks_to_plants(stocks))
+
+def _plant_description(plant: Dict[str, Any]) -> str:
+    """Текстовое описание растения для эмбеддинга: все непустые поля, кроме часто меняющихся."""
+    desc_parts = []
+    for key, val in plant.items():
+        if key in EMBEDDING_EXCLUDED_FIELDS:
+            continue
+        if val is not None and str(val).strip():
+            desc_parts.append(f"{key}: {val}")
+    return ". ".join(desc_parts)
+
+def _description_key(description: str) -> bytes:
+    """Ключ эмбеддинга растения - sha256 его описания."""
+    return hashlib.sha256(description.encode("utf-8")).digest()
+
+def embeddings_by_description(plants: List[Dict[str, Any]], embeddings: np.ndarray) -> Dict[bytes, np.ndarray]:
+    """
+    Сопоставляет уже посчитанные эмбеддинги растений ключам их описаний,
+    чтобы create_embeddings не запрашивал их повторно. Нулевые строки (батч с ошибкой) пропускаются.
+    """
+    if len(plants) != len(embeddings):
+        return {}
+    known = {}
+    for plant, emb in zip(plants, embeddings):
+        if emb.any():
+            known[_description_key(_plant_description(plant))] = emb
+    return known
+
+async def create_embeddings(
+    plants: List[Dict[str, Any]], openai_client, known: Optional[Dict[bytes, np.ndarray]] = None
+) -> np.ndarray:
     """
     Создает эмбеддинги для растений.
     
     Args:
         plants: Список растений
         openai_client: OpenAI клиент
+        known: Эмбеддинги с прошлого обновления по ключу описания (embeddings_by_description);
+            у OpenAI запрашиваются только новые и изменившиеся растения
         
     Returns:
-        List[List[float]]: Список эмбеддингов для растений
+        np.ndarray: float32-матрица (растений x размерность) с нормированными строками
     """
+    known = known or {}
+    
     # Создаем текстовые описания растений для эмбеддингов, используя все поля из данных
-    plant_descriptions = []
-    for plant in plants:
-        desc_parts = []
-        for key, val in plant.items():
-            if val is not None and str(val).strip():
-                desc_parts.append(f"{key}: {val}")
-        plant_descriptions.append(". ".join(desc_parts))
-    
-    # Определяем размерность эмбеддингов
+    plant_descriptions = [_plant_description(plant) for plant in plants]
+    keys = [_description_key(desc) for desc in plant_descriptions]
+    
+    # Определяем размерность эмбеддингов: по готовым векторам или пробным запросом
     embedding_dim = EMBEDDING_DIM_DEFAULT  # Значение по умолчанию
-    try:
-        sample_resp = await openai_client.embeddings.create(
-            model=EMBEDDING_MODEL, input=["Тест"]
-        )
-        embedding_dim = len(sample_resp.data[0].embedding)
-    except Exception as e:
-        logger.error(f"Ошибка определения размерности эмбеддингов: {e}")
+    if known:
+        embedding_dim = len(next(iter(known.values())))
+    else:
+        try:
+            sample_resp = await openai_client.embeddings.create(
+                model=EMBEDDING_MODEL, input=["Тест"]
+            )
+            embedding_dim = len(sample_resp.data[0].embedding)
+        except Exception as e:
+            logger.error(f"Ошибка определения размерности эмбеддингов: {e}")
+    
+    # Заполняем заранее выделенную матрицу: известные строки копируем,
+    # остальные создаем батчами; строки батчей с ошибкой остаются нулевыми
+    embeddings = np.zeros((len(plant_descriptions), embedding_dim), dtype=np.float32)
+    missing = []
+    for i, key in enumerate(keys):
+        emb = known.get(key)
+        if emb is not None and len(emb) == embedding_dim:
+            embeddings[i] = emb
+        else:
+            missing.append(i)
     
-    # Создаем эмбеддинги батчами
-    embeddings = []
-    for i in range(0, len(plant_descriptions), EMBEDDING_BATCH_SIZE):
-        batch = plant_descriptions[i:i+EMBEDDING_BATCH_SIZE]
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        rows = missing[start:start+EMBEDDING_BATCH_SIZE]
+        batch = [plant_descriptions[i] for i in rows]
         try:
             resp = await openai_client.embeddings.create(
                 model=EMBEDDING_MODEL, input=batch
             )
-            embeddings.extend([d.embedding for d in resp.data])
+            embeddings[rows] = [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
             await asyncio.sleep(EMBEDDING_BATCH_PAUSE)  # Пауза для избежания лимитов API
         except Exception as e:
-            logger.error(f"Ошибка при создании эмбеддингов для батча {i}-{i+len(batch)}: {e}")
-            # Заполняем нулевыми векторами в случае ошибки
-            embeddings.extend([[0] * embedding_dim] * len(batch))
+            logger.error(f"Ошибка при создании эмбеддингов для батча {start}-{start+len(batch)}: {e}")
     
-    logger.info(f"Создано {len(embeddings)} эмбеддингов для растений")
-    return embeddings
+    logger.info(
+        f"Создано {len(embeddings)} эмбеддингов для растений "
+        f"(запрошено {len(missing)}, взято готовых {len(embeddings) - len(missing)})"
+    )
+    return _normalize_rows(embeddings)
 
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+def _normalize_rows(embeddings) -> np.ndarray:
     """
-    Вычисляет косинусное сходство между двумя векторами.
-    
-    Args:
-        vec1: Первый вектор
-        vec2: Второй вектор
-        
-    Returns:
-        float: Косинусное сходство (от -1 до 1)
+    Приводит эмбеддинги к float32-матрице с единичными строками, чтобы косинусное
+    сходство сводилось к скалярному произведению. Нулевые строки остаются нулевыми.
     """
-    if len(vec1) != len(vec2):
-        return 0.0
+    matrix = np.array(embeddings, dtype=np.float32)
+    if matrix.ndim != 2:
+        return np.zeros((0, EMBEDDING_DIM_DEFAULT), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    matrix /= norms
+    return matrix
+
+async def _embed_query(query: str, openai_client) -> np.ndarray:
+    """
+    Возвращает эмбеддинг запроса, повторные запросы берутся из LRU-кэша.
     
+    Ключ - sha256 от текста без крайних пробелов и в нижнем регистре.
+    Одинаковые запросы, пришедшие одновременно, делают к OpenAI один вызов,
+    а разные запросы одной итерации event-loop отправляются одним батчем.
+    """
+    key = hashlib.sha256(query.strip().lower().encode("utf-8")).digest()
+    cached = _query_embedding_cache.get(key)
+    if cached is not None:
+        _query_embedding_cache.move_to_end(key)
+        return cached
+    
+    future = _query_embedding_inflight.get(key)
+    if future is None:
+        # Новый запрос ставим в батч: все запросы, пришедшие в той же итерации
+        # event-loop (например, параллельные вызовы инструментов агента), уйдут одним вызовом
+        loop = asyncio.get_running_loop()
+        future = _query_embedding_inflight[key] = loop.create_future()
+        if not _query_embedding_batch:
+            loop.call_soon(_flush_query_embedding_batch, openai_client)
+        _query_embedding_batch.append((query, key, future))
+    return await asyncio.shield(future)
+
+def _flush_query_embedding_batch(openai_client) -> None:
+    """Отправляет накопленные запросы батчами по EMBEDDING_BATCH_SIZE."""
+    batch = _query_embedding_batch[:]
+    _query_embedding_batch.clear()
+    for i in range(0, len(batch), EMBEDDING_BATCH_SIZE):
+        task = asyncio.ensure_future(_embed_query_batch(batch[i:i+EMBEDDING_BATCH_SIZE], openai_client))
+        _query_embedding_tasks.add(task)
+        task.add_done_callback(_query_embedding_tasks.discard)
+
+async def _embed_query_batch(batch: List[Tuple[str, bytes, "asyncio.Future[np.ndarray]"]], openai_client) -> None:
+    """Получает эмбеддинги для батча запросов одним вызовом и раздаёт их ожидающим."""
     try:
-        v1 = np.array(vec1, dtype=np.float32)
-        v2 = np.array(vec2, dtype=np.float32)
-        
-        denom = float(np.linalg.norm(v1) * np.linalg.norm(v2))
-        
-        if denom == 0.0:
-            return 0.0
-            
-        return float(np.dot(v1, v2) / denom)
+        resp = await openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[query for query, _, _ in batch]
+        )
+        # OpenAI возвращает эмбеддинги с индексом входной строки
+        vectors = [None] * len(batch)
+        for d in resp.data:
+            vectors[d.index] = np.asarray(d.embedding, dtype=np.float32)
+    except asyncio.CancelledError:
+        for _, key, future in batch:
+            del _query_embedding_inflight[key]
+            future.cancel()
+        raise
     except Exception as e:
-        logger.error(f"Ошибка при вычислении косинусного сходства: {e}")
-        return 0.0
+        logger.error(f"Ошибка при создании эмбеддингов запросов: {e}")
+        for _, key, future in batch:
+            del _query_embedding_inflight[key]
+            if not future.done():
+                future.set_exception(e)
+                # Если ожидающих уже нет, не даём asyncio ругаться на непрочитанное исключение
+                future.exception()
+        return
+    
+    for (_, key, future), query_emb in zip(batch, vectors):
+        del _query_embedding_inflight[key]
+        _query_embedding_cache[key] = query_emb
+        if not future.done():
+            future.set_result(query_emb)
+    while len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+        _query_embedding_cache.popitem(last=False)
+
+def _write_query_embedding_cache(items: List[Tuple[bytes, np.ndarray]]) -> None:
+    """
+    Записывает снимок кэша эмбеддингов запросов (пары ключ-вектор в порядке LRU) на диск.
+    Работает со снимком, а не с самим кэшем, поэтому может вызываться в пуле потоков.
+    """
+    try:
+        # Ключи (sha256, 32 байта) - матрицей uint8, векторы - матрицей float32, в порядке LRU
+        keys = b"".join(key for key, _ in items)
+        if items:
+            vectors = np.stack([vector for _, vector in items]).astype(np.float32, copy=False)
+        else:
+            vectors = np.zeros((0, EMBEDDING_DIM_DEFAULT), dtype=np.float32)
+        tmp_file = QUERY_EMBEDDINGS_FILE + ".tmp"
+        with safe_file_operation(tmp_file, 'wb') as f:
+            np.savez(
+                f,
+                model=np.array(EMBEDDING_MODEL),
+                keys=np.frombuffer(keys, dtype=np.uint8).reshape(len(items), 32),
+                vectors=vectors,
+            )
+        os.replace(tmp_file, QUERY_EMBEDDINGS_FILE)
+        logger.info(f"Сохранено {len(items)} эмбеддингов запросов в {QUERY_EMBEDDINGS_FILE}")
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении кэша эмбеддингов запросов: {e}")
+
+def save_query_embedding_cache() -> None:
+    """Сохраняет кэш эмбеддингов запросов на диск, чтобы после перезапуска он был тёплым."""
+    _write_query_embedding_cache(list(_query_embedding_cache.items()))
+
+def load_query_embedding_cache() -> None:
+    """Загружает сохранённый кэш эмбеддингов запросов, если он сделан той же моделью."""
+    if not os.path.exists(QUERY_EMBEDDINGS_FILE):
+        return
+    try:
+        # allow_pickle=False: из файла читаются только числовые массивы
+        with np.load(QUERY_EMBEDDINGS_FILE, allow_pickle=False) as saved_data:
+            if str(saved_data['model']) != EMBEDDING_MODEL:
+                logger.info("Кэш эмбеддингов запросов сделан другой моделью, пропускаем")
+                return
+            keys = saved_data['keys'][-QUERY_EMBEDDING_CACHE_SIZE:]
+            vectors = saved_data['vectors'][-QUERY_EMBEDDING_CACHE_SIZE:]
+        for key, query_emb in zip(keys, vectors):
+            _query_embedding_cache[key.tobytes()] = query_emb
+        logger.info(f"Загружено {len(_query_embedding_cache)} эмбеддингов запросов из {QUERY_EMBEDDINGS_FILE}")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке кэша эмбеддингов запросов: {e}")
 
 async def vector_search(query: str, top_k: int, openai_client) -> List[Dict[str, Any]]:
     """
@@ -518,11 +827,11 @@ async def vector_search_with_score(query: str, top_k: int, openai_client) -> Lis
     global plants_data, plants_embeddings
     
     # Проверяем наличие данных
-    if not plants_data or not plants_embeddings:
+    if not plants_data or not len(plants_embeddings):
         logger.warning("Нет загруженных данных о растениях")
         await initialize_data(openai_client)
         
-        if not plants_data or not plants_embeddings:
+        if not plants_data or not len(plants_embeddings):
             logger.error("Не удалось загрузить данные о растениях")
             return []
     
@@ -532,30 +841,40 @@ async def vector_search_with_score(query: str, top_k: int, openai_client) -> Lis
         return []
     
     try:
-        # Создаем эмбеддинг для запроса
-        resp = await openai_client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=[query]
-        )
-        query_emb = resp.data[0].embedding
+        query_emb = await _embed_query(query, openai_client)
         
-        # Вычисляем сходство с каждым растением
-        similarities = []
-        for i, emb in enumerate(plants_embeddings):
-            sim = cosine_similarity(query_emb, emb)
-            similarities.append((plants_data[i], sim))
+        matrix = plants_embeddings
+        if matrix.shape[1] != query_emb.shape[0]:
+            logger.error(f"Несоответствие размерности эмбеддингов: {matrix.shape[1]} и {query_emb.shape[0]}")
+            return []
+        
+        # Сходство со всеми растениями одним умножением матрицы на вектор
+        query_norm = float(np.linalg.norm(query_emb))
+        if query_norm == 0.0:
+            sims = np.zeros(matrix.shape[0], dtype=np.float32)
+        else:
+            sims = matrix @ (query_emb / query_norm)
         
-        # Сортируем по убыванию сходства и берем top_k
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        # Выбираем top_k без полной сортировки, затем сортируем только их
+        if top_k < sims.shape[0]:
+            top = np.argpartition(-sims, top_k)[:top_k]
+            order = top[np.argsort(-sims[top], kind="stable")]
+        else:
+            order = np.argsort(-sims, kind="stable")
+        similarities = [(plants_data[i], float(sims[i])) for i in order]
         
-        logger.info(f"Найдено {min(top_k, len(similarities))} растений по запросу '{query}'")
-        return similarities[:top_k]
+        logger.info(f"Найдено {len(similarities)} растений по запросу '{query}'")
+        return similarities
     
     except Exception as e:
         logger.error(f"Ошибка при векторном поиске: {e}")
         return []
 
-def download_google_sheet_as_excel(sheet_id: str = SHEET_ID, output_file: str = OUTPUT_FILE) -> bool:
+def _read_all_sheets(file_path: str) -> Dict[str, pd.DataFrame]:
+    """Читает все листы xlsx-файла за один проход."""
+    return pd.read_excel(file_path, sheet_name=None, engine=EXCEL_READ_ENGINE)
+
+async def download_google_sheet_as_excel(sheet_id: str = SHEET_ID, output_file: str = OUTPUT_FILE) -> bool:
     """
     Скачивает Google Sheet как Excel файл.
     
@@ -571,17 +890,17 @@ def download_google_sheet_as_excel(sheet_id: str = SHEET_ID, output_file: str =
         export_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=xlsx"
         
         # Скачиваем файл
-        response = requests.get(export_url)
+        response = await _get_http_client().get(export_url)
         
         if response.status_code == 200:
             # Сохраняем файл
-            with safe_file_operation(output_file, 'wb') as f:
-                f.write(response.content)
+            await asyncio.get_running_loop().run_in_executor(None, _write_bytes_file, output_file, response.content)
             
             logger.info(f"Файл успешно скачан как {output_file}")
             
-            # Обрабатываем файл (удаляем фрагменты текста вида [11111])
-            process_excel_file(output_file)
+            # Обрабатываем файл (удаляем фрагменты текста вида [11111]).
+            # Разбор и запись xlsx занимают секунды - выполняем в пуле потоков, чтобы не блокировать цикл событий
+            await asyncio.get_running_loop().run_in_executor(None, process_excel_file, output_file)
             logger.info(f"Файл успешно обработан")
             
             return True
@@ -604,20 +923,18 @@ def process_excel_file(file_path: str) -> None:
     temp_file = file_path.replace('.xlsx', '_temp.xlsx')
     
     try:
-        # Читаем все листы
-        dfs = {}
-        with pd.ExcelFile(file_path) as excel_file:
-            for sheet_name in excel_file.sheet_names:
-                dfs[sheet_name] = pd.read_excel(excel_file, sheet_name=sheet_name)
+        # Читаем все листы за один проход
+        dfs = _read_all_sheets(file_path)
         
         # Обрабатываем каждый лист
         with pd.ExcelWriter(temp_file, engine='openpyxl') as writer:
             for sheet_name, df in dfs.items():
-                # Удаляем фрагменты вида [11111] из текстовых колонок
+                # Удаляем фрагменты вида [11111] из текстовых колонок (векторно, пустые ячейки не трогаем)
                 for column in df.columns:
                     if df[column].dtype == 'object':
-                        df[column] = df[column].apply(
-                            lambda x: re.sub(r'\[\d+\]', '', str(x)) if pd.notna(x) else x
+                        present = df[column].notna()
+                        df.loc[present, column] = (
+                            df.loc[present, column].astype(str).str.replace(_BRACKET_NUM_RE, '', regex=True)
                         )
                 
                 # Сохраняем обработанный лист
@@ -644,127 +961,174 @@ def process_excel_file(file_path: str) -> None:
 
 
 
-async def merge_moysklad_with_sheet(moysklad_data: List[Dict[str, Any]], sheet_file: str = OUTPUT_FILE) -> str:
+# Общие значения для строк, которые добавляются в таблицу из МойСклад
+_NEW_SHEET_ROW_TEMPLATE = {
+    "Грунт": "-",
+    "Пересадка": "-",
+    "Растение": "-",
+    "Кашпо/Горшок": "в техническом горшке",
+    "Уход (список)": "-",
+    "Освещение": "-",
+    "Полив": "-",
+}
+
+async def merge_moysklad_with_sheet(
+    moysklad_data: List[Dict[str, Any]], sheet_file: str = OUTPUT_FILE
+) -> Tuple[str, Optional[Dict[str, pd.DataFrame]]]:
     """
     Объединяет данные из МойСклад с данными из Google Sheets.
     Добавляет колонку с остатками из МойСклад.
     
     Если растение из МойСклад отсутствует в Excel, добавляет новую строку
     с нужными значениями.
+    
+    Returns:
+        (путь к сохранённому файлу, листы объединённой таблицы). При ошибке -
+        (sheet_file, None): вызывающий код читает исходную таблицу сам.
     """
     try:
         # Создаём словарь для быстрого доступа к price/stock.
         stock_dict = {}
         for plant in moysklad_data:
-            raw_name = plant.get("name", "").strip()
-            raw_name = re.sub(r'\[\d+\]', '', raw_name).strip().lower()
+            original_name = plant.get("name", "").strip()
+            raw_name = _BRACKET_NUM_RE.sub('', original_name).strip().lower()
             _, _, full_name = extract_plant_base_name(raw_name)
             
+            # Преобразуем price в целое
+            price = plant.get("price", 0)
+            try:
+                price = int(price)
+            except (ValueError, TypeError):
+                pass
+            
+            # Символьные коды считаем один раз на растение, а не на каждом листе таблицы
             stock_dict[full_name] = {
-                "price": plant.get("price", 0),
+                "price": price,
                 "stock": plant.get("stock", 0),
-                "original_name": plant.get("name", "").strip()
+                "original_name": original_name,
+                "symbolic_code": generate_symbolic_code(original_name),
+                "tech_symbolic_code": generate_symbolic_code(f"{original_name}_tech"),
             }
         
-        output_file = PROCESSED_SHEET_FILE
-        dfs = {}
+        # Чтение, сопоставление и запись xlsx - синхронная работа pandas, выполняем её в пуле потоков
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _merge_stock_into_sheet, stock_dict, sheet_file, PROCESSED_SHEET_FILE
+        )
+    
+    except Exception as e:
+        logger.error(f"Ошибка: {e}")
+        return sheet_file, None
+
+def _merge_stock_into_sheet(
+    stock_dict: Dict[str, Dict[str, Any]], sheet_file: str, output_file: str
+) -> Tuple[str, Dict[str, pd.DataFrame]]:
+    """
+    Синхронная часть merge_moysklad_with_sheet: проставляет остатки на всех листах
+    sheet_file, добавляет недостающие строки и сохраняет результат в output_file.
+    Возвращает путь к файлу и сами листы, чтобы не перечитывать только что записанный xlsx.
+    """
+    dfs = _read_all_sheets(sheet_file)
+    
+    for sheet_name, df in dfs.items():
+        # Ищем колонку "Растение" (или по любой вашей логике)
+        name_column = None
+        for col in df.columns:
+            if "растение" in col.lower():
+                name_column = col
+                break
         
-        with pd.ExcelFile(sheet_file) as excel_file:
-            for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(excel_file, sheet_name=sheet_name)
-                
-                # Ищем колонку "Растение" (или по любой вашей логике)
-                name_column = None
-                for col in df.columns:
-                    if "растение" in col.lower():
-                        name_column = col
-                        break
-                
-                # Убеждаемся, что есть колонка "остаток (мойсклад)"
-                if "остаток (мойсклад)" not in df.columns:
-                    df["остаток (мойсклад)"] = None
-                
-                found_plants = set()
-                if name_column:
-                    # Пробегаемся по каждой строке и ставим остатки, если растение есть
-                    for idx, row in df.iterrows():
-                        plant_name = str(row[name_column]).strip()
-                        plant_name = re.sub(r'\[\d+\]', '', plant_name).strip().lower()
-                        _, _, full_name = extract_plant_base_name(plant_name)
-                        
-                        if full_name in stock_dict:
-                            df.at[idx, "остаток (мойсклад)"] = stock_dict[full_name]["stock"]
-                            found_plants.add(full_name)
-                
-                # Добавляем новые строки для растений, которых нет в Excel
-                missing_plants = [k for k in stock_dict if k not in found_plants]
-                
-                for mp in missing_plants:
-                    data = stock_dict[mp]
-                    new_row = {}
-                    original_name = data["original_name"]
-                    new_row["Название"] = original_name
-                    new_row["Грунт"] = "-"
-                    new_row["Пересадка"] = "-"
-                    new_row["Растение"] = "-"
-                    new_row["Кашпо/Горшок"] = "в техническом горшке"
-                    new_row["Уход (список)"] = "-"
-                    new_row["Освещение"] = "-"
-                    new_row["Полив"] = "-"
-                    # Преобразуем price в целое
-                    try:
-                        new_row["Розничная цена"] = int(data["price"])
-                    except:
-                        new_row["Розничная цена"] = data["price"]
-                    
-                    # Генерируем символьный код для нового растения
-                    generated_code = generate_symbolic_code(original_name)
-                    new_row["Символьный код в админке (не удалять)"] = generated_code
-                    new_row["Ссылка на товар"] = "ссылка"
-                        
-                    new_row["остаток (мойсклад)"] = data["stock"]
-                    
-                    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                
-                # Теперь добавляем все растения из МойСклад в технических горшках
-                for stock_key, data in stock_dict.items():
-                    original_name = data["original_name"]
-                    new_row = {}
-                    new_row["Название"] = f"{original_name} (тех)"
-                    new_row["Грунт"] = "-"
-                    new_row["Пересадка"] = "-"
-                    new_row["Растение"] = "-" 
-                    new_row["Кашпо/Горшок"] = "в техническом горшке"
-                    new_row["Уход (список)"] = "-"
-                    new_row["Освещение"] = "-"
-                    new_row["Полив"] = "-"
-                    # Преобразуем price в целое
-                    try:
-                        new_row["Розничная цена"] = int(data["price"])
-                    except:
-                        new_row["Розничная цена"] = data["price"]
-                    
-                    # Генерируем символьный код для растения в техническом горшке
-                    generated_code = generate_symbolic_code(f"{original_name}_tech")
-                    new_row["Символьный код в админке (не удалять)"] = generated_code
-                    new_row["Ссылка на товар"] = "ссылка"
-                        
-                    new_row["остаток (мойсклад)"] = data["stock"]
-                    
-                    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                
-                dfs[sheet_name] = df
+        # Убеждаемся, что есть колонка "остаток (мойсклад)"
+        if "остаток (мойсклад)" not in df.columns:
+            df["остаток (мойсклад)"] = None
         
-        with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
-            for sheet_name, df in dfs.items():
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        found_plants = set()
+        if name_column:
+            # Чистим названия всей колонкой сразу, без iterrows
+            plant_names = (
+                df[name_column].astype(str).str.strip()
+                .str.replace(_BRACKET_NUM_RE, '', regex=True).str.strip().str.lower()
+            )
+            
+            full_names = _full_plant_names(plant_names)
+            
+            # Ставим остатки одним сопоставлением по словарю вместо df.at на каждой строке
+            in_stock = full_names.isin(stock_dict.keys())
+            df.loc[in_stock, "остаток (мойсклад)"] = full_names[in_stock].map(
+                {name: data["stock"] for name, data in stock_dict.items()}
+            )
+            found_plants = set(full_names[in_stock])
+        
+        # Новые строки копим в списках и добавляем к таблице одним concat:
+        # concat в цикле копирует всю таблицу на каждой строке.
+        # За один проход по stock_dict собираем и растения, которых нет в Excel,
+        # и копии всех растений в технических горшках (они идут после первых, как раньше)
+        missing_rows = []
+        tech_rows = []
         
-        logger.info(f"Файл сохранён: {output_file}")
-        return output_file
+        for stock_key, data in stock_dict.items():
+            if stock_key not in found_plants:
+                missing_rows.append({
+                    **_NEW_SHEET_ROW_TEMPLATE,
+                    "Название": data["original_name"],
+                    "Розничная цена": data["price"],
+                    "Символьный код в админке (не удалять)": data["symbolic_code"],
+                    "Ссылка на товар": "ссылка",
+                    "остаток (мойсклад)": data["stock"],
+                })
+            
+            # Растение в техническом горшке
+            tech_rows.append({
+                **_NEW_SHEET_ROW_TEMPLATE,
+                "Название": f"{data['original_name']} (тех)",
+                "Розничная цена": data["price"],
+                "Символьный код в админке (не удалять)": data["tech_symbolic_code"],
+                "Ссылка на товар": "ссылка",
+                "остаток (мойсклад)": data["stock"],
+            })
+        
+        new_rows = missing_rows + tech_rows
+        if new_rows:
+            df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
+        
+        dfs[sheet_name] = df
     
-    except Exception as e:
-        logger.error(f"Ошибка: {e}")
-        return sheet_file
+    with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
+        for sheet_name, df in dfs.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    
+    logger.info(f"Файл сохранён: {output_file}")
+    return output_file, dfs
+
+def _sheet_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    Строки листа словарями одним вызовом to_dict. Пустые ячейки (NaN) становятся None:
+    геттеры растений и описание для эмбеддинга считают None отсутствующим значением, а NaN - нет.
+    """
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def _select_sheet_rows(dfs: Dict[str, pd.DataFrame]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Возвращает (строки с остатком >= 1, строки листов без колонки остатка) в виде словарей.
+    """
+    sheet_data = []
+    filtered_data = []
+    
+    for sheet_name, df in dfs.items():
+        # Фильтруем только растения с остатком >= 1
+        if 'остаток (мойсклад)' in df.columns:
+            # В объединённой таблице колонка остатка смешанная (числа и None) - приводим к числам
+            in_stock = pd.to_numeric(df['остаток (мойсклад)'], errors='coerce') >= 1
+            df_filtered = df[in_stock]
+            logger.info(f"На листе {sheet_name}: отфильтровано {len(df_filtered)} растений из {len(df)}")
+            
+            # Сохраняем отфильтрованные данные
+            filtered_data.extend(_sheet_records(df_filtered))
+        else:
+            logger.warning(f"На листе {sheet_name} нет колонки 'остаток (мойсклад)'")
+            # Включаем все строки, если нет колонки остатка
+            sheet_data.extend(_sheet_records(df))
+    
+    return filtered_data, sheet_data
 
 async def update_plant_data(openai_client) -> bool:
     """
@@ -793,11 +1157,13 @@ async def update_plant_data(openai_client) -> bool:
             logger.error("Не удалось получить остатки из МойСклад")
             return False
             
-        # Преобразуем данные МойСклад в удобный формат
-        plants_data_ms = await parse_json_to_plants(await export_to_json(stocks))
+        # Преобразуем данные МойСклад в удобный формат прямо в памяти;
+        # JSON-файл пишем только как архивную копию и обратно не читаем
+        plants_data_ms = stocks_to_plants(stocks)
+        await export_plants_to_json(plants_data_ms)
         
         # Шаг 3: Скачивание данных из Google Sheets
-        sheets_success = download_google_sheet_as_excel(SHEET_ID, OUTPUT_FILE)
+        sheets_success = await download_google_sheet_as_excel(SHEET_ID, OUTPUT_FILE)
         if not sheets_success:
             logger.error("Не удалось скачать Google Sheet")
             return False
@@ -805,42 +1171,24 @@ async def update_plant_data(openai_client) -> bool:
         logger.info(f"Google Sheet успешно скачан как {OUTPUT_FILE}")
         
         # Шаг 4: Добавление колонки "остаток" к данным из Google Sheets
-        processed_file = await merge_moysklad_with_sheet(plants_data_ms, OUTPUT_FILE)
+        processed_file, sheets = await merge_moysklad_with_sheet(plants_data_ms, OUTPUT_FILE)
         logger.info(f"Файл с добавленными остатками создан: {processed_file}")
         
-        # Шаг 5: Загрузка данных из Excel и фильтрация (остаток >= 1)
-        sheet_data = []
-        filtered_data = []
+        # Шаг 5: Фильтрация (остаток >= 1) по листам, которые merge уже держит в памяти.
+        # Перечитываем xlsx только если объединение не удалось
         now = datetime.now().strftime("%Y%m%d_%H%M%S")
         filtered_json_file = f"{PLANTS_FILTERED_PREFIX}{now}{JSON_FILE_SUFFIX}"
-        
-        with pd.ExcelFile(processed_file) as excel_file:
-            for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(excel_file, sheet_name=sheet_name)
-                
-                # Фильтруем только растения с остатком >= 1
-                if 'остаток (мойсклад)' in df.columns:
-                    df_filtered = df[df['остаток (мойсклад)'] >= 1].copy()
-                    logger.info(f"На листе {sheet_name}: отфильтровано {len(df_filtered)} растений из {len(df)}")
-                    
-                    # Сохраняем отфильтрованные данные
-                    for _, row in df_filtered.iterrows():
-                        item_data = row.to_dict()
-                        filtered_data.append(item_data)
-                else:
-                    logger.warning(f"На листе {sheet_name} нет колонки 'остаток (мойсклад)'")
-                    # Включаем все строки, если нет колонки остатка
-                    for _, row in df.iterrows():
-                        item_data = row.to_dict()
-                        sheet_data.append(item_data)
+        loop = asyncio.get_running_loop()
+        if sheets is None:
+            sheets = await loop.run_in_executor(None, _read_all_sheets, processed_file)
+        filtered_data, sheet_data = await loop.run_in_executor(None, _select_sheet_rows, sheets)
         
         # Если есть отфильтрованные данные, используем их, иначе используем все данные
         final_data = filtered_data if filtered_data else sheet_data
         
         # Шаг 6: Сохранение отфильтрованных данных в JSON
         try:
-            with safe_file_operation(filtered_json_file, 'w', encoding='utf-8') as f:
-                json.dump(final_data, f, ensure_ascii=False, indent=4)
+            await asyncio.get_running_loop().run_in_executor(None, _write_json_file, filtered_json_file, final_data)
             logger.info(f"Отфильтрованные данные сохранены в {filtered_json_file}")
             latest_stock_file = filtered_json_file
             
@@ -853,29 +1201,63 @@ async def update_plant_data(openai_client) -> bool:
         
         # Шаг 7: Создание эмбеддингов для отфильтрованных данных
         logger.info(f"Создание эмбеддингов для {len(final_data)} растений...")
-        plants_embeddings = await create_embeddings(final_data, openai_client)
+        # Растения с неизменившимся описанием берут эмбеддинг из текущих данных
+        known_embeddings = embeddings_by_description(plants_data, plants_embeddings)
+        plants_embeddings = await create_embeddings(final_data, openai_client, known_embeddings)
         plants_data = final_data
+        # Индекс текстового поиска строим сразу, а не на первом запросе клиента, и вне event loop
+        await asyncio.get_running_loop().run_in_executor(None, _get_search_index)
+        
+        # Шаг 8: Сохранение данных и эмбеддингов - в пуле потоков, чтобы запись
+        # нескольких мегабайт не останавливала обработку сообщений
+        await asyncio.get_running_loop().run_in_executor(None, _save_embeddings, plants_embeddings)
         
-        # Шаг 8: Сохранение данных и эмбеддингов
         save_data = {
             'file': filtered_json_file,
             'processed_file': processed_file,
             'file_mtime': os.path.getmtime(filtered_json_file),
             'plants_data': plants_data,
-            'embeddings': plants_embeddings,
             'timestamp': datetime.now().isoformat()
         }
         
-        with safe_file_operation(EMBEDDINGS_FILE, 'wb') as f:
-            pickle.dump(save_data, f)
+        # JSON вместо pickle: загрузка не исполняет код из файла, а orjson разбирает его быстрее
+        tmp_data_file = PLANTS_DATA_FILE + ".tmp"
+        await asyncio.get_running_loop().run_in_executor(None, _write_json_file, tmp_data_file, save_data)
+        await asyncio.get_running_loop().run_in_executor(None, os.replace, tmp_data_file, PLANTS_DATA_FILE)
+        
+        logger.info(f"Данные сохранены в {PLANTS_DATA_FILE}, эмбеддинги - в {EMBEDDINGS_MATRIX_FILE}")
         
-        logger.info(f"Данные и эмбеддинги сохранены в {EMBEDDINGS_FILE}")
+        # Заодно сбрасываем на диск кэш эмбеддингов запросов (раз в цикл обновления).
+        # Снимок берём в event loop (кэш меняют запросы), а stack/savez - в пуле потоков
+        query_cache_items = list(_query_embedding_cache.items())
+        await asyncio.get_running_loop().run_in_executor(None, _write_query_embedding_cache, query_cache_items)
         return True
     
     except Exception as e:
         logger.error(f"Ошибка при обновлении данных о растениях: {e}")
         return False
 
+def _save_embeddings(matrix: np.ndarray) -> None:
+    """
+    Сохраняет матрицу эмбеддингов в EMBEDDINGS_MATRIX_FILE (вызывается в пуле потоков).
+    Пишем во временный файл и подменяем rename: уже отображённый в память
+    старый файл остаётся целым, пока его кто-то читает.
+    """
+    tmp_matrix_file = EMBEDDINGS_MATRIX_FILE + ".tmp"
+    with safe_file_operation(tmp_matrix_file, 'wb') as f:
+        np.save(f, matrix)
+    os.replace(tmp_matrix_file, EMBEDDINGS_MATRIX_FILE)
+
+def _load_embeddings() -> np.ndarray:
+    """
+    Загружает матрицу эмбеддингов, сохранённую вместе с PLANTS_DATA_FILE.
+    Матрица из EMBEDDINGS_MATRIX_FILE отображается в память (mmap) без копирования.
+    """
+    matrix = np.load(EMBEDDINGS_MATRIX_FILE, mmap_mode='r')
+    if matrix.ndim != 2 or matrix.dtype != np.float32:
+        raise ValueError(f"Неожиданный формат {EMBEDDINGS_MATRIX_FILE}: {matrix.shape}, {matrix.dtype}")
+    return matrix
+
 async def initialize_data(openai_client) -> bool:
     """
     Инициализирует данные о растениях, загружая их из файла или обновляя при необходимости.
@@ -888,58 +1270,139 @@ async def initialize_data(openai_client) -> bool:
     """
     global plants_data, plants_embeddings, latest_stock_file
     
+    if not _query_embedding_cache:
+        load_query_embedding_cache()
+    
     try:
-        if os.path.exists(EMBEDDINGS_FILE):
-            logger.info(f"Найден {EMBEDDINGS_FILE}, проверяем возраст...")
-            
-            file_age_seconds = time.time() - os.path.getmtime(EMBEDDINGS_FILE)
+        if os.path.exists(PLANTS_DATA_FILE):
+            logger.info(f"Найден {PLANTS_DATA_FILE}, проверяем возраст...")
             
-            # Если файл старше 1 часа, обновляем данные
-            if file_age_seconds > EMBEDDINGS_FILE_MAX_AGE:
-                logger.info("Файл эмбеддингов старше 1 часа. Обновляем...")
-                return await update_plant_data(openai_client)
+            file_age_seconds = time.time() - os.path.getmtime(PLANTS_DATA_FILE)
             
-            # Загружаем данные из файла
+            # Загружаем данные из файла даже если он устарел: обновление возьмёт
+            # из них эмбеддинги неизменившихся растений
             try:
-                with safe_file_operation(EMBEDDINGS_FILE, 'rb') as f:
-                    saved_data = pickle.load(f)
+                saved_data = await asyncio.get_running_loop().run_in_executor(None, _read_json_file, PLANTS_DATA_FILE)
                 
                 if not saved_data:
-                    logger.warning("Не удалось загрузить данные из pickle файла")
+                    logger.warning(f"Не удалось загрузить данные из {PLANTS_DATA_FILE}")
                     return await update_plant_data(openai_client)
                 
                 saved_file = saved_data.get('file')
                 
-                # Проверяем, существует ли файл, на который ссылается pickle
+                # Проверяем, существует ли файл, на который ссылаются сохранённые данные
                 if saved_file and os.path.exists(saved_file):
                     plants_data = saved_data.get('plants_data', [])
-                    plants_embeddings = saved_data.get('embeddings', [])
+                    plants_embeddings = _load_embeddings()
                     latest_stock_file = saved_data.get('moysklad_file', saved_file)
                     
-                    logger.info(f"Загружено {len(plants_data)} растений из {EMBEDDINGS_FILE}")
+                    if len(plants_embeddings) != len(plants_data):
+                        logger.warning(f"Эмбеддингов {len(plants_embeddings)}, а растений {len(plants_data)}. Обновляем данные...")
+                        return await update_plant_data(openai_client)
+                    
+                    # Если файл старше 1 часа, обновляем данные
+                    if file_age_seconds > EMBEDDINGS_FILE_MAX_AGE:
+                        logger.info("Файл эмбеддингов старше 1 часа. Обновляем...")
+                        return await update_plant_data(openai_client)
+                    
+                    await asyncio.get_running_loop().run_in_executor(None, _get_search_index)
+                    logger.info(f"Загружено {len(plants_data)} растений из {PLANTS_DATA_FILE}")
                     return True
                 else:
-                    logger.warning("В pickle нет актуального файла. Обновляем данные...")
+                    logger.warning(f"В {PLANTS_DATA_FILE} нет актуального файла. Обновляем данные...")
                     return await update_plant_data(openai_client)
                     
             except Exception as e:
                 logger.error(f"Ошибка при загрузке файла: {e}")
                 return await update_plant_data(openai_client)
         else:
-            logger.info(f"{EMBEDDINGS_FILE} не найден, запускаем обновление данных...")
+            logger.info(f"{PLANTS_DATA_FILE} не найден, запускаем обновление данных...")
             return await update_plant_data(openai_client)
     
     except Exception as e:
         logger.error(f"Ошибка при инициализации данных: {e}")
         return await update_plant_data(openai_client)
 
-def search_plants_by_name(query_name: str) -> List[Dict[str, Any]]:
+def _plant_search_entry(plant: Dict[str, Any]) -> _PlantSearchEntry:
+    """Собирает нормализованные поля растения для текстового поиска."""
+    lowered = [v.lower() if isinstance(v, str) else "" for v in map(plant.get, _SEARCH_TEXT_FIELDS)]
+    search_text = " ".join(lowered).strip()
+    
+    # Базовое имя растения (без размеров): по "name", иначе по "Название"
+    plant_name, plant_title = lowered[0], lowered[2]
+    base_name, _, _ = extract_plant_base_name(plant_name if plant_name else plant_title)
+    
+    cleaned_name = _NAME_JUNK_RE.sub('', get_plant_name(plant).lower()).strip()
+    return _PlantSearchEntry(cleaned_name, search_text, tuple(search_text.split()), base_name, tuple(base_name.split()))
+
+def _get_search_index() -> List[_PlantSearchEntry]:
+    """Возвращает индекс текстового поиска для текущих plants_data, перестраивая его после обновления данных."""
+    global _search_index, _search_index_source, _search_vocab, _search_postings, _search_exact_names
+    source = plants_data
+    if _search_index_source is not source:
+        search_index = [_plant_search_entry(plant) for plant in source]
+        
+        postings: Dict[str, List[int]] = {}
+        exact_names: Dict[str, List[int]] = {}
+        for i, entry in enumerate(search_index):
+            exact_names.setdefault(entry.cleaned_name, []).append(i)
+            for word in set(entry.search_words).union(entry.base_words):
+                postings.setdefault(word, []).append(i)
+        # Индекс строится и в пуле потоков: публикуем его целиком, а метку источника - последней,
+        # чтобы параллельный поиск не увидел новый источник со старыми списками вхождений
+        _search_index = search_index
+        _search_exact_names = exact_names
+        _search_vocab = list(postings)
+        _search_postings = list(postings.values())
+        _search_index_source = source
+    return _search_index
+
+def _match_plants_batch(search_index: List[_PlantSearchEntry], cleaned_query: str, query_words: List[str]) -> List[int]:
+    """
+    То же, что _entry_matches_query для каждого растения, но нечеткое сопоставление всех слов
+    запроса со словарём считается одним вызовом rapidfuzz cdist. Возвращает номера растений по порядку.
+    """
+    matched = set()
+    if cleaned_query:
+        matched.update(
+            i for i, entry in enumerate(search_index)
+            if cleaned_query in entry.search_text or cleaned_query in entry.base_name
+        )
+    
+    if query_words:
+        scores = None
+        if _search_vocab:
+            # Ниже score_cutoff cdist возвращает 0
+            scores = fuzz_process.cdist(
+                query_words, _search_vocab, scorer=Levenshtein.normalized_similarity,
+                processor=None, score_cutoff=FUZZY_MATCH_THRESHOLD, workers=-1,
+            )
+        
+        # Растение подходит, если КАЖДОЕ слово запроса входит в его текст или похоже на одно из его слов.
+        # Слово запроса без пробелов входит в текст только внутри одного из его слов, поэтому
+        # и точное вхождение проверяем по словарю, а растения берём из списков вхождений
+        candidates = None
+        for w, word in enumerate(query_words):
+            hits = {t for t, token in enumerate(_search_vocab) if word in token}
+            if scores is not None:
+                hits.update(np.flatnonzero(scores[w]).tolist())
+            word_plants = set().union(*(_search_postings[t] for t in hits))
+            
+            candidates = word_plants if candidates is None else candidates & word_plants
+            if not candidates:
+                break
+        matched |= candidates
+    
+    return sorted(matched)
+
+def search_plants_by_name(query_name: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
     """
     Выполняет прямой поиск растений по названию (тексту).
     Включает нечеткое сопоставление для обработки опечаток.
     
     Args:
         query_name: Поисковый запрос
+        limit: Вернуть не больше limit первых (в порядке каталога) совпадений; None - все
         
     Returns:
         List[Dict[str, Any]]: Список найденных растений
@@ -955,17 +1418,13 @@ def search_plants_by_name(query_name: str) -> List[Dict[str, Any]]:
         return []
     
     query_lower = query_name.lower().strip()
+    # Убираем лишние скобки, точки и т.п.
+    cleaned_query = _NAME_JUNK_RE.sub('', query_lower).strip()
+    
+    search_index = _get_search_index()
     
     # 1) Ищем точное совпадение (без учёта регистра)
-    exact_matches = []
-    for plant in plants_data:
-        name_lower = get_plant_name(plant).lower()
-        # Убираем лишние скобки, точки и т.п.
-        cleaned_plant_name = re.sub(r'[^\w\s\-/]+', '', name_lower).strip()
-        cleaned_query = re.sub(r'[^\w\s\-/]+', '', query_lower).strip()
-        
-        if cleaned_plant_name == cleaned_query:
-            exact_matches.append(plant)
+    exact_matches = [plants_data[i] for i in _search_exact_names.get(cleaned_query, ())[:limit]]
     
     if exact_matches:
         logger.info(f"Найдено {len(exact_matches)} точных совпадений по запросу '{query_name}'")
@@ -973,17 +1432,31 @@ def search_plants_by_name(query_name: str) -> List[Dict[str, Any]]:
     
     # 2) Для нечеткого сопоставления подготавливаем ключевые слова
     query_words = prepare_query_words(query_lower)
+    query_text = query_lower.translate(_PUNCTUATION_TABLE).strip()
     
     # 3) Пробуем нечеткое сопоставление
-    matching_plants = []
-    for plant in plants_data:
-        if is_plant_matching_query(plant, query_lower, query_words):
-            # Убираем фильтрацию по остатку > 0, добавляем все совпадения
-            matching_plants.append(plant)
+    # Убираем фильтрацию по остатку > 0, добавляем все совпадения
+    if fuzz_process is not None:
+        matching_plants = [plants_data[i] for i in _match_plants_batch(search_index, query_text, query_words)[:limit]]
+    else:
+        # Без rapidfuzz проверяем растения по одному и останавливаемся на limit совпадениях
+        matching_plants = list(islice(
+            (plant for plant, entry in zip(plants_data, search_index)
+             if _entry_matches_query(entry, query_text, query_words)),
+            limit,
+        ))
     
     logger.info(f"Найдено {len(matching_plants)} растений по запросу '{query_name}' (нечеткое сопоставление)")
     return matching_plants
 
+# Множественное число (для русского языка): последняя буква слова -> чем её заменить.
+# фикусы -> фикус, кактуси -> кактус, деревья -> дерев и дерево
+_PLURAL_ENDING_VARIANTS = {
+    'ы': ('',),
+    'и': ('',),
+    'я': ('', 'о'),
+}
+
 def prepare_query_words(query: str) -> List[str]:
     """
     Подготавливает список ключевых слов для поиска из запроса.
@@ -996,45 +1469,37 @@ def prepare_query_words(query: str) -> List[str]:
         List[str]: Список ключевых слов
     """
     # Удаляем знаки препинания и разбиваем на слова
-    query_words = query.translate(str.maketrans('', '', string.punctuation)).split()
+    query_words = query.translate(_PUNCTUATION_TABLE).split()
     
-    # Обрабатываем варианты слов
-    word_variants = []
+    # Обрабатываем варианты слов: оригинальное слово и формы из _PLURAL_ENDING_VARIANTS
+    word_variants = set()
     
     for word in query_words:
-        # Добавляем оригинальное слово
-        word_variants.append(word)
-        
-        # Проверяем на множественное число (для русского языка)
+        word_variants.add(word)
         if len(word) >= 4:
-            if word.endswith('ы'):
-                word_variants.append(word[:-1])  # фикусы -> фикус
-            elif word.endswith('и'):
-                word_variants.append(word[:-1])  # кактуси -> кактус
-            elif word.endswith('я'):
-                word_variants.append(word[:-1])  # деревья -> дерев + я
-                word_variants.append(word[:-1] + 'о')  # деревья -> дерево
-            elif word.endswith('ии'):
-                word_variants.append(word[:-2] + 'ия')  # лилии -> лилия
-            elif word.endswith('сы'):
-                word_variants.append(word[:-2] + 'с')  # фикусы -> фикус
-    
-    # Оставляем только значимые слова (длиной >= 3) и убираем дубликаты
-    return list(set([w for w in word_variants if len(w) >= 3]))
-
-def levenshtein_distance(s1: str, s2: str) -> int:
+            for ending in _PLURAL_ENDING_VARIANTS.get(word[-1], ()):
+                word_variants.add(word[:-1] + ending)
+    
+    # Оставляем только значимые слова (длиной >= 3)
+    return [w for w in word_variants if len(w) >= 3]
+
+def levenshtein_distance(s1: str, s2: str, max_distance: Optional[int] = None) -> int:
     """
     Вычисляет расстояние Левенштейна между двумя строками.
+    Запасная реализация на случай, когда rapidfuzz не установлен.
     
     Args:
         s1: Первая строка
         s2: Вторая строка
+        max_distance: Если задано, расчёт прекращается, как только расстояние
+            заведомо больше max_distance; тогда возвращается max_distance + 1
         
     Returns:
         int: Расстояние Левенштейна
     """
+    # Внутренний цикл - по более короткой строке
     if len(s1) < len(s2):
-        return levenshtein_distance(s2, s1)
+        s1, s2 = s2, s1
     
     if len(s2) == 0:
         return len(s1)
@@ -1047,6 +1512,9 @@ def levenshtein_distance(s1: str, s2: str) -> int:
             deletions = current_row[j] + 1
             substitutions = previous_row[j] + (c1 != c2)
             current_row.append(min(insertions, deletions, substitutions))
+        # Минимум строки не убывает: если он уже больше порога, итог тоже больше
+        if max_distance is not None and min(current_row) > max_distance:
+            return max_distance + 1
         previous_row = current_row
     
     return previous_row[-1]
@@ -1065,6 +1533,10 @@ def fuzzy_string_match(s1: str, s2: str) -> float:
     if not s1 or not s2:
         return 0.0
     
+    if Levenshtein is not None:
+        # То же 1 - расстояние / длина большей строки
+        return Levenshtein.normalized_similarity(s1, s2)
+    
     distance = levenshtein_distance(s1, s2)
     max_len = max(len(s1), len(s2))
     
@@ -1087,57 +1559,59 @@ def is_plant_matching_query(plant: Dict[str, Any], query: str, query_words: List
     Returns:
         bool: True, если растение соответствует запросу
     """
-    # Получаем текстовые поля для поиска
-    plant_name = plant.get("name", "").lower() if isinstance(plant.get("name"), str) else ""
-    plant_type = plant.get("Растение", "").lower() if isinstance(plant.get("Растение"), str) else ""
-    plant_title = plant.get("Название", "").lower() if isinstance(plant.get("Название"), str) else ""
-    plant_care = plant.get("Уход (список)", "").lower() if isinstance(plant.get("Уход (список)"), str) else ""
-    plant_article = plant.get("article", "").lower() if isinstance(plant.get("article"), str) else ""
-    plant_folder = plant.get("folder", "").lower() if isinstance(plant.get("folder"), str) else ""
-    plant_group = plant.get("group", "").lower() if isinstance(plant.get("group"), str) else ""
-    plant_pot = plant.get("Кашпо/Горшок", "").lower() if isinstance(plant.get("Кашпо/Горшок"), str) else ""
-    plant_light = plant.get("Освещение", "").lower() if isinstance(plant.get("Освещение"), str) else ""
-    plant_water = plant.get("Полив", "").lower() if isinstance(plant.get("Полив"), str) else ""
-    plant_tag = plant.get("Тег (Народное название)", "").lower() if isinstance(plant.get("Тег (Народное название)"), str) else ""
-    
-    # Объединяем все текстовые поля для поиска
-    search_text = f"{plant_name} {plant_type} {plant_title} {plant_care} {plant_article} {plant_folder} {plant_group} {plant_pot} {plant_light} {plant_water} {plant_tag}".strip()
-    
-    # Базовое имя растения (без размеров)
-    effective_name = plant_name if plant_name else plant_title
-    base_name, _, _ = extract_plant_base_name(effective_name)
+    return _entry_matches_query(
+        _plant_search_entry(plant), query.translate(_PUNCTUATION_TABLE).strip(), query_words
+    )
+
+def _word_matches_fuzzy(word: str, text: str, text_words: Tuple[str, ...]) -> bool:
+    """Проверяет вхождение слова в текст: сначала точное, затем нечеткое по словам текста."""
+    # Сначала проверяем точное вхождение
+    if word in text:
+        return True
     
-    # Проверяем точное вхождение всего запроса
-    cleaned_query = query.translate(str.maketrans('', '', string.punctuation)).strip()
+    # Если точного вхождения нет, проверяем нечеткое соответствие
+    if fuzz_process is not None:
+        # Один вызов на все слова текста; score_cutoff отсекает кандидатов, не досчитывая расстояние
+        match = fuzz_process.extractOne(
+            word, text_words, scorer=Levenshtein.normalized_similarity,
+            processor=None, score_cutoff=FUZZY_MATCH_THRESHOLD,
+        )
+        if match is not None:
+            logger.debug(f"Нечеткое совпадение: '{word}' ~ '{match[0]}' (score: {match[1]:.2f})")
+            return True
+        return False
+    
+    word_len = len(word)
+    for text_word in text_words:
+        max_len = max(word_len, len(text_word))
+        # Порог сходства в терминах расстояния (с запасом на округление float).
+        # Расстояние не меньше разницы длин - такие пары отбрасываем без расчёта
+        max_distance = int((1.0 - FUZZY_MATCH_THRESHOLD) * max_len + 1e-9)
+        if abs(word_len - len(text_word)) > max_distance:
+            continue
+        match_score = 1.0 - levenshtein_distance(word, text_word, max_distance) / max_len
+        if match_score >= FUZZY_MATCH_THRESHOLD:
+            logger.debug(f"Нечеткое совпадение: '{word}' ~ '{text_word}' (score: {match_score:.2f})")
+            return True
     
-    if cleaned_query and (cleaned_query in search_text or cleaned_query in base_name):
+    return False
+
+def _entry_matches_query(entry: _PlantSearchEntry, cleaned_query: str, query_words: List[str]) -> bool:
+    """
+    Тело is_plant_matching_query над уже нормализованными полями растения.
+    cleaned_query - запрос без знаков препинания.
+    """
+    # Проверяем точное вхождение всего запроса
+    if cleaned_query and (cleaned_query in entry.search_text or cleaned_query in entry.base_name):
         return True
     
     # Проверяем вхождение ВСЕХ отдельных слов
     if query_words:
-        # Функция для проверки нечеткого соответствия слова в тексте
-        def word_matches_fuzzy(word: str, text: str) -> bool:
-            # Сначала проверяем точное вхождение
-            if word in text:
-                return True
-            
-            # Если точного вхождения нет, проверяем нечеткое соответствие
-            for text_word in text.split():
-                match_score = fuzzy_string_match(word, text_word)
-                if match_score >= FUZZY_MATCH_THRESHOLD:
-                    logger.debug(f"Нечеткое совпадение: '{word}' ~ '{text_word}' (score: {match_score:.2f})")
-                    return True
-            
-            return False
-        
-        # Счетчик найденных слов
-        found_words = 0
-        for word in query_words:
-            if word_matches_fuzzy(word, search_text) or word_matches_fuzzy(word, base_name):
-                found_words += 1
-        
-        # Все слова из запроса должны быть найдены
-        return found_words == len(query_words)
+        return all(
+            _word_matches_fuzzy(word, entry.search_text, entry.search_words)
+            or _word_matches_fuzzy(word, entry.base_name, entry.base_words)
+            for word in query_words
+        )
     
     return False
 
@@ -1153,21 +1627,11 @@ def generate_symbolic_code(name: str) -> str:
         str: Символьный код для растения
     """
     # Переводим в нижний регистр и удаляем квадратные скобки с числами
-    name = re.sub(r'\[\d+\]', '', name.lower())
+    name = _BRACKET_NUM_RE.sub('', name.lower())
     
     # Удаляем знаки препинания и заменяем пробелы на подчеркивания
-    name = re.sub(r'[^\w\s]', '', name)
-    code = re.sub(r'\s+', '_', name.strip())
-    
-    # Транслитерация кириллицы в латиницу (пример реализации)
-    rus_chars = {'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
-                 'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
-                 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
-                 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
-                 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'}
-    
-    transliterated = ''
-    for char in code:
-        transliterated += rus_chars.get(char, char)
+    name = _NON_WORD_RE.sub('', name)
+    code = _WHITESPACE_RE.sub('_', name.strip())
     
-    return transliterated
+    # Транслитерация кириллицы в латиницу
+    return code.translate(_TRANSLIT_TABLE)
@@ -1,74 +1,192 @@
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode, ChatMemberStatus
+from aiogram.exceptions import TelegramRetryAfter
 import config
 import logging
-import requests
-from datetime import datetime
-import json
+import httpx
+from typing import Optional
+import operator
+import orjson
+import re
 import time
 import asyncio
 
 logger = logging.getLogger(__name__)
 
-try:
-    bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    logger.info("Телеграм-бот успешно инициализирован")
-except Exception as e:
-    logger.error(f"Не удалось инициализировать Телеграм-бот: {e}")
+# Максимум одновременных соединений сессии бота с api.telegram.org
+TELEGRAM_CONNECTION_LIMIT = 100
+
+# Таймаут запросов к API MessageGateway, секунд
+API_TIMEOUT = 5.0
+# HTTP-методы, которые поддерживает api_request
+API_METHODS = frozenset({"GET", "POST", "PATCH"})
+# Повторы при сетевых ошибках и временных ответах API: число попыток и первая задержка
+# (удваивается с каждой попыткой), секунд
+API_RETRY_ATTEMPTS = 3
+API_RETRY_BASE_DELAY = 0.2
+API_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Общий клиент с пулом соединений: TCP/TLS-рукопожатие с API не повторяется на каждый запрос
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Кэш онлайн-менеджеров: id группы -> (время проверки, список менеджеров)
+ONLINE_MANAGERS_TTL = 15.0  # секунд
+_online_managers_cache: dict[int, tuple[float, list]] = {}
+
+# Кэш найденных диалогов: ID диалога -> (время проверки, диалог)
+DIALOG_CACHE_TTL = 5.0  # секунд
+DIALOG_CACHE_MAX_SIZE = 512
+_dialog_cache: dict[str, tuple[float, dict]] = {}
+
+# Признаки корпоративного заказа: в теме обращения и в деталях заказа
+_B2B_SUBJECT_RE = re.compile(r"офис|b2b", re.IGNORECASE)
+_B2B_DETAILS_RE = re.compile(r"цветы в офис|растения для офиса", re.IGNORECASE)
+
+# Поля контекста диалога для уведомления и значения, если поля нет
+_CONTEXT_FIELDS = (
+    "chat_id", "dialog_id", "subject", "channel_info", "user_info",
+    "selected_plants", "out_of_stock_plant", "preorder_info", "order_details",
+)
+_CONTEXT_DEFAULTS = (None, None, "", {}, {}, [], {}, {}, {})
+# ChatContext на __slots__ (без __dict__): все поля читаем одним вызовом attrgetter
+_get_context_fields = operator.attrgetter(*_CONTEXT_FIELDS)
+
+# Ключ выбора менеджера: число активных диалогов (вызов на C без lambda, словари не меняем)
+_active_dialogs = operator.methodcaller("get", "activeDialogs", 0)
+
+# Заголовки уведомления продавцу: заказ, обращение с темой, предзаказ
+_HEADERS = (
+    "🔔 <b>Новый заказ!</b>\n\n",
+    "🔔 <b>Обращение клиента!</b>\n\n",
+    "🔔 <b>Новый ПРЕДЗАКАЗ!</b>\n\n",
+)
+
+# Подтверждения клиенту после отправки уведомления
+_CONFIRM_PREORDER = "Ура! Ваш предзаказ успешно оформлен! 🎉 Растение будет доступно в течение 7-10 дней. Я лично прослежу, чтобы с вами связались для подтверждения заказа и уточнения деталей доставки. Спасибо, что выбрали наш магазин! 💚"
+_CONFIRM_ORDER = "Отлично! Ваш заказ успешно оформлен! 🎉 Я уже передала информацию нашему менеджеру, и с вами скоро свяжутся. Если возникнут вопросы, обращайтесь в любое время! Спасибо за выбор нашего магазина! 💚"
+
+# Телеграм-бот создаётся при первой отправке, чтобы импорт модуля не читал .env
+bot: Optional[Bot] = None
+
+
+def _get_bot() -> Bot:
+    """Возвращает общий Телеграм-бот, создавая его при первом обращении."""
+    global bot
+    if bot is None:
+        try:
+            # Одна сессия на процесс: уведомления идут по уже открытым keep-alive соединениям
+            bot = Bot(
+                token=config.BOT_TOKEN,
+                session=AiohttpSession(limit=TELEGRAM_CONNECTION_LIMIT),
+                default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+            )
+        except Exception as e:
+            logger.error(f"Не удалось инициализировать Телеграм-бот: {e}")
+            raise
+        logger.info("Телеграм-бот успешно инициализирован")
+    return bot
 
 
 # SELLER_CHAT_ID = -1002540034535 # Эту строку можно удалить, так как теперь используются переменные из config
 
-def api_request(method, endpoint, params=None, json_data=None, headers=None):
+def _get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx.AsyncClient, создавая его при первом обращении."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            http2=True,
+            timeout=API_TIMEOUT,
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """Закрывает общий HTTP-клиент и сессию Телеграм-бота (при остановке бота)."""
+    global _http_client, bot
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if bot is not None:
+        await bot.session.close()
+        bot = None
+
+
+async def api_request(method, endpoint, params=None, json_data=None, headers=None):
     """Универсальная функция для запросов к API"""
     try:
-        base_url = config.MG_URL if endpoint.startswith("/users") else config.API_URL
-        url = f"{base_url}{endpoint}"
+        if method not in API_METHODS:
+            return None, f"Неподдерживаемый метод: {method}"
+
+        is_users = endpoint.startswith("/users")
+        url = f"{config.MG_URL if is_users else config.API_URL}{endpoint}"
 
         if not headers:
-            headers = {"X-Bot-Token": config.MG_TOKEN if endpoint.startswith("/users") else config.RETAIL_CRM_BOT_TOKEN}
-
-        if method == "GET":
-            resp = requests.get(url, params=params, headers=headers, timeout=5)
-        elif method == "POST":
-            resp = requests.post(url, json=json_data, headers=headers, timeout=5)
-        elif method == "PATCH":
-            resp = requests.patch(url, json=json_data, headers=headers, timeout=5)
-        else:
-            return None, f"Неподдерживаемый метод: {method}"
+            headers = {"X-Bot-Token": config.MG_TOKEN if is_users else config.RETAIL_CRM_BOT_TOKEN}
+
+        client = _get_http_client()
+        for attempt in range(1, API_RETRY_ATTEMPTS + 1):
+            try:
+                resp = await client.request(method, url, params=params, json=json_data, headers=headers)
+            except httpx.TransportError as e:
+                if attempt == API_RETRY_ATTEMPTS:
+                    raise
+                logger.warning("[api_request] %s %s: %s, повтор %d/%d",
+                               method, endpoint, e, attempt, API_RETRY_ATTEMPTS - 1)
+            else:
+                if resp.status_code not in API_RETRY_STATUSES or attempt == API_RETRY_ATTEMPTS:
+                    break
+                logger.warning("[api_request] %s %s: HTTP %s, повтор %d/%d",
+                               method, endpoint, resp.status_code, attempt, API_RETRY_ATTEMPTS - 1)
+            await asyncio.sleep(API_RETRY_BASE_DELAY * 2 ** (attempt - 1))
 
         if resp.status_code in [200, 201, 204]:
-            return resp.json() if resp.content else {}, None
+            # orjson разбирает байты ответа напрямую, без промежуточной строки
+            return orjson.loads(resp.content) if resp.content else {}, None
 
         error = f"HTTP {resp.status_code}: {resp.text}"
-        logger.error(f"[api_request] {error}")
+        logger.error("[api_request] %s", error)
         return None, error
 
     except Exception as e:
-        logger.error(f"[api_request] Ошибка: {e}")
+        logger.error("[api_request] Ошибка: %s", e)
         return None, str(e)
 
 
-def get_online_managers(group):
-    """Возвращает список онлайн-менеджеров указанной группы"""
+def _response_items(data, key):
+    """Список объектов из ответа API: сам список или поле key объекта-обёртки."""
+    if isinstance(data, dict):
+        return data.get(key, []) or []
+    return data if isinstance(data, list) else []
+
+
+async def get_online_managers(group):
+    """Возвращает список онлайн-менеджеров указанной группы, обращаясь к API не чаще раза в ONLINE_MANAGERS_TTL"""
+    now_ts = time.monotonic()
+    cached = _online_managers_cache.get(group)
+    if cached and now_ts - cached[0] < ONLINE_MANAGERS_TTL:
+        return cached[1]
+
     params = {"group": group, "online": 1, "active": 1, "limit": 50}
-    data, error = api_request("GET", "/users", params=params)
+    data, error = await api_request("GET", "/users", params=params)
 
+    # Ошибку не кэшируем: следующий вызов снова спросит API
     if error:
         return []
 
-    if isinstance(data, dict):
-        return data.get('users', []) or []
-    return data if isinstance(data, list) else []
+    managers = _response_items(data, 'users')
+    _online_managers_cache[group] = (now_ts, managers)
+    return managers
 
 
 def choose_manager(managers):
     """Выбирает менеджера с наименьшим количеством активных диалогов"""
-    return min(managers, key=lambda u: u.get("activeDialogs", 0)) if managers else None
+    return min(managers, key=_active_dialogs) if managers else None
 
 
-def assign_dialog_to_manager(dialog_id, user_id):
+async def assign_dialog_to_manager(dialog_id, user_id):
     """Назначает диалог MessageGateway‑бота конкретному менеджеру"""
     headers = {
         "X-Bot-Token": config.RETAIL_CRM_BOT_TOKEN,
@@ -76,78 +194,112 @@ def assign_dialog_to_manager(dialog_id, user_id):
     }
     payload = {"user_id": int(user_id)}
 
-    data, error = api_request("PATCH", f"/dialogs/{dialog_id}/assign", json_data=payload, headers=headers)
+    data, error = await api_request("PATCH", f"/dialogs/{dialog_id}/assign", json_data=payload, headers=headers)
 
     if not error:
-        logger.info(f"[assign_dialog_to_manager] Диалог {dialog_id} → менеджер {user_id}")
+        logger.info("[assign_dialog_to_manager] Диалог %s → менеджер %s", dialog_id, user_id)
+        # У менеджера стало больше активных диалогов, а у диалога - ответственный
+        _online_managers_cache.clear()
+        _dialog_cache.clear()
         return True
     return False
 
 
-def get_dialog_by_id(dialog_id, debug=False):
-    """Получает диалог по его ID - оптимизированная версия"""
+async def get_dialog_by_id(dialog_id, debug=False):
+    """Получает диалог по его ID; найденный диалог кэшируется на DIALOG_CACHE_TTL секунд"""
     dialog_id_str = str(dialog_id)
+    cached = _dialog_cache.get(dialog_id_str)
+    if cached and time.monotonic() - cached[0] < DIALOG_CACHE_TTL:
+        return cached[1]
+
+    dialog = await _fetch_dialog_by_id(dialog_id, dialog_id_str)
+    if dialog is not None:
+        if len(_dialog_cache) >= DIALOG_CACHE_MAX_SIZE:
+            _dialog_cache.clear()
+        _dialog_cache[dialog_id_str] = (time.monotonic(), dialog)
+    return dialog
+
+
+async def _fetch_dialog_by_id(dialog_id, dialog_id_str):
+    """Ищет диалог через API: прямым запросом, параметром id, затем по первым страницам списка"""
 
     # Сначала пробуем прямой запрос по ID (если API поддерживает)
-    logger.info(f"[get_dialog_by_id] Поиск диалога {dialog_id}")
-    data, error = api_request("GET", f"/dialogs/{dialog_id}")
+    logger.info("[get_dialog_by_id] Поиск диалога %s", dialog_id)
+    data, error = await api_request("GET", f"/dialogs/{dialog_id}")
 
     if not error and data:
-        logger.info(f"[get_dialog_by_id] Диалог {dialog_id} найден прямым запросом")
+        logger.info("[get_dialog_by_id] Диалог %s найден прямым запросом", dialog_id)
         return data
 
     # Если прямой запрос не сработал, пробуем с параметром id
-    data, error = api_request("GET", "/dialogs", params={"id": dialog_id})
+    data, error = await api_request("GET", "/dialogs", params={"id": dialog_id})
 
     if not error and data:
         # API может вернуть список или один объект
         if isinstance(data, list) and data:
-            logger.info(f"[get_dialog_by_id] Диалог {dialog_id} найден через параметр id (список)")
+            logger.info("[get_dialog_by_id] Диалог %s найден через параметр id (список)", dialog_id)
             return data[0]
         elif isinstance(data, dict):
-            logger.info(f"[get_dialog_by_id] Диалог {dialog_id} найден через параметр id (объект)")
+            logger.info("[get_dialog_by_id] Диалог %s найден через параметр id (объект)", dialog_id)
             return data
 
     # Если ничего не помогло, используем старый метод с ограничением
-    logger.info(f"[get_dialog_by_id] Переход к поиску по страницам для диалога {dialog_id}")
+    logger.info("[get_dialog_by_id] Переход к поиску по страницам для диалога %s", dialog_id)
 
-    page = 1
     limit = 100
     max_pages = 5  # Уменьшили лимит страниц для быстрого поиска
 
-    while page <= max_pages:
-        data, error = api_request("GET", "/dialogs", params={"limit": limit, "page": page})
-
+    # API отдаёт chat_id числом: сравниваем с числом без str() на каждый диалог,
+    # строковое сравнение оставляем для строковых chat_id
+    try:
+        dialog_id_num = int(dialog_id_str)
+    except ValueError:
+        dialog_id_num = dialog_id_str
+    if str(dialog_id_num) != dialog_id_str:
+        dialog_id_num = dialog_id_str  # "007" и т.п. раньше не совпадали с числом 7
+
+    # Первую страницу запрашиваем отдельно: диалог часто на ней, а пагинация в ответе
+    # говорит, сколько страниц есть. Остальные (не дальше последней) - одновременно
+    pages = [await api_request("GET", "/dialogs", params={"limit": limit, "page": 1})]
+
+    # Разбираем по порядку страниц, как при последовательном обходе
+    page = 0
+    while page < len(pages):
+        data, error = pages[page]
+        page += 1
         if error:
-            logger.error(f"[get_dialog_by_id] Ошибка получения диалогов (стр. {page}): {error}")
+            logger.error("[get_dialog_by_id] Ошибка получения диалогов (стр. %s): %s", page, error)
             return None
 
         # Определяем диалоги в зависимости от формата ответа
-        dialogs = []
+        dialogs = _response_items(data, 'dialogs')
+        page_count = max_pages
         if isinstance(data, dict):
-            dialogs = data.get('dialogs', []) or []
             # Проверяем пагинацию
             pagination = data.get('pagination', {})
-            if pagination.get('currentPage') == pagination.get('totalPageCount'):
-                page = max_pages  # Последняя страница
-        elif isinstance(data, list):
-            dialogs = data
-            if len(dialogs) < limit:
-                page = max_pages  # Последняя страница
+            last_page = pagination.get('currentPage') == pagination.get('totalPageCount')
+            if isinstance(pagination.get('totalPageCount'), int):
+                page_count = min(pagination['totalPageCount'], max_pages)
+        else:
+            last_page = len(dialogs) < limit
 
         # Ищем диалог по chat_id
         for dialog in dialogs:
-            if str(dialog.get('chat_id')) == dialog_id_str:
-                logger.info(f"[get_dialog_by_id] Диалог {dialog_id} найден на странице {page}")
+            chat_id = dialog.get('chat_id')
+            if chat_id == dialog_id_num or chat_id == dialog_id_str:
+                logger.info("[get_dialog_by_id] Диалог %s найден на странице %s", dialog_id, page)
                 return dialog
 
-        if not dialogs:
+        if not dialogs or last_page:
             break
 
-        page += 1
-        time.sleep(0.1)  # Уменьшили задержку
+        if page == 1:
+            pages += await asyncio.gather(*(
+                api_request("GET", "/dialogs", params={"limit": limit, "page": next_page})
+                for next_page in range(2, page_count + 1)
+            ))
 
-    logger.warning(f"[get_dialog_by_id] Диалог {dialog_id} не найден")
+    logger.warning("[get_dialog_by_id] Диалог %s не найден", dialog_id)
     return None
 
 
@@ -167,117 +319,104 @@ def get_context_info(context):
             "dialog_id": None
         }
 
-    chat_id = getattr(context, "chat_id", None)
-    dialog_id = getattr(context, "dialog_id", None)
+    try:
+        values = _get_context_fields(context)
+    except AttributeError:
+        # Контекст другого типа, где части полей нет
+        values = tuple(getattr(context, name, default) for name, default in zip(_CONTEXT_FIELDS, _CONTEXT_DEFAULTS))
+    chat_id, dialog_id = values[0], values[1]
 
     # Логируем полученные ID
     if chat_id:
-        logger.info(f"[get_context_info] Получен chat_id: {chat_id}")
+        logger.info("[get_context_info] Получен chat_id: %s", chat_id)
     else:
         logger.warning("[get_context_info] chat_id отсутствует в контексте")
 
     if dialog_id:
-        logger.info(f"[get_context_info] Получен dialog_id: {dialog_id}")
+        logger.info("[get_context_info] Получен dialog_id: %s", dialog_id)
     else:
         logger.debug("[get_context_info] dialog_id отсутствует в контексте")
 
-    result = {
-        "chat_id": chat_id,
-        "dialog_id": dialog_id,
-        "subject": getattr(context, "subject", ""),
-        "channel_info": getattr(context, "channel_info", {}),
-        "user_info": getattr(context, "user_info", {}),
-        "selected_plants": getattr(context, "selected_plants", []),
-        "out_of_stock_plant": getattr(context, "out_of_stock_plant", {}),
-        "preorder_info": getattr(context, "preorder_info", {}),
-        "order_details": getattr(context, "order_details", {})
-    }
-    return result
+    return dict(zip(_CONTEXT_FIELDS, values))
 
 
 def is_b2b_order(context_info, order_details):
     """Определяет, является ли заказ корпоративным (B2B)"""
-    if "офис" in context_info["subject"].lower() or "b2b" in context_info["subject"].lower():
-        return True
-    if "цветы в офис" in order_details.lower() or "растения для офиса" in order_details.lower():
-        return True
-    return False
+    # Один проход по каждой строке без копий в нижнем регистре
+    return bool(_B2B_SUBJECT_RE.search(context_info["subject"]) or _B2B_DETAILS_RE.search(order_details))
 
 
-def format_seller_message(context_info, order_details, is_preorder, is_b2b, assignment_result=None):
+def format_seller_message(context_info, order_details, is_preorder, is_b2b, assignment_result=None, dialog_id=None):
     """Формирует сообщение для продавца"""
-    if is_preorder:
-        message = "🔔 <b>Новый ПРЕДЗАКАЗ!</b>\n\n"
-    elif context_info["subject"]:
-        message = "🔔 <b>Обращение клиента!</b>\n\n"
-    else:
-        message = "🔔 <b>Новый заказ!</b>\n\n"
+    # Части собираем в список и склеиваем один раз в конце
+    parts = [_HEADERS[2 if is_preorder else 1 if context_info["subject"] else 0]]
 
     if context_info["subject"]:
-        message += f"<b>Тема:</b> {context_info['subject']}\n\n"
+        parts.append(f"<b>Тема:</b> {context_info['subject']}\n\n")
 
-    message += f"<b>Тип клиента:</b> {'B2B' if is_b2b else 'B2C'}\n\n"
+    parts.append(f"<b>Тип клиента:</b> {'B2B' if is_b2b else 'B2C'}\n\n")
 
     # Информация о клиенте
     if context_info["chat_id"]:
-        message += f"<b>Информация о клиенте:</b>\n"
-        message += f"• ID чата: <code>{context_info['chat_id']}</code>\n"
+        parts.append("<b>Информация о клиенте:</b>\n")
+        if dialog_id:
+            parts.append(f"• ID диалога: <code>{dialog_id}</code>\n")
+        parts.append(f"• ID чата: <code>{context_info['chat_id']}</code>\n")
 
         if context_info["channel_info"]:
             channel_name = context_info["channel_info"].get('name', 'Неизвестный канал')
             channel_id = context_info["channel_info"].get('id', 'Неизвестный ID')
-            message += f"• Канал: {channel_name} (ID: {channel_id})\n"
+            parts.append(f"• Канал: {channel_name} (ID: {channel_id})\n")
 
         if context_info["user_info"]:
             user_name = context_info["user_info"].get('name', 'Неизвестный пользователь')
             user_id = context_info["user_info"].get('id', 'Неизвестный ID')
-            message += f"• Клиент: {user_name} (ID: {user_id})\n"
+            parts.append(f"• Клиент: {user_name} (ID: {user_id})\n")
 
         # Информация о растениях для обычного заказа
         if not is_preorder and context_info["selected_plants"]:
-            message += f"• Выбранные растения: {len(context_info['selected_plants'])} шт.\n"
+            parts.append(f"• Выбранные растения: {len(context_info['selected_plants'])} шт.\n")
             for i, plant in enumerate(context_info["selected_plants"], 1):
-                plant_name = plant.get("Название", "Неизвестное растение")
-                message += f"  {i}. {plant_name}\n"
+                parts.append(f"  {i}. {plant.get('Название', 'Неизвестное растение')}\n")
 
     # Для предзаказа добавляем специальную информацию
     if is_preorder:
-        message += f"\n<b>ПРЕДЗАКАЗ (поставка через 7-10 дней):</b>\n"
+        parts.append("\n<b>ПРЕДЗАКАЗ (поставка через 7-10 дней):</b>\n")
 
         if context_info["out_of_stock_plant"]:
             plant = context_info["out_of_stock_plant"]
-            message += f"• Растение: {plant.get('Название', 'Неизвестное растение')}\n"
+            parts.append(f"• Растение: {plant.get('Название', 'Неизвестное растение')}\n")
             if 'Цена' in plant:
-                message += f"• Цена: {plant['Цена']}\n"
+                parts.append(f"• Цена: {plant['Цена']}\n")
             if 'Ссылка' in plant and plant['Ссылка']:
-                message += f"• Ссылка: {plant['Ссылка']}\n"
+                parts.append(f"• Ссылка: {plant['Ссылка']}\n")
 
         if context_info["preorder_info"]:
             for key, value in context_info["preorder_info"].items():
                 if key not in ('is_preorder', 'plant_name'):
-                    message += f"• {key}: {value}\n"
+                    parts.append(f"• {key}: {value}\n")
 
     # Детали заказа
     if context_info["order_details"]:
-        message += f"\n<b>Детали заказа:</b>\n"
+        parts.append("\n<b>Детали заказа:</b>\n")
         for key, value in context_info["order_details"].items():
-            message += f"• {key}: {value}\n"
+            parts.append(f"• {key}: {value}\n")
 
     # Результат назначения диалога
     if assignment_result:
-        message += f"\n<b>Назначение диалога:</b>\n• {assignment_result['message']}\n"
+        parts.append(f"\n<b>Назначение диалога:</b>\n• {assignment_result['message']}\n")
 
     # Дополнительная информация
-    message += f"\n<b>Дополнительная информация:</b>\n{order_details}"
+    parts.append(f"\n<b>Дополнительная информация:</b>\n{order_details}")
 
     # Временная метка
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    message += f"\n\n<i>Заказ получен: {current_time}</i>"
+    current_time = time.strftime("%Y-%m-%d %H:%M:%S")
+    parts.append(f"\n\n<i>Заказ получен: {current_time}</i>")
 
-    return message
+    return "".join(parts)
 
 
-def handle_manager_assignment(is_b2b=False, target_dialog_id=None):
+async def handle_manager_assignment(is_b2b=False, target_dialog_id=None):
     """Обрабатывает назначение диалога соответствующему менеджеру
 
     Args:
@@ -286,37 +425,39 @@ def handle_manager_assignment(is_b2b=False, target_dialog_id=None):
     """
     try:
         logger.info(
-            f"[handle_manager_assignment] Вызов с параметрами: is_b2b={is_b2b}, target_dialog_id={target_dialog_id}")
+            "[handle_manager_assignment] Вызов с параметрами: is_b2b=%s, target_dialog_id=%s", is_b2b, target_dialog_id)
 
         # Если не указан конкретный диалог, возвращаем ошибку
         if not target_dialog_id:
             logger.error("[handle_manager_assignment] Не указан ID диалога")
             return {"status": "error", "message": "Не указан ID диалога для назначения менеджера"}
 
+        # Группа менеджеров зависит только от типа запроса, поэтому диалог и
+        # онлайн-менеджеров запрашиваем одновременно
+        manager_group = config.MANAGER_B2B if is_b2b else config.MANAGER_B2C
+        dialog, managers = await asyncio.gather(
+            get_dialog_by_id(target_dialog_id), get_online_managers(manager_group.id)
+        )
+
         # Проверяем существование диалога
-        dialog = get_dialog_by_id(target_dialog_id)
         if not dialog:
-            logger.warning(f"[handle_manager_assignment] Диалог {target_dialog_id} не найден")
+            logger.warning("[handle_manager_assignment] Диалог %s не найден", target_dialog_id)
             return {"status": "error", "message": f"Диалог {target_dialog_id} не найден"}
 
         # Проверяем, не назначен ли диалог уже менеджеру
         if isinstance(dialog, dict) and dialog.get("responsible", {}).get("type") == "user":
-            logger.warning(f"[handle_manager_assignment] Диалог {target_dialog_id} уже назначен менеджеру")
+            logger.warning("[handle_manager_assignment] Диалог %s уже назначен менеджеру", target_dialog_id)
             return {"status": "warning", "message": "Диалог уже назначен менеджеру"}
 
-        # Выбираем группу менеджеров в зависимости от типа запроса
-        manager_group = config.MANAGER_B2B if is_b2b else config.MANAGER_B2C
-        managers = get_online_managers(manager_group["id"])
-
         if not managers:
             return {
                 "status": "warning",
-                "message": f"Нет онлайн-менеджеров группы {manager_group['group']}. Диалог остается в очереди."
+                "message": f"Нет онлайн-менеджеров группы {manager_group.group}. Диалог остается в очереди."
             }
 
         target_manager = choose_manager(managers)
 
-        if assign_dialog_to_manager(dialog['id'], target_manager["id"]):
+        if await assign_dialog_to_manager(dialog['id'], target_manager["id"]):
             # Формируем имя менеджера из first_name и last_name
             manager_name = f"{target_manager.get('first_name', '')} {target_manager.get('last_name', '')}"
             if not manager_name.strip():  # Если имя пустое, используем запасной вариант
@@ -324,7 +465,7 @@ def handle_manager_assignment(is_b2b=False, target_dialog_id=None):
 
             return {
                 "status": "success",
-                "message": f"Диалог {target_dialog_id} назначен менеджеру {manager_name} группы {manager_group['group']}"
+                "message": f"Диалог {target_dialog_id} назначен менеджеру {manager_name} группы {manager_group.group}"
             }
         else:
             return {
@@ -333,14 +474,30 @@ def handle_manager_assignment(is_b2b=False, target_dialog_id=None):
             }
 
     except Exception as e:
-        logger.error(f"[handle_manager_assignment] Ошибка: {e}")
+        logger.error("[handle_manager_assignment] Ошибка: %s", e)
         return {"status": "error", "message": str(e)}
 
 
+async def _send_seller_message(message: str):
+    """Отправляет сообщение в чат продавцов; при ограничении частоты Telegram ждёт и повторяет один раз."""
+    send_kwargs = {
+        "chat_id": config.TELEGRAM_CHAT_ID,
+        "text": message,
+        "parse_mode": "HTML",
+        "message_thread_id": config.TELEGRAM_TOPIC_ID,
+    }
+    try:
+        return await _get_bot().send_message(**send_kwargs)
+    except TelegramRetryAfter as e:
+        logger.warning("[notify_seller] Ограничение частоты Telegram, повтор через %s с", e.retry_after)
+        await asyncio.sleep(e.retry_after)
+        return await _get_bot().send_message(**send_kwargs)
+
+
 async def notify_seller(order_details: str, is_preorder: bool, context=None) -> dict:
     """Отправляет уведомление продавцу через Telegram"""
     try:
-        logger.info(f"[notify_seller] Отправка данных заказа продавцу (is_preorder={is_preorder})")
+        logger.info("[notify_seller] Отправка данных заказа продавцу (is_preorder=%s)", is_preorder)
 
         # Получаем информацию из контекста
         context_info = get_context_info(context)
@@ -349,44 +506,53 @@ async def notify_seller(order_details: str, is_preorder: bool, context=None) ->
         is_b2b = is_b2b_order(context_info, order_details)
 
         # Назначаем диалог только если есть dialog_id
-        assignment_result = None
         target_dialog_id = context_info.get("dialog_id")
 
+        # Формируем сообщение для продавца
+        # ID диалога (если есть) выводится в блоке информации о клиенте
         if target_dialog_id:
-            logger.info(f"[notify_seller] Назначаем менеджера на диалог {target_dialog_id}")
-            assignment_result = handle_manager_assignment(is_b2b, target_dialog_id)
-            logger.info(f"[notify_seller] Результат назначения диалога: {assignment_result}")
+            # Назначение (запросы к RetailCRM) идёт параллельно с отправкой: сообщение уходит
+            # сразу без результата назначения, а затем дополняется им через редактирование
+            logger.info("[notify_seller] Назначаем менеджера на диалог %s", target_dialog_id)
+            assignment_task = asyncio.create_task(handle_manager_assignment(is_b2b, target_dialog_id))
+            try:
+                sent_message = await _send_seller_message(format_seller_message(
+                    context_info, order_details, is_preorder, is_b2b, dialog_id=target_dialog_id
+                ))
+            finally:
+                # Назначение доводим до конца, даже если отправка не удалась
+                assignment_result = await assignment_task
+            logger.info("[notify_seller] Результат назначения диалога: %s", assignment_result)
+
+            message = format_seller_message(
+                context_info, order_details, is_preorder, is_b2b, assignment_result, dialog_id=target_dialog_id
+            )
+            try:
+                await _get_bot().edit_message_text(
+                    text=message,
+                    chat_id=config.TELEGRAM_CHAT_ID,
+                    message_id=sent_message.message_id,
+                    parse_mode="HTML",
+                )
+            except Exception as e:
+                # Уведомление уже доставлено, не хватает только строки о назначении
+                logger.warning("[notify_seller] Не удалось дополнить уведомление результатом назначения: %s", e)
         else:
             logger.warning("[notify_seller] Отсутствует dialog_id, назначение диалога невозможно")
             assignment_result = {"status": "warning", "message": "Не указан диалог для назначения"}
+            message = format_seller_message(context_info, order_details, is_preorder, is_b2b, assignment_result)
 
-        # Формируем сообщение для продавца
-        message = format_seller_message(context_info, order_details, is_preorder, is_b2b, assignment_result)
-
-        # Добавляем информацию о диалоге в сообщение, если она есть
-        if target_dialog_id:
-            message = message.replace("• ID чата:", f"• ID диалога: <code>{target_dialog_id}</code>\n• ID чата:")
-
-        # Отправляем сообщение
-        await bot.send_message(
-            chat_id=config.TELEGRAM_CHAT_ID,
-            text=message,
-            parse_mode="HTML",
-            message_thread_id=config.TELEGRAM_TOPIC_ID
-        )
+            # Отправляем сообщение
+            await _send_seller_message(message)
 
-        logger.info(f"[notify_seller] Уведомление успешно отправлено продавцу (chat_id: {config.TELEGRAM_CHAT_ID})")
+        logger.info("[notify_seller] Уведомление успешно отправлено продавцу (chat_id: %s)", config.TELEGRAM_CHAT_ID)
 
         # Возвращаем подтверждение в зависимости от типа заказа
-        if is_preorder:
-            confirmation_message = "Ура! Ваш предзаказ успешно оформлен! 🎉 Растение будет доступно в течение 7-10 дней. Я лично прослежу, чтобы с вами связались для подтверждения заказа и уточнения деталей доставки. Спасибо, что выбрали наш магазин! 💚"
-        else:
-            confirmation_message = "Отлично! Ваш заказ успешно оформлен! 🎉 Я уже передала информацию нашему менеджеру, и с вами скоро свяжутся. Если возникнут вопросы, обращайтесь в любое время! Спасибо за выбор нашего магазина! 💚"
-
+        confirmation_message = _CONFIRM_PREORDER if is_preorder else _CONFIRM_ORDER
         return {"status": "success", "confirmation_message": confirmation_message}
 
     except Exception as e:
-        logger.error(f"[notify_seller] Ошибка при отправке уведомления продавцу: {e}")
+        logger.error("[notify_seller] Ошибка при отправке уведомления продавцу: %s", e)
         error_message = "К сожалению, при оформлении заказа произошла ошибка. 😥 Пожалуйста, попробуйте еще раз или свяжитесь с нами напрямую."
         return {"status": "error", "error_message": error_message}
 
@@ -402,7 +568,7 @@ async def main():
     try:
         print(
             f"Попытка отправить тестовое сообщение в чат {config.TELEGRAM_CHAT_ID}, тему {config.TELEGRAM_TOPIC_ID}...")
-        await bot.send_message(
+        await _get_bot().send_message(
             chat_id=config.TELEGRAM_CHAT_ID,
             message_thread_id=config.TELEGRAM_TOPIC_ID,
             text=test_message,